@@ -1,87 +1,773 @@
 """ Routines to record audio from environment and store the files
 """
 
+import threading
+import time
 import wave
-from datetime import datetime
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from os import path, stat
 from uuid import uuid4
 
 from pony.orm import db_session
-from pyaudio import PyAudio, paInt16
+
+from ImHearing import dsp, retry, sources
 
 
 # Default Values to be used for recording
 CHUNK = 512
 DEVICE_INDEX = 2
-FORM_1 = paInt16
+SAMPLE_WIDTH = 2
 CHANNELS = 1
 SAMPLE_RATE = 44100
 
+# Seconds of audio kept in the ring buffer between the device and the disk
+BUFFER_SECONDS = 10
+
+# Seconds of silence kept before the first sound of a record
+PRE_ROLL_SECONDS = 0.5
+
+# A read is late when the audio it returns waited longer than this (seconds)
+LATE_READ_SECONDS = 0.25
+
+# The device has stalled when no audio arrives for two chunk durations (one
+# second at least, so scheduling hiccups are not taken for stalls)
+READ_TIMEOUT_CHUNKS = 2
+READ_TIMEOUT_MIN_SECONDS = 1.0
+
+# After each stall in a row, the source is reopened and the wait for audio
+# doubled, up to this (seconds), so a dead device is not polled every second
+STALL_BACKOFF_MAX_SECONDS = 60.0
+
+
+class RingBuffer:
+    """
+    Preallocated byte ring buffer filled by the audio source and drained by
+    the recorder. Non-blocking writes never wait: when the reader falls
+    behind, the oldest bytes are dropped and accounted, so the position of
+    every byte in the captured stream is always known.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._buffer = bytearray(capacity)
+        self._read_pos = 0
+        self._size = 0
+        self._consumed = 0
+        self.dropped = 0
+        self.closed = False
+        self._cond = threading.Condition()
+
+    def write(self, data, block=False):
+        """
+        Appends data to the buffer, dropping the oldest bytes on overflow.
+        :param data: bytes to append
+        :param block: Wait for the reader instead of dropping bytes
+        :return: Number of bytes dropped to make room for data
+        """
+        data = memoryview(data)
+        with self._cond:
+            if block:
+                self._cond.wait_for(
+                    lambda: self.closed or
+                    self._size + len(data) <= self.capacity)
+            if self.closed:
+                return 0
+            dropped = 0
+            if len(data) > self.capacity:
+                dropped += len(data) - self.capacity
+                data = data[len(data) - self.capacity:]
+            overflow = self._size + len(data) - self.capacity
+            if overflow > 0:
+                self._read_pos = (self._read_pos + overflow) % self.capacity
+                self._size -= overflow
+                dropped += overflow
+            self.dropped += dropped
+
+            write_pos = (self._read_pos + self._size) % self.capacity
+            first = min(len(data), self.capacity - write_pos)
+            self._buffer[write_pos:write_pos + first] = data[:first]
+            self._buffer[:len(data) - first] = data[first:]
+            self._size += len(data)
+            self._cond.notify_all()
+            return dropped
+
+    def read(self, nbytes, timeout=None):
+        """
+        Blocks until nbytes are available and removes them from the buffer.
+        Once the buffer is closed, returns whatever is left (maybe nothing).
+        :param nbytes: Number of bytes to read
+        :param timeout: Max seconds to wait, None waits forever
+        :return: Tuple (data, stream offset of the first byte returned)
+        """
+        with self._cond:
+            if not self._cond.wait_for(
+                    lambda: self.closed or self._size >= nbytes, timeout):
+                raise TimeoutError('No audio received from source')
+            nbytes = min(nbytes, self._size)
+            offset = self._consumed + self.dropped
+            first = min(nbytes, self.capacity - self._read_pos)
+            data = bytes(self._buffer[self._read_pos:self._read_pos + first])
+            if first < nbytes:
+                data += bytes(self._buffer[:nbytes - first])
+            self._read_pos = (self._read_pos + nbytes) % self.capacity
+            self._size -= nbytes
+            self._consumed += nbytes
+            self._cond.notify_all()
+            return data, offset
+
+    @property
+    def available(self):
+        """
+        Number of bytes waiting to be read.
+        """
+        with self._cond:
+            return self._size
+
+    @property
+    def end_offset(self):
+        """
+        Stream offset following the last byte written.
+        """
+        with self._cond:
+            return self._consumed + self.dropped + self._size
+
+    def close(self):
+        """
+        Marks the end of the stream, waking up blocked readers and writers.
+        """
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+
+class CaptureStats:
+    """
+    Health counters of the capture path: overflows (events where audio was
+    lost, either by the device or by the ring buffer), dropped frames, late
+    reads and the read latency, which is how long audio waited in the ring
+    buffer before being read.
+    """
+
+    def __init__(self):
+        self.overflows = 0
+        self.dropped_frames = 0
+        self.reads = 0
+        self.late_reads = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def add_overflow(self, dropped_frames=0):
+        self.overflows += 1
+        self.dropped_frames += dropped_frames
+
+    def add_read(self, latency):
+        self.reads += 1
+        self.latency_total += latency
+        self.latency_max = max(self.latency_max, latency)
+        if latency > LATE_READ_SECONDS:
+            self.late_reads += 1
+
+    @property
+    def latency_avg(self):
+        return self.latency_total / self.reads if self.reads else 0.0
+
+    def as_dict(self):
+        """
+        Counters as a dict, with latencies in milliseconds.
+        """
+        return {
+            'overflows': self.overflows,
+            'dropped_frames': self.dropped_frames,
+            'reads': self.reads,
+            'late_reads': self.late_reads,
+            'read_latency_avg': self.latency_avg * 1000,
+            'read_latency_max': self.latency_max * 1000
+        }
+
+
+class CaptureEngine:
+    """
+    Long-lived capture engine. The audio source is started once and keeps
+    filling the ring buffer between records, so consecutive records are cut
+    at frame boundaries of the same continuous stream. When the recording
+    format (rate, channels, sample_width) differs from the source, audio is
+    converted while it is read. Health counters are kept for the whole
+    execution (stats) and since the previous record ended (record_stats),
+    so audio lost between records (e.g. while archiving) is accounted to
+    the next one. device tags the records captured by the engine. Frames
+    are timed from the wall clock when the first chunk arrives, and again
+    whenever audio resumes after a gap longer than read_timeout, as the
+    device delivered nothing meanwhile (see frame_time). stalls counts the
+    records in a row that ended on a stall, and stall_marker is the id of
+    the marker Record of the last stall without audio, extended while the
+    device stays silent (see start_recording).
+    """
+
+    def __init__(self, source, buffer_seconds=BUFFER_SECONDS, rate=None,
+                 channels=None, sample_width=None, device=''):
+        self.source = source
+        self.device = device
+        self.rate = rate or source.rate
+        self.channels = channels or source.channels
+        self.sample_width = sample_width or source.sample_width
+        self.chunk = source.chunk
+        self.frame_size = self.channels * self.sample_width
+        self.ring = RingBuffer(source.rate * buffer_seconds *
+                               source.frame_size)
+        self.converter = None
+        # (stream second, wall clock time of stream second 0) of each span
+        # of continuous audio, see frame_time
+        self._anchors = list()
+        self._last_arrival = None
+        self.stalls = 0
+        self.stall_marker = None
+        self.stats = CaptureStats()
+        self.record_stats = CaptureStats()
+        self._stats_lock = threading.Lock()
+        self._pending = bytearray()
+        self._pending_frame = 0
+        self._next_source_frame = None
+        self._ended = False
+
+    def start(self):
+        """
+        Starts the source, which begins filling the ring buffer.
+        """
+        self.source.start(self._sink)
+
+    def stop(self):
+        """
+        Stops the source and ends the captured stream.
+        """
+        self.ring.close()
+        self.source.stop()
+
+    def restart(self):
+        """
+        Reopens the source after a stall, with a new ring buffer: the
+        captured stream, and its frame count, start over.
+        :return: True if the source started, False if it failed to (e.g. the
+                 device is gone), leaving reads to time out
+        """
+        self.stop()
+        self.ring = RingBuffer(self.ring.capacity)
+        self.converter = None
+        self._anchors = list()
+        self._last_arrival = None
+        self._pending.clear()
+        self._pending_frame = 0
+        self._next_source_frame = None
+        self._ended = False
+        try:
+            self.start()
+        except OSError:
+            return False
+        return True
+
+    def roll_record_stats(self):
+        """
+        Ends the health counters of a record and starts those of the next
+        one, which also count what happens until it starts.
+        :return: CaptureStats Object of the record ended
+        """
+        with self._stats_lock:
+            stats = self.record_stats
+            self.record_stats = CaptureStats()
+            return stats
+
+    def _sink(self, data, overflow=False):
+        if not data:
+            self.ring.close()
+            return
+        if self._last_arrival is None or \
+                time.monotonic() - self._last_arrival > self.read_timeout:
+            # The first chunk, or the first one after a gap, was captured
+            # len(data) frames ago
+            first = self.ring.end_offset / self.source.frame_size / \
+                self.source.rate
+            end = first + len(data) / self.source.frame_size / \
+                self.source.rate
+            self._anchors.append(
+                (first, datetime.now() - timedelta(seconds=end)))
+        dropped = self.ring.write(data, block=not self.source.realtime)
+        # After the write, so waiting for the reader is not taken for a gap
+        self._last_arrival = time.monotonic()
+        if overflow or dropped:
+            with self._stats_lock:
+                for stats in (self.stats, self.record_stats):
+                    stats.add_overflow(dropped // self.source.frame_size)
+
+    def _restart_stream(self, source_frame):
+        self._pending.clear()
+        self._pending_frame = source_frame
+        if (self.rate, self.channels, self.sample_width) != \
+                (self.source.rate, self.source.channels,
+                 self.source.sample_width):
+            self.converter = dsp.FormatConverter(
+                self.source.rate, self.source.channels,
+                self.source.sample_width, self.rate, self.channels,
+                self.sample_width, position=source_frame)
+            self._pending_frame = self.converter.next_output
+
+    def _fill(self, nbytes, timeout):
+        while len(self._pending) < nbytes and not self._ended:
+            data, offset = self.ring.read(
+                self.source.chunk * self.source.frame_size, timeout)
+            if not data:
+                self._ended = True
+                if self.converter is not None:
+                    self._pending += self.converter.flush()
+                return
+            latency = (self.ring.available + len(data)) / \
+                self.source.frame_size / self.source.rate
+            with self._stats_lock:
+                for stats in (self.stats, self.record_stats):
+                    stats.add_read(latency)
+
+            offset //= self.source.frame_size
+            if offset != self._next_source_frame:
+                # First read, or the reader fell behind and audio was
+                # dropped: the stream (and the converter) restart there
+                self._restart_stream(offset)
+            self._next_source_frame = offset + \
+                len(data) // self.source.frame_size
+            if self.converter is not None:
+                data = self.converter.process(data)
+            self._pending += data
+
+    def read(self, frames, timeout=None):
+        """
+        Reads the next frames of the captured stream, in the recording
+        format.
+        :param frames: Number of frames to read
+        :param timeout: Max seconds to wait for the device
+        :return: Tuple (data, index of the first frame returned). data is
+                 shorter than requested only when the stream ended
+        """
+        nbytes = frames * self.frame_size
+        self._fill(nbytes, timeout)
+        data = bytes(self._pending[:nbytes])
+        del self._pending[:nbytes]
+        offset = self._pending_frame
+        self._pending_frame += len(data) // self.frame_size
+        return data, offset
+
+    @property
+    def read_timeout(self):
+        """
+        Seconds without audio after which the source is considered stalled.
+        """
+        return max(READ_TIMEOUT_MIN_SECONDS,
+                   READ_TIMEOUT_CHUNKS * self.source.chunk / self.source.rate)
+
+    @property
+    def stall_timeout(self):
+        """
+        Seconds to wait for audio: read_timeout, doubled after each stall in
+        a row up to STALL_BACKOFF_MAX_SECONDS.
+        """
+        return retry.Backoff(
+            base=self.read_timeout,
+            cap=max(self.read_timeout, STALL_BACKOFF_MAX_SECONDS)
+        ).ceiling(self.stalls + 1)
+
+    def frame_time(self, frame_index):
+        """
+        Wall clock time of a given frame, computed from the frame count
+        since the start of its span of continuous audio.
+        :param frame_index: Index of the frame in the captured stream
+        :return: datetime of the frame
+        """
+        seconds = frame_index / self.rate
+        anchor = self._anchors[0][1]
+        for first, span_anchor in self._anchors[1:]:
+            if first > seconds:
+                break
+            anchor = span_anchor
+        return anchor + timedelta(seconds=seconds)
+
+
+def get_devices(global_config):
+    """
+    Input devices to capture from, set in the Global Configuration as a
+    comma separated list (device_index).
+    :param global_config: Global Configuration dict
+    :return: List of device indexes
+    """
+    devices = str(global_config.get('device_index', DEVICE_INDEX))
+    return [int(device) for device in devices.split(',') if device.strip()]
+
+
+def get_source(global_config, device_index=DEVICE_INDEX):
+    """
+    Creates the audio source set in the Global Configuration (audio_source):
+    pyaudio (default), file or signal.
+    :param global_config: Global Configuration dict
+    :param device_index: Input device used by the pyaudio source
+    :return: AudioSource Object
+    """
+    source_type = global_config.get('audio_source', 'pyaudio')
+    speed = float(global_config.get('source_speed', 1))
+    rate = int(global_config.get('capture_rate', SAMPLE_RATE))
+    channels = int(global_config.get('capture_channels', CHANNELS))
+
+    if source_type == 'file':
+        return sources.WaveFileSource(global_config['source_file'], CHUNK,
+                                      speed=speed)
+    if source_type == 'signal':
+        return sources.SignalSource(rate, channels, CHUNK, speed=speed)
+    return sources.PyAudioSource(device_index, rate, channels, SAMPLE_WIDTH,
+                                 CHUNK)
+
+
+def get_capture_engine(global_config, device_index=None):
+    """
+    Creates a capture engine using the Global Configuration. Records are
+    stored with sample_rate, channels and sample_width, which default to the
+    format of the source.
+    :param global_config: Global Configuration dict
+    :param device_index: Input device, if None the first configured one
+    :return: CaptureEngine Object (not started)
+    """
+    if device_index is None:
+        device_index = get_devices(global_config)[0]
+    source = get_source(global_config, device_index)
+    return CaptureEngine(
+        source,
+        buffer_seconds=int(global_config.get('capture_buffer',
+                                             BUFFER_SECONDS)),
+        rate=int(global_config.get('sample_rate', source.rate)),
+        channels=int(global_config.get('channels', source.channels)),
+        sample_width=int(global_config.get('sample_width',
+                                           source.sample_width)),
+        device=str(device_index))
+
+
+def get_capture_engines(global_config):
+    """
+    Creates one capture engine, with its own source and ring buffer, for
+    each configured device.
+    :param global_config: Global Configuration dict
+    :return: List of CaptureEngine Objects (not started)
+    """
+    return [get_capture_engine(global_config, device)
+            for device in get_devices(global_config)]
+
+
+def get_health_fields(stats):
+    """
+    Record attributes with the capture health of a record.
+    :param stats: CaptureStats Object of the record
+    :return: Dict of Record attributes
+    """
+    return {
+        'overflows': stats.overflows,
+        'late_reads': stats.late_reads,
+        'read_latency_avg': stats.latency_avg * 1000,
+        'read_latency_max': stats.latency_max * 1000
+    }
+
+
+def _get_level(global_config, key):
+    level = global_config.get(key, '')
+    if level is None or str(level).strip() == '':
+        return None
+    return float(level)
+
+
+def get_silence_threshold(global_config):
+    """
+    Level (dBFS) under which audio is considered silence, from the Global
+    Configuration (silence_threshold).
+    :param global_config: Global Configuration dict
+    :return: Threshold in dBFS, or None if silence detection is disabled
+    """
+    return _get_level(global_config, 'silence_threshold')
+
+
+def get_priority_threshold(global_config):
+    """
+    Peak level (dBFS) from which a record is a priority one, to be uploaded
+    right away, from the Global Configuration (priority_threshold).
+    :param global_config: Global Configuration dict
+    :return: Threshold in dBFS, or None if priority uploads are disabled
+    """
+    return _get_level(global_config, 'priority_threshold')
+
+
+class WaveWriter:
+    """
+    Writes a record as raw PCM in a WAV file.
+    """
+
+    def __init__(self, file_path, engine):
+        self._file = wave.open(file_path, 'wb')
+        self._file.setnchannels(engine.channels)
+        self._file.setsampwidth(engine.sample_width)
+        self._file.setframerate(engine.rate)
+
+    def write(self, data):
+        self._file.writeframesraw(data)
+
+    def close(self):
+        # Patches the header with the number of frames written
+        self._file.close()
+
+
+class FlacWriter:
+    """
+    Encodes a record as FLAC (lossless) while it is captured. Requires the
+    soundfile package.
+    """
+
+    SUBTYPES = {1: 'PCM_S8', 2: 'PCM_16'}
+
+    def __init__(self, file_path, engine):
+        import soundfile
+
+        if engine.sample_width not in self.SUBTYPES:
+            raise ValueError('FLAC records must have 8 or 16 bits samples')
+        self._sample_width = engine.sample_width
+        self._channels = engine.channels
+        self._file = soundfile.SoundFile(
+            file_path, 'w', samplerate=engine.rate, channels=engine.channels,
+            subtype=self.SUBTYPES[engine.sample_width], format='FLAC')
+
+    def write(self, data):
+        if self._sample_width == 1:
+            data = dsp.from_float(dsp.to_float(data, 1), 2)
+        self._file.buffer_write(data, dtype='int16')
+
+    def close(self):
+        self._file.close()
+
+
+# Writers of each record format, by file extension
+RECORD_WRITERS = {
+    'wav': WaveWriter,
+    'flac': FlacWriter
+}
+
+
+def get_record_format(global_config):
+    """
+    Format used to store records, from the Global Configuration
+    (record_format): wav (default) or flac.
+    :param global_config: Global Configuration dict
+    :return: Record format, which is also the file extension
+    """
+    record_format = global_config.get('record_format', 'wav') or 'wav'
+    if record_format not in RECORD_WRITERS:
+        raise ValueError('Unknown record format {}'.format(record_format))
+    return record_format
+
 
 @db_session
-def start_recording(db, global_config):
+def start_recording(db, global_config, engine=None):
     """
-    Main routine to perform environment records.
+    Main routine to perform environment records. When silence detection is
+    enabled, the leading silence of a record is not stored and a record
+    which is silent from start to end has no file at all: it is either
+    dropped or stored as a marker Record (status 'silent'), according to
+    silence_mode. A record whose peak reaches priority_threshold gets the
+    status 'priority', to be archived and uploaded on its own. If the device
+    stalls (no audio for engine.read_timeout), the record ends there with
+    the status 'error', keeping the audio captured so far. The next record
+    reopens the source and waits longer for audio (engine.stall_timeout);
+    while the device stays silent, the marker of the stall is extended
+    instead of storing a new one.
     :param db: DB Connection to Pony
     :param global_config: Global Configuration dict
-    :return: Record Object or -1 on error
+    :param engine: Running CaptureEngine. If None, a temporary one is opened
+                   and closed for this single record
+    :return: Record Object, None if a silent record was dropped or -1 on
+             error
     """
 
     if not path.isdir(global_config['record_path']):
         return -1
-    
-    audio = PyAudio()
-    frames = list()
-    stream = audio.open(format=FORM_1,
-                        rate=SAMPLE_RATE,
-                        channels=CHANNELS,
-                        input_device_index=DEVICE_INDEX,
-                        input=True, frames_per_buffer=CHUNK)
+
+    own_engine = engine is None
+    if own_engine:
+        engine = get_capture_engine(global_config)
+        engine.start()
+    elif engine.stalls:
+        engine.restart()
+
     record_uuid = uuid4()
+    record_format = get_record_format(global_config)
     record_file = get_filename(
         file_name_parts=[str(record_uuid)[35 - 11:],
-                         str(int(datetime.now().timestamp()))])
+                         str(int(datetime.now().timestamp()))],
+        extension=record_format)
+    input_file = global_config['record_path'] + record_file
+
+    threshold = get_silence_threshold(global_config)
+    pre_roll = deque()
+    pre_roll_frames = 0
+    max_pre_roll_frames = int(engine.rate * PRE_ROLL_SECONDS)
+
+    # Chunks are appended to the file as soon as they are read, so memory
+    # usage does not grow with the record period. The file is only created
+    # once sound is heard, and the header is finalized by close().
+    record_writer = None
+    envelope = dsp.LoudnessEnvelope(engine.rate, engine.channels,
+                                    engine.sample_width)
 
     # Start the Recording
-    time_start = datetime.now()
-    for _ in range(0, (SAMPLE_RATE // CHUNK) * int(global_config['record_period'])):
-        data = stream.read(CHUNK, exception_on_overflow=False)
-        frames.append(data)
-
-    stream.stop_stream()
-    stream.close()
-    audio.terminate()
-    time_end = datetime.now()
+    frames_left = engine.rate * int(global_config['record_period'])
+    first_frame = None
+    stalled = False
+    try:
+        while frames_left > 0:
+            timeout = engine.stall_timeout
+            try:
+                data, offset = engine.read(min(engine.chunk, frames_left),
+                                           timeout)
+            except TimeoutError:
+                stalled = True
+                break
+            if not data:
+                break
+            frames = len(data) // engine.frame_size
+            if first_frame is None:
+                first_frame = offset
+                engine.stalls = 0
+                engine.stall_marker = None
+            frames_left -= frames
+            last_frame = offset + frames
+
+            if record_writer is None:
+                if threshold is not None and dsp.rms_dbfs(
+                        dsp.to_float(data, engine.sample_width)) < threshold:
+                    # Keep a short pre-roll, so the onset is not clipped
+                    pre_roll.append((data, offset))
+                    pre_roll_frames += frames
+                    if pre_roll_frames > max_pre_roll_frames:
+                        old_data, _ = pre_roll.popleft()
+                        pre_roll_frames -= len(old_data) // engine.frame_size
+                    continue
+
+                record_writer = RECORD_WRITERS[record_format](input_file,
+                                                              engine)
+                sound_frame = pre_roll[0][1] if pre_roll else offset
+                for pre_data, _ in pre_roll:
+                    record_writer.write(pre_data)
+                    envelope.add(pre_data)
+                pre_roll.clear()
+            record_writer.write(data)
+            envelope.add(data)
+    finally:
+        if record_writer is not None:
+            record_writer.close()
+        if own_engine:
+            engine.stop()
     # Finish the Recording
 
-    input_file = global_config['record_path'] + record_file
-    wavefile = wave.open(input_file, 'wb')
-    wavefile.setnchannels(CHANNELS)
-    wavefile.setsampwidth(audio.get_sample_size(FORM_1))
-    wavefile.setframerate(SAMPLE_RATE)
-    wavefile.writeframes(b''.join(frames))
-    wavefile.close()
+    # The source ended before delivering any audio
+    if first_frame is None and not stalled:
+        return -1
+
+    # Counters since the previous record, audio lost in between included
+    stats = engine.roll_record_stats()
+    if stalled:
+        engine.stalls += 1
+
+    # The device stalled before delivering any audio: only a marker of the
+    # time spent waiting is stored, or the marker of the previous stall is
+    # extended
+    if first_frame is None:
+        stall_end = datetime.now()
+        marker = db.Record.get(id=engine.stall_marker) \
+            if engine.stall_marker is not None else None
+        if marker is not None:
+            marker.end = stall_end
+            marker.overflows += stats.overflows
+            marker.late_reads += stats.late_reads
+            return marker
+        marker = db.Record(
+            start=stall_end - timedelta(seconds=timeout),
+            end=stall_end,
+            size=0,
+            path='',
+            status='error',
+            removed=True,
+            device=engine.device,
+            **get_health_fields(stats)
+        )
+        engine.stall_marker = marker.id
+        return marker
+
+    if record_writer is None:
+        if not stalled and \
+                global_config.get('silence_mode', 'marker') == 'drop':
+            return None
+        return db.Record(
+            start=engine.frame_time(first_frame),
+            end=engine.frame_time(last_frame),
+            size=0,
+            path='',
+            status='error' if stalled else 'silent',
+            removed=True,
+            device=engine.device,
+            **get_health_fields(stats)
+        )
+
+    # Loud records skip the bulk batch and go through the priority lane
+    status = 'recorded'
+    priority_threshold = get_priority_threshold(global_config)
+    levels = envelope.levels()
+    if stalled:
+        status = 'error'
+    elif priority_threshold is not None and len(levels) and \
+            levels[:, 1].max() >= priority_threshold:
+        status = 'priority'
 
     record_new = db.Record(
-        start=time_start,
-        end=time_end,
+        start=engine.frame_time(sound_frame),
+        end=engine.frame_time(last_frame),
         size=stat(input_file).st_size / (1024 * 1024),
         path=input_file,
-        status='recorded'
+        status=status,
+        device=engine.device,
+        loudness=envelope.pack(),
+        **get_health_fields(stats)
     )
 
     return record_new
 
 
-def get_filename(file_name_parts=None):
+def start_recording_all(db, global_config, engines):
+    """
+    Records from all engines at once, each one in its own thread, so devices
+    are captured in parallel. Records of a device stay gapless, since its
+    engine keeps capturing while the others finish.
+    :param db: DB Connection to Pony
+    :param global_config: Global Configuration dict
+    :param engines: List of running CaptureEngine Objects
+    :return: List with the result of start_recording for each engine
+    """
+    if len(engines) == 1:
+        return [start_recording(db, global_config, engines[0])]
+
+    with ThreadPoolExecutor(max_workers=len(engines)) as executor:
+        return list(executor.map(
+            lambda engine: start_recording(db, global_config, engine),
+            engines))
+
+
+def get_filename(file_name_parts=None, extension='wav'):
     """
     This routine creates the filename to be used to store the record.
     :param file_name_parts: file name parts
+    :param extension: file extension, according to the record format
     :return: File Name to store the record
     """
     file_partial = ''
     if file_name_parts is not None:
         for part in file_name_parts:
             file_partial = file_partial + '_' + part
-    output_file = 'record_' + file_partial + '.wav'
+    output_file = 'record_' + file_partial + '.' + extension
     return output_file
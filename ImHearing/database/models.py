@@ -1,7 +1,97 @@
 from datetime import datetime
 from uuid import UUID
 
-from pony.orm import Database, Optional, PrimaryKey, Required, Set
+from pony.orm import Database, Optional, PrimaryKey, Required, Set, db_session
+
+# Triggers keeping the Counters row up to date in the same transaction as
+# the change of a Record or an Archive: local records (not removed) and
+# their size, and the size of the archives uploaded. Insert and delete are
+# updates from or to nothing, so a single delta expression serves the three.
+RECORD_DELTA = '''
+    local_records = local_records + {new_local} - {old_local},
+    local_records_mb = local_records_mb +
+        {new_local} * COALESCE({new}."size", 0) -
+        {old_local} * COALESCE({old}."size", 0)'''
+ARCHIVE_DELTA = '''
+    uploaded_mb = uploaded_mb +
+        {new_uploaded} * COALESCE({new}."size", 0) -
+        {old_uploaded} * COALESCE({old}."size", 0)'''
+COUNTER_TRIGGERS = {
+    'counters_record_insert': ('AFTER INSERT ON "Record"', RECORD_DELTA.format(
+        new='NEW', old='NEW', new_local='(NOT NEW."removed")', old_local='0')),
+    'counters_record_update': (
+        'AFTER UPDATE OF "size", "removed" ON "Record"', RECORD_DELTA.format(
+            new='NEW', old='OLD', new_local='(NOT NEW."removed")',
+            old_local='(NOT OLD."removed")')),
+    'counters_record_delete': ('AFTER DELETE ON "Record"', RECORD_DELTA.format(
+        new='OLD', old='OLD', new_local='0',
+        old_local='(NOT OLD."removed")')),
+    'counters_archive_insert': (
+        'AFTER INSERT ON "Archive"', ARCHIVE_DELTA.format(
+            new='NEW', old='NEW', new_uploaded='COALESCE(NEW."uploaded", 0)',
+            old_uploaded='0')),
+    'counters_archive_update': (
+        'AFTER UPDATE OF "size", "uploaded" ON "Archive"',
+        ARCHIVE_DELTA.format(
+            new='NEW', old='OLD',
+            new_uploaded='COALESCE(NEW."uploaded", 0)',
+            old_uploaded='COALESCE(OLD."uploaded", 0)')),
+    'counters_archive_delete': (
+        'AFTER DELETE ON "Archive"', ARCHIVE_DELTA.format(
+            new='OLD', old='OLD', new_uploaded='0',
+            old_uploaded='COALESCE(OLD."uploaded", 0)'))
+}
+
+# Columns added to existing tables after they were first released. Pony only
+# creates missing tables, so these are added to older databases in place
+# (schema version 1, see MIGRATIONS).
+ADDED_COLUMNS = {
+    'Record': [
+        ('overflows', 'INTEGER'),
+        ('late_reads', 'INTEGER'),
+        ('read_latency_avg', 'REAL'),
+        ('read_latency_max', 'REAL'),
+        ('device', 'TEXT'),
+        ('loudness', 'BLOB'),
+        ('member_offset', 'INTEGER'),
+        ('member_length', 'INTEGER'),
+        ('member_compress_size', 'INTEGER'),
+        ('member_crc', 'INTEGER'),
+        ('member_compress_type', 'INTEGER'),
+        ('sha256', 'TEXT')
+    ],
+    'Archive': [
+        ('upload_id', 'TEXT'),
+        ('upload_part_size', 'INTEGER'),
+        ('sha256', 'TEXT'),
+        ('md5', 'TEXT'),
+        ('etag', 'TEXT'),
+        ('upload_attempts', 'INTEGER'),
+        ('next_attempt', 'DATETIME')
+    ]
+}
+
+# Indexes on the fields the queries filter on (schema version 2): name,
+# table and columns. Composite indexes also serve their first column alone,
+# so filters on Record.start use idx_record__start_id (PAGE_INDEXES).
+INDEXES = [
+    ('idx_record__end', 'Record', ('end',)),
+    ('idx_record__status_removed', 'Record', ('status', 'removed')),
+    ('idx_record__removed', 'Record', ('removed',)),
+    ('idx_archive__uploaded_next_attempt', 'Archive',
+     ('uploaded', 'next_attempt')),
+    ('idx_archive__removed', 'Archive', ('removed',))
+]
+
+# Indexes on the keys of the pagination of the web views (schema version 4)
+PAGE_INDEXES = [
+    ('idx_record__start_id', 'Record', ('start', 'id')),
+    ('idx_archive__creation_id', 'Archive', ('creation', 'id'))
+]
+
+# Duration of a record in days, indexed (schema version 3) so the longest
+# record is found without a scan. Queries must use the same expression.
+RECORD_DURATION = 'julianday("end") - julianday("start")'
 
 
 def define_entities(db):
@@ -23,6 +113,18 @@ def define_entities(db):
         status = Optional(str)
         removed = Required(bool, default=False)
         archive = Optional('Archive')
+        overflows = Optional(int)
+        late_reads = Optional(int)
+        read_latency_avg = Optional(float)
+        read_latency_max = Optional(float)
+        device = Optional(str)
+        loudness = Optional(bytes)
+        member_offset = Optional(int, size=64)
+        member_length = Optional(int, size=64)
+        member_compress_size = Optional(int, size=64)
+        member_crc = Optional(int, size=64)
+        member_compress_type = Optional(int)
+        sha256 = Optional(str)
 
     class Archive(db.Entity):
         id = PrimaryKey(UUID, auto=True)
@@ -33,6 +135,28 @@ def define_entities(db):
         uploaded = Optional(bool, default=False)
         removed = Required(bool, default=False)
         records = Set(Record)
+        upload_id = Optional(str)
+        upload_part_size = Optional(int)
+        upload_parts = Set('UploadPart')
+        sha256 = Optional(str)
+        md5 = Optional(str)
+        etag = Optional(str)
+        upload_attempts = Optional(int)
+        next_attempt = Optional(datetime)
+
+    class UploadPart(db.Entity):
+        archive = Required(Archive)
+        number = Required(int)
+        etag = Required(str)
+        PrimaryKey(archive, number)
+
+    class Counters(db.Entity):
+        # A single row (id 1), only written by the triggers and
+        # repair_counters, read with query.get_counters
+        id = PrimaryKey(int)
+        local_records = Required(int, default=0)
+        local_records_mb = Required(float, default=0)
+        uploaded_mb = Required(float, default=0)
 
     class Token(db.Entity):
         id = PrimaryKey(UUID, auto=True)
@@ -40,9 +164,170 @@ def define_entities(db):
         user = Required(User)
 
 
-def define_db(**db_params):
-    db = Database(**db_params)
+def add_missing_columns(db):
+    for table, columns in ADDED_COLUMNS.items():
+        existing = db.select("name FROM pragma_table_info($table)")
+        for name, sql_type in columns:
+            if name not in existing:
+                db.execute('ALTER TABLE "{}" ADD COLUMN "{}" {}'.format(
+                    table, name, sql_type))
+
+
+def create_indexes(db, indexes=INDEXES):
+    for name, table, columns in indexes:
+        db.execute('CREATE INDEX IF NOT EXISTS "{}" ON "{}" ({})'.format(
+            name, table, ', '.join('"{}"'.format(column)
+                                   for column in columns)))
+
+
+def create_duration_index(db):
+    db.execute('CREATE INDEX IF NOT EXISTS "idx_record__duration" '
+               'ON "Record" ({})'.format(RECORD_DURATION))
+
+
+def create_page_indexes(db):
+    create_indexes(db, PAGE_INDEXES)
+
+# SQLite settings of the DB Configuration, in the order they are applied,
+# with their valid values. The busy timeout comes first, so a change of
+# journal mode waits for other connections instead of failing
+SQLITE_PRAGMAS = [
+    ('busy_timeout', int),
+    ('journal_mode', ('delete', 'truncate', 'persist', 'memory', 'wal',
+                      'off')),
+    ('synchronous', ('off', 'normal', 'full', 'extra')),
+    ('cache_size', int),
+    ('mmap_size', int)
+]
+
+
+# Schema migrations by version, applied in order to databases with a lower
+# user_version (PRAGMA), new ones included: Pony creates the tables as
+# defined above, but neither adds columns nor indexes to existing ones.
+# Each migration runs in a transaction with the version bump, and must
+# also work on the tables created by Pony.
+MIGRATIONS = [
+    (1, add_missing_columns),
+    (2, create_indexes),
+    (3, create_duration_index),
+    (4, create_page_indexes)
+]
+
+
+def get_schema_version(db):
+    """
+    Schema version of a database, as stored by migrate.
+    :param db: DB Connection to Pony
+    :return: Version, 0 for databases never migrated
+    """
+    with db_session:
+        return db.select('user_version FROM pragma_user_version')[0]
+
+
+def migrate(db):
+    """
+    Brings the schema of a database to the last version in MIGRATIONS.
+    :param db: DB Connection to Pony
+    :return: List of the versions applied
+    """
+    applied = list()
+    for version, migration in MIGRATIONS:
+        if version <= get_schema_version(db):
+            continue
+        with db_session:
+            migration(db)
+            db.execute('PRAGMA user_version = {}'.format(int(version)))
+        applied.append(version)
+    return applied
+
+
+@db_session
+def repair_counters(db):
+    """
+    Recomputes the Counters row from the Record and Archive tables, e.g.
+    after they were edited with the triggers missing.
+    :param db: DB Connection to Pony
+    """
+    db.execute('''
+        INSERT OR REPLACE INTO "Counters"
+            (id, local_records, local_records_mb, uploaded_mb)
+        SELECT 1,
+            (SELECT COUNT(*) FROM "Record" WHERE NOT "removed"),
+            (SELECT COALESCE(SUM("size"), 0) FROM "Record"
+             WHERE NOT "removed"),
+            (SELECT COALESCE(SUM("size"), 0) FROM "Archive"
+             WHERE "uploaded")''')
+
+
+@db_session
+def create_counters(db):
+    """
+    Creates the triggers maintaining the Counters row, computing it first
+    when it does not exist yet (new or older databases).
+    :param db: DB Connection to Pony
+    """
+    for name, (event, delta) in COUNTER_TRIGGERS.items():
+        db.execute('CREATE TRIGGER IF NOT EXISTS "{}" {} BEGIN '
+                   'UPDATE "Counters" SET {} WHERE id = 1; END'.format(
+                       name, event, delta))
+    if not db.select('id FROM "Counters" WHERE id = 1'):
+        repair_counters(db)
+
+
+def get_sqlite_profile(db_config):
+    """
+    SQLite settings of the DB Configuration, as the PRAGMAs to run on each
+    connection: busy_timeout (ms), journal_mode, synchronous, cache_size and
+    mmap_size. Settings left empty keep the SQLite default.
+    :param db_config: DB Config Dict
+    :return: List of (PRAGMA, value) tuples, in the order to run them
+    :raises ValueError: if a setting is not valid
+    """
+    profile = list()
+    for pragma, values in SQLITE_PRAGMAS:
+        value = (db_config.get(pragma, '') or '').strip().lower()
+        if not value:
+            continue
+        if values is int:
+            value = int(value)
+        elif value not in values:
+            raise ValueError('Invalid {} {}'.format(pragma, value))
+        profile.append((pragma, value))
+    return profile
+
+
+def set_sqlite_profile(db, profile):
+    """
+    Runs the profile PRAGMAs on every connection Pony opens to the database
+    (one per thread), before its first transaction.
+    :param db: DB Connection to Pony, not bound yet
+    :param profile: List of (PRAGMA, value) tuples, see get_sqlite_profile
+    """
+    @db.on_connect(provider='sqlite')
+    def apply_profile(_, connection):
+        cursor = connection.cursor()
+        for pragma, value in profile:
+            cursor.execute('PRAGMA {} = {}'.format(pragma, value))
+
+
+def define_db(profile=None, **db_params):
+    """
+    Binds the database, creates or migrates its schema and its counters.
+    :param profile: SQLite PRAGMAs run on each connection, see
+                    get_sqlite_profile
+    :param db_params: Pony Database parameters
+    :return: DB Connection to Pony
+    """
+    db = Database()
+    if profile:
+        set_sqlite_profile(db, profile)
+    db.bind(**db_params)
     define_entities(db)
-    db.generate_mapping(create_tables=True)
+    # Older tables lack the columns added since, so they are checked against
+    # the entities once migrated
+    db.generate_mapping(create_tables=True, check_tables=False)
+    migrate(db)
+    db.check_tables()
+    create_counters(db)
 
     return db
\ No newline at end of file
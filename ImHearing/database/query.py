@@ -1,8 +1,26 @@
 """ This file contains routines to query Objects into SQLite using Pony
 """
 
+import binascii
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime, timedelta
+from functools import lru_cache
+from uuid import UUID
+
+import numpy as np
 from maya import parse
-from pony.orm import db_session, select
+from pony.orm import count, db_session, flush, max, select, sum
+
+from ImHearing import dsp
+from ImHearing.database.models import RECORD_DURATION
+
+# Format of datetimes stored by Pony in SQLite, compared as text
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+# Rows per page of the listing views, unless requested otherwise, and the
+# largest page served
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
 
 
 @db_session
@@ -17,6 +35,33 @@ def get_recorded_entries(db):
     )
 
 
+@db_session
+def get_priority_entries(db):
+    """
+    Return all priority records (loud ones) without an archive associated.
+    :param db: db connection
+    :return: list with priority record objects not archived yet
+    """
+    return select(
+        il for il in db.Record if il.status == 'priority'
+    )
+
+
+@db_session
+def get_entries_to_archive(db):
+    """
+    Return all records to archive by the bulk lane: the recorded ones, the
+    priority ones left by the priority lane (e.g. while uploads were
+    paused) and those cut short by a stalled device, with audio.
+    :param db: db connection
+    :return: list with record objects not archived yet
+    """
+    return select(
+        il for il in db.Record if il.status in ('recorded', 'priority') or
+        (il.status == 'error' and not il.removed)
+    )
+
+
 @db_session
 def get_records_from_archive(archive, db):
     """
@@ -57,12 +102,44 @@ def get_archives_uploaded(db):
 @db_session
 def get_archives_not_uploaded(db):
     """
-    Get a list of archives NOT uploaded to the Object Store
+    Get a list of archives NOT uploaded to the Object Store, still on the
+    disk (streamed uploads left open are not, see get_stream_uploads_open)
     :param db: db connection
     :return: list of all archives NOT uploaded
     """
     return select(
-        il for il in db.Archive if il.uploaded is False
+        il for il in db.Archive if il.uploaded is False and
+        il.removed is False
+    )
+
+
+@db_session
+def get_archives_due(db, now):
+    """
+    Get a list of archives NOT uploaded whose next upload attempt is due,
+    archives never attempted included.
+    :param db: db connection
+    :param now: datetime compared to the next attempt of each archive
+    :return: list of archives NOT uploaded and due
+    """
+    return select(
+        il for il in db.Archive if il.uploaded is False and
+        il.removed is False and
+        (il.next_attempt is None or il.next_attempt <= now)
+    )
+
+
+@db_session
+def get_stream_uploads_open(db):
+    """
+    Get a list of archives whose streamed upload was left open, by a crash
+    or an abort that failed: NOT uploaded and without a local file.
+    :param db: db connection
+    :return: list of archives with a streamed upload open
+    """
+    return select(
+        il for il in db.Archive if il.uploaded is False and
+        il.removed is True
     )
 
 
@@ -90,13 +167,127 @@ def get_local_record_files(db):
     )
 
 
+@db_session
+def get_counters(db):
+    """
+    Reads the counters kept up to date by triggers (see
+    models.create_counters), instead of scanning the records and archives.
+    :param db: db connection
+    :return: dict with the number and size (MB) of local records, and the
+             size (MB) of the archives uploaded
+    """
+    # Pending changes are written first, so the triggers count them
+    flush()
+    local_records, local_records_mb, uploaded_mb = db.select(
+        'local_records, local_records_mb, uploaded_mb FROM "Counters" '
+        'WHERE id = 1')[0]
+    return {
+        'local_records': local_records,
+        'local_records_mb': local_records_mb,
+        'uploaded_mb': uploaded_mb
+    }
+
+
+@db_session
+def get_capture_health(db, start=None, end=None):
+    """
+    Aggregates the capture health of the records started in a time range.
+    :param db: db connection
+    :param start: datetime, records started before it are ignored
+    :param end: datetime, records started after it are ignored
+    :return: dict with the number of records, overflows, late reads and
+             read latencies (ms)
+    """
+    records = select(
+        il for il in db.Record if il.overflows is not None
+    )
+    if start is not None:
+        records = records.filter(lambda il: il.start >= start)
+    if end is not None:
+        records = records.filter(lambda il: il.start <= end)
+
+    records_count = count(records)
+    return {
+        'records': records_count,
+        'overflows': sum(il.overflows for il in records),
+        'records_with_overflows': count(
+            il for il in records if il.overflows > 0),
+        'late_reads': sum(il.late_reads for il in records),
+        'read_latency_avg': sum(
+            il.read_latency_avg for il in records) / records_count
+        if records_count else 0.0,
+        'read_latency_max': max(il.read_latency_max for il in records) or 0.0
+    }
+
+
+@db_session
+def get_loud_spans(db, threshold, start=None, end=None, level='peak'):
+    """
+    Finds the time spans louder than a threshold, using the loudness envelope
+    stored with each record, so no audio file is read.
+    :param db: db connection
+    :param threshold: Level in dBFS
+    :param start: datetime, spans before it are ignored
+    :param end: datetime, spans after it are ignored
+    :param level: Envelope column compared to the threshold, 'peak' or 'rms'
+    :return: List of dicts with Record (id), Start, End and Level (the
+             loudest second of the span), sorted by Start
+    """
+    column = 0 if level == 'rms' else 1
+    records = select(
+        il for il in db.Record if il.loudness is not None
+    )
+    if start is not None:
+        records = records.filter(lambda il: il.end >= start)
+    if end is not None:
+        records = records.filter(lambda il: il.start <= end)
+
+    spans = list()
+    for rec in records:
+        levels = dsp.unpack_envelope(rec.loudness)[:, column]
+        loud = np.concatenate([[False], levels >= threshold, [False]])
+        edges = np.flatnonzero(np.diff(loud.astype(np.int8)))
+        for first, last in zip(edges[::2], edges[1::2]):
+            span_start = rec.start + timedelta(seconds=int(first))
+            span_end = rec.start + timedelta(seconds=int(last))
+            if rec.end is not None and span_end > rec.end:
+                span_end = rec.end
+            if (start is not None and span_end < start) or \
+                    (end is not None and span_start > end):
+                continue
+            spans.append({
+                'Record': str(rec.id),
+                'Start': span_start,
+                'End': span_end,
+                'Level': float(levels[first:last].max())
+            })
+    return sorted(spans, key=lambda span: span['Start'])
+
+
+@lru_cache(maxsize=1024)
+def parse_query_date(date_text, timez):
+    """
+    Parses a date of a query to the format stored, in the given timezone.
+    Parsing is slow and the web UI sends the same dates over and over, so
+    results are cached per date and timezone.
+    :param date_text: Format YYYY-MM-DD HH:MM, where HH:MM is optional
+    :param timez: Timezone of the date
+    :return: Date as text in DATETIME_FORMAT
+    """
+    return parse(date_text, timezone=timez).datetime(
+        to_timezone=timez, naive=True).strftime(DATETIME_FORMAT)
+
+
 # Views used by Flask / API
 @db_session
 def get_record_by_date(db, start_datetime=None,
                        end_datetime=None, timez='America/Sao_Paulo'):
     """
     This routine returns all records or archives that has records performed in
-    a time range.
+    a time range: records started in the range, or running when it starts.
+    It is a single query on the start index, with the archives joined. A
+    record running at the start of the range started at most the longest
+    record duration before it, which bounds the index range.
     :param start_datetime: Format YYYY-MM-DD HH:MM, where HH:MM is optional
     :param end_datetime: Format YYYY-MM-DD HH:MM, where HH:MM is optional
     :param timez: The timezone used to the query. Default is SAO_PAULO, Brazil
@@ -108,70 +299,167 @@ def get_record_by_date(db, start_datetime=None,
     if start_datetime is None and end_datetime is None:
         return ret_dict
 
-    td_query_start = parse(start_datetime, timezone=timez).datetime(
-        to_timezone=timez, naive=False) if start_datetime is not None \
-        else start_datetime
-    td_query_end = parse(end_datetime, timezone=timez).datetime(
-        to_timezone=timez, naive=False) if end_datetime is not None \
-        else end_datetime
-
-    if td_query_start and td_query_end is None:
-        records_list = select(
-            il for il in db.Record if il.start >= td_query_start
-        )
-    elif td_query_end and td_query_start is None:
-        records_list = select(
-            il for il in db.Record if il.start <= td_query_end
-        )
+    query_start = parse_query_date(start_datetime, timez) \
+        if start_datetime is not None else None
+    query_end = parse_query_date(end_datetime, timez) \
+        if end_datetime is not None else None
+
+    if query_end is None:
+        where = 'r."start" >= $query_start'
+    elif query_start is None:
+        where = 'r."start" <= $query_end'
     else:
-        records_list = select(
-            il for il in db.Record if
-            (il.start >= td_query_start and il.start <= td_query_end) or
-            (il.end >= td_query_start and il.start <= td_query_start)
-        )
+        longest = db.select(
+            'MAX({}) FROM "Record"'.format(RECORD_DURATION))[0] or 0
+        # One second of margin for the precision of julianday
+        query_lower = (datetime.strptime(query_start, DATETIME_FORMAT) -
+                       timedelta(days=longest, seconds=1)).strftime(
+            DATETIME_FORMAT)
+        where = 'r."start" >= $query_lower AND r."start" <= $query_end ' \
+            'AND (r."start" >= $query_start OR r."end" >= $query_start)'
 
-    if len(records_list) == 0:
-        return ret_dict
+    rows = db.select(
+        'r."id", r."start", r."end", r."path", r."status", a."uploaded", '
+        'a."remote_path", a."local_path" '
+        'FROM "Record" r LEFT JOIN "Archive" a ON a."id" = r."archive" '
+        'WHERE ' + where + ' ORDER BY r."start"')
 
-    for rec in records_list:
-        if rec.status == 'archived':
-            ret_dict[str(rec.id)] = {
-                'Archive': rec.archive.remote_path if rec.archive.uploaded
-                else rec.archive.local_path,
-                'Start': str(rec.start),
-                'End': str(rec.end)
-            }
+    for rec_id, start, end, rec_path, status, uploaded, remote_path, \
+            local_path in rows:
+        rec_times = {
+            'Start': str(datetime.fromisoformat(start)),
+            'End': str(datetime.fromisoformat(end) if end else None)
+        }
+        if status == 'archived':
+            rec_times['Archive'] = remote_path if uploaded else local_path
         else:
-            ret_dict[str(rec.id)] = {
-                'Path': rec.path,
-                'Start': str(rec.start),
-                'End': str(rec.end)
-            }
+            rec_times['Path'] = rec_path
+        ret_dict[str(UUID(bytes=rec_id))] = rec_times
     return ret_dict
 
 
+def encode_cursor(key, row_id):
+    """
+    Opaque cursor pointing after a row, to be passed in URLs.
+    :param key: Sort key of the row, as stored (text), None if it is NULL
+    :param row_id: Row id (UUID bytes)
+    :return: URL safe cursor
+    """
+    return urlsafe_b64encode('{}|{}'.format(
+        key if key is not None else '', row_id.hex()).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """
+    Reverse of encode_cursor.
+    :param cursor: Cursor from encode_cursor
+    :return: Tuple (key, UUID bytes), the key is None if it was NULL
+    :raises ValueError: if the cursor is not valid
+    """
+    try:
+        key, row_id = urlsafe_b64decode(cursor.encode()).decode().split('|')
+        row_id = bytes.fromhex(row_id)
+    except (UnicodeError, binascii.Error) as e:
+        raise ValueError('Invalid cursor {}'.format(cursor)) from e
+    if len(row_id) != 16:
+        raise ValueError('Invalid cursor {}'.format(cursor))
+    return key or None, row_id
+
+
+def get_page_limit(limit):
+    """
+    Page size requested, bounded to MAX_PAGE_SIZE.
+    :param limit: Requested size (text or int), None for PAGE_SIZE
+    :return: Page size
+    :raises ValueError: if the size is not a number
+    """
+    if limit is None or limit == '':
+        return PAGE_SIZE
+    return min(MAX_PAGE_SIZE, max(1, int(limit)))
+
+
+def format_datetime(value):
+    """
+    Formats a datetime stored by Pony (text) as str(datetime) does.
+    :param value: Stored datetime, or None
+    :return: Formatted datetime, None if value is None
+    """
+    return str(datetime.fromisoformat(value)) if value else None
+
+
 @db_session
-def get_all_records(db):
+def get_all_records(db, after=None, limit=PAGE_SIZE):
     """
-    List all records, no filters applied
+    List a page of records, no filters applied, in (start, id) order. Pages
+    are read by keyset: the page starts after the last row of the previous
+    one (the cursor), so any page is an index range, unlike an OFFSET.
     :param db: DB Connection
-    :return: List of all records
+    :param after: Cursor returned with the previous page, None for the first
+    :param limit: Page size
+    :return: Tuple (list of dicts with ID, Status, Start, End, Size and
+             Archive (id or None), cursor of the next page or None if this
+             is the last one)
     """
-    return list(select(
-        records for records in db.Record
-    ))
+    where = ''
+    if after is not None:
+        after_start, after_id = decode_cursor(after)
+        where = 'WHERE (r."start", r."id") > ($after_start, $after_id) '
+    fetch = limit + 1
+    rows = db.select(
+        'r."id", r."status", r."start", r."end", r."size", r."archive" '
+        'FROM "Record" r ' + where +
+        'ORDER BY r."start", r."id" LIMIT $fetch')
+
+    records = [{
+        'ID': str(UUID(bytes=rec_id)),
+        'Status': status,
+        'Start': format_datetime(start),
+        'End': format_datetime(end),
+        'Size': size,
+        'Archive': str(UUID(bytes=archive_id)) if archive_id else None
+    } for rec_id, status, start, end, size, archive_id in rows[:limit]]
+    next_cursor = encode_cursor(rows[limit - 1][2], rows[limit - 1][0]) \
+        if len(rows) > limit else None
+    return records, next_cursor
 
 
 @db_session
-def get_all_archives(db):
+def get_all_archives(db, after=None, limit=PAGE_SIZE):
     """
-    List all archives, no filters applied
+    List a page of archives, no filters applied, in (creation, id) order,
+    read by keyset as get_all_records. Archives without a creation date come
+    first.
     :param db: DB Connection
-    :return: List of all archives
+    :param after: Cursor returned with the previous page, None for the first
+    :param limit: Page size
+    :return: Tuple (list of dicts with ID, Created, LocalPath and
+             RemotePath, cursor of the next page or None if this is the last
+             one)
     """
-    return list(select(
-        archives for archives in db.Archive
-    ))
+    where = ''
+    if after is not None:
+        after_creation, after_id = decode_cursor(after)
+        if after_creation is None:
+            where = 'WHERE (a."creation" IS NULL AND a."id" > $after_id) ' \
+                'OR a."creation" IS NOT NULL '
+        else:
+            where = 'WHERE (a."creation", a."id") > ' \
+                '($after_creation, $after_id) '
+    fetch = limit + 1
+    rows = db.select(
+        'a."id", a."creation", a."local_path", a."remote_path" '
+        'FROM "Archive" a ' + where +
+        'ORDER BY a."creation", a."id" LIMIT $fetch')
+
+    archives = [{
+        'ID': str(UUID(bytes=archive_id)),
+        'Created': format_datetime(creation),
+        'LocalPath': local_path,
+        'RemotePath': remote_path
+    } for archive_id, creation, local_path, remote_path in rows[:limit]]
+    next_cursor = encode_cursor(rows[limit - 1][1], rows[limit - 1][0]) \
+        if len(rows) > limit else None
+    return archives, next_cursor
 
 
 @db_session
@@ -0,0 +1,287 @@
+""" Signal processing routines applied to the captured audio
+"""
+
+import numpy as np
+
+# Level reported for digital silence, instead of -inf
+MIN_DBFS = -120.0
+
+# numpy types of little-endian PCM samples, by sample width in bytes
+PCM_DTYPES = {
+    1: np.uint8,
+    2: np.dtype('<i2'),
+    4: np.dtype('<i4')
+}
+
+
+def to_float(data, sample_width):
+    """
+    Converts interleaved PCM bytes to float samples in the range [-1, 1).
+    :param data: PCM bytes
+    :param sample_width: Bytes per sample (1, 2 or 4)
+    :return: numpy float32 array
+    """
+    if sample_width not in PCM_DTYPES:
+        raise ValueError('Unsupported sample width {}'.format(sample_width))
+
+    samples = np.frombuffer(data, dtype=PCM_DTYPES[sample_width])
+    if sample_width == 1:
+        # 8 bits PCM is unsigned
+        return (samples.astype(np.float32) - 128) / 128
+    return samples.astype(np.float32) / float(2 ** (8 * sample_width - 1))
+
+
+def rms_dbfs(samples):
+    """
+    RMS level of a block of samples, in dB relative to full scale.
+    :param samples: float samples in the range [-1, 1)
+    :return: Level in dBFS (MIN_DBFS for silence or an empty block)
+    """
+    if len(samples) == 0:
+        return MIN_DBFS
+    rms = np.sqrt(np.mean(np.square(samples, dtype=np.float64)))
+    return max(MIN_DBFS, 20 * np.log10(rms)) if rms > 0 else MIN_DBFS
+
+
+def from_float(samples, sample_width):
+    """
+    Converts float samples in the range [-1, 1) to PCM bytes, clipping
+    values out of range.
+    :param samples: float samples (interleaved if multichannel)
+    :param sample_width: Bytes per sample (1, 2 or 4)
+    :return: PCM bytes
+    """
+    if sample_width not in PCM_DTYPES:
+        raise ValueError('Unsupported sample width {}'.format(sample_width))
+
+    full_scale = float(2 ** (8 * sample_width - 1))
+    scaled = np.clip(np.rint(np.asarray(samples, dtype=np.float64) *
+                             full_scale), -full_scale, full_scale - 1)
+    if sample_width == 1:
+        scaled += 128
+    return scaled.astype(PCM_DTYPES[sample_width]).tobytes()
+
+
+class Resampler:
+    """
+    Streaming rational resampler (polyphase FIR). The anti-alias lowpass is
+    a Kaiser windowed sinc with its cutoff under the lowest Nyquist
+    frequency. Output frame n is the signal at time n / rate_out, for frame
+    indexes counted from the same origin as the input frames, so the
+    resampled stream stays aligned with the captured one.
+    """
+
+    def __init__(self, rate_in, rate_out, channels, position=0,
+                 zero_crossings=16, rolloff=0.9, beta=8.6):
+        divisor = np.gcd(rate_in, rate_out)
+        self.up = rate_out // divisor
+        self.down = rate_in // divisor
+        self.channels = channels
+
+        factor = max(self.up, self.down)
+        cutoff = rolloff * 0.5 / factor
+        self._half = int(np.ceil(zero_crossings * factor / rolloff))
+        length = 2 * self._half + 1
+        self._taps = -(-length // self.up)
+
+        t = np.arange(length) - self._half
+        prototype = 2 * cutoff * np.sinc(2 * cutoff * t) * \
+            np.kaiser(length, beta)
+        prototype *= self.up / prototype.sum()
+        prototype = np.concatenate(
+            [prototype, np.zeros(self._taps * self.up - length)])
+        # phases[p, k] weights input sample (base - k) for phase p
+        self._phases = prototype.reshape(self._taps, self.up).T.copy()
+
+        # First output at or after the first input, inputs before the
+        # position are taken as zeros
+        self.next_output = -(-position * self.up // self.down)
+        self._buffer = np.zeros((self._taps, channels))
+        self._buffer_start = position - self._taps
+        self._end = position
+
+    def process(self, samples):
+        """
+        Resamples the next block of the stream.
+        :param samples: float array with shape (frames, channels)
+        :return: float array with shape (frames, channels). Outputs are
+                 delayed until the input they depend on is available
+        """
+        self._buffer = np.concatenate([self._buffer, samples])
+        self._end += len(samples)
+
+        # Outputs whose newest input sample is already buffered
+        last = (self._end * self.up - self._half - 1) // self.down
+        outputs = np.arange(self.next_output, last + 1)
+        if len(outputs) == 0:
+            return np.zeros((0, self.channels))
+
+        combined = outputs * self.down + self._half
+        base = combined // self.up
+        phase = combined - base * self.up
+        index = base[:, None] - np.arange(self._taps)[None, :] - \
+            self._buffer_start
+        result = np.einsum('nk,nkc->nc', self._phases[phase],
+                           self._buffer[index])
+
+        self.next_output = last + 1
+        oldest = (self.next_output * self.down + self._half) // self.up - \
+            self._taps + 1
+        discard = max(0, oldest - self._buffer_start)
+        self._buffer = self._buffer[discard:]
+        self._buffer_start += discard
+        return result
+
+    def flush(self):
+        """
+        Ends the stream, returning the outputs up to the last input, which
+        were waiting for more input.
+        :return: float array with shape (frames, channels)
+        """
+        last = ((self._end - 1) * self.up) // self.down
+        pending = max(0, last + 1 - self.next_output)
+        if pending == 0:
+            return np.zeros((0, self.channels))
+        end = self._end
+        result = self.process(np.zeros((self._taps, self.channels)))
+        self._end = end
+        return result[:pending]
+
+
+class FormatConverter:
+    """
+    Converts a stream of PCM to another rate, number of channels and sample
+    width. Channels are downmixed by averaging (or duplicated, when going
+    from mono to more channels). next_output is the index of the next frame
+    returned, on the same time origin as the input frames.
+    """
+
+    def __init__(self, rate_in, channels_in, width_in, rate_out, channels_out,
+                 width_out, position=0):
+        self.rate_in = rate_in
+        self.channels_in = channels_in
+        self.width_in = width_in
+        self.rate_out = rate_out
+        self.channels_out = channels_out
+        self.width_out = width_out
+        self.next_output = position
+        self.resampler = None
+        if rate_in != rate_out:
+            self.resampler = Resampler(rate_in, rate_out, channels_out,
+                                       position)
+            self.next_output = self.resampler.next_output
+
+    def _mix(self, frames):
+        if self.channels_out == self.channels_in:
+            return frames
+        if self.channels_out == 1:
+            return frames.mean(axis=1, keepdims=True)
+        if self.channels_in == 1:
+            return np.repeat(frames, self.channels_out, axis=1)
+        raise ValueError('Cannot mix {} channels into {}'.format(
+            self.channels_in, self.channels_out))
+
+    def process(self, data):
+        """
+        Converts the next block of the stream.
+        :param data: PCM bytes in the input format
+        :return: PCM bytes in the output format
+        """
+        frames = to_float(data, self.width_in).reshape(-1, self.channels_in)
+        frames = self._mix(frames)
+        if self.resampler is not None:
+            frames = self.resampler.process(frames)
+        self.next_output += len(frames)
+        return from_float(frames.ravel(), self.width_out)
+
+    def flush(self):
+        """
+        Ends the stream, returning the audio held by the resampler.
+        :return: PCM bytes in the output format
+        """
+        if self.resampler is None:
+            return b''
+        frames = self.resampler.flush()
+        self.next_output += len(frames)
+        return from_float(frames.ravel(), self.width_out)
+
+
+class LoudnessEnvelope:
+    """
+    Per-window (one second by default) RMS and peak levels of a stream,
+    computed while it is recorded. The envelope is packed as int8 pairs
+    (RMS dBFS, peak dBFS) per window, so a record of 30 seconds takes 60
+    bytes.
+    """
+
+    def __init__(self, rate, channels, sample_width, window=1.0):
+        self.sample_width = sample_width
+        self._window = int(rate * window) * channels
+        self._levels = []
+        self._sum_squares = 0.0
+        self._peak = 0.0
+        self._filled = 0
+
+    @staticmethod
+    def _level(sum_squares, peak, samples):
+        rms = np.sqrt(sum_squares / samples)
+        return (max(MIN_DBFS, 20 * np.log10(rms)) if rms > 0 else MIN_DBFS,
+                max(MIN_DBFS, 20 * np.log10(peak)) if peak > 0 else MIN_DBFS)
+
+    def add(self, data):
+        """
+        Adds the next block of the stream.
+        :param data: PCM bytes
+        """
+        samples = np.abs(to_float(data, self.sample_width)).astype(np.float64)
+
+        # Completes the current window
+        head = samples[:self._window - self._filled]
+        self._sum_squares += np.dot(head, head)
+        self._peak = max(self._peak, head.max(initial=0.0))
+        self._filled += len(head)
+        if self._filled < self._window:
+            return
+        self._levels.append(
+            self._level(self._sum_squares, self._peak, self._window))
+
+        # Whole windows at once, the remainder starts a new window
+        samples = samples[len(head):]
+        whole = len(samples) // self._window * self._window
+        windows = samples[:whole].reshape(-1, self._window)
+        for sum_squares, peak in zip(np.einsum('ij,ij->i', windows, windows),
+                                     windows.max(axis=1, initial=0.0)):
+            self._levels.append(self._level(sum_squares, peak, self._window))
+        tail = samples[whole:]
+        self._sum_squares = np.dot(tail, tail)
+        self._peak = tail.max(initial=0.0)
+        self._filled = len(tail)
+
+    def levels(self):
+        """
+        Levels of every window, including the last partial one.
+        :return: float array with shape (windows, 2): RMS and peak in dBFS
+        """
+        levels = list(self._levels)
+        if self._filled:
+            levels.append(
+                self._level(self._sum_squares, self._peak, self._filled))
+        return np.array(levels, dtype=np.float64).reshape(-1, 2)
+
+    def pack(self):
+        """
+        Envelope packed to be stored.
+        :return: bytes with an int8 pair (RMS, peak) per window
+        """
+        return np.clip(np.rint(self.levels()), -128, 0).astype(
+            np.int8).tobytes()
+
+
+def unpack_envelope(data):
+    """
+    Unpacks an envelope created by LoudnessEnvelope.pack.
+    :param data: Packed envelope
+    :return: float array with shape (windows, 2): RMS and peak in dBFS
+    """
+    return np.frombuffer(data, dtype=np.int8).reshape(-1, 2).astype(
+        np.float64)
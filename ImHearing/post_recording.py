@@ -1,17 +1,98 @@
 """ Routines to run after a record (or a set of records) is already in place
 """
 
+import hashlib
+import logging
+import multiprocessing
+import struct
+import threading
 import zipfile
-from datetime import datetime
+import zlib
+from collections import deque
+from contextlib import nullcontext
+from concurrent.futures import (ProcessPoolExecutor, ThreadPoolExecutor,
+                                as_completed)
+from base64 import b64encode
+from datetime import datetime, timedelta
+from io import BytesIO
 from os import path, remove, stat
 from uuid import uuid4
 
-from boto3 import resource
-from botocore.exceptions import ConnectionError, EndpointConnectionError
-from pony.orm import db_session
+from boto3.exceptions import S3UploadFailedError
+from botocore.exceptions import BotoCoreError, ClientError
+from pony.orm import commit, db_session
 
+from ImHearing import retry, storage, throttle
 from ImHearing.database import query
 
+# Record formats already compressed, stored as they are in archives
+COMPRESSED_EXTENSIONS = ('.flac',)
+
+# Codecs available for archive_compression (zstd needs Python 3.14+)
+COMPRESSION_CODECS = {
+    'stored': zipfile.ZIP_STORED,
+    'deflate': zipfile.ZIP_DEFLATED,
+    'bzip2': zipfile.ZIP_BZIP2,
+    'lzma': zipfile.ZIP_LZMA
+}
+if hasattr(zipfile, 'ZIP_ZSTANDARD'):
+    COMPRESSION_CODECS['zstd'] = zipfile.ZIP_ZSTANDARD
+
+# Requests (archives or parts) uploaded at the same time, unless set by
+# upload_concurrency
+UPLOAD_CONCURRENCY = 4
+
+# Size (MB) of the parts of multipart uploads, unless set by
+# upload_part_size. S3 does not accept parts under 5MB, except the last one
+PART_SIZE_MB = 8
+MIN_PART_SIZE_MB = 5
+
+# Bytes read at once from records while they are hashed and compressed
+READ_BLOCK_SIZE = 1024 * 1024
+
+# Private zipfile internals (not part of its API, they change between
+# Python versions) used to hash and compress a record in a single read, to
+# append members compressed by other processes and to read a single member.
+# Where they are missing, records are written with ZipFile.write, packed
+# serially and fetched with their whole archive
+ZIPINFO_LEVEL = hasattr(zipfile.ZipInfo, '_compresslevel')
+ZIP_DECOMPRESSOR = hasattr(zipfile, '_get_decompressor')
+ZIPFILE_WRITE_STATE = ('_lock', '_didModify', 'fp', 'start_dir', 'filelist',
+                       'NameToInfo')
+
+# Start method of the processes compressing records. They are never forked
+# from the recorder, whose capture and upload threads may hold locks that a
+# forked child would inherit locked
+POOL_START_METHOD = 'forkserver' \
+    if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+# Errors failing a single upload, which is then retried by the next call
+UPLOAD_ERRORS = (BotoCoreError, ClientError, S3UploadFailedError, OSError,
+                 storage.StorageError)
+
+# Records being archived, so the bulk and the priority lanes never archive
+# the same records. The lock is only held to select and claim them, see
+# claim_records
+records_archiving = set()
+archiving_lock = threading.Lock()
+
+# Archives being uploaded, so the bulk and the priority lanes never upload
+# the same archive at the same time
+archives_uploading = set()
+archives_uploading_lock = threading.Lock()
+
+# Bandwidth limit shared by all uploads, see get_upload_limiter
+upload_limiter = None
+upload_limiter_config = None
+
+# Circuit breaker pausing uploads while the object store is unreachable,
+# see get_circuit_breaker
+circuit_breaker = None
+circuit_breaker_config = None
+
+# Warnings of the upload routines, written to the log file by the runners
+log = logging.getLogger(__name__)
+
 
 @db_session
 def remove_uploaded_records(db):
@@ -55,6 +136,14 @@ def remove_uploaded_archives(db):
     for archive in list_of_local_archives:
         archive_path = archive.local_path
 
+        # The store checked the body against its Content-MD5 when it was
+        # received. A different ETag is expected with some server side
+        # encryptions (SSE-KMS, SSE-C), so it is only reported
+        if not is_etag_matching(archive):
+            log.warning('ETag %s of archive %s is not its MD5 %s, kept as '
+                        'uploaded (checked by Content-MD5)', archive.etag,
+                        archive.id, archive.md5)
+
         if path.isfile(archive_path):
             remove(archive_path)
             archive.removed = True
@@ -63,73 +152,1088 @@ def remove_uploaded_archives(db):
     return removed_archives_list
 
 
+def get_content_md5(md5):
+    """
+    Content-MD5 header of a request, so S3 checks the body on ingest.
+    :param md5: MD5 hex digest of the body
+    :return: Base64 digest
+    """
+    return b64encode(bytes.fromhex(md5)).decode()
+
+
+def is_etag_matching(archive):
+    """
+    Compares the ETag of an uploaded archive with its MD5, from the catalog,
+    without reading any file. The uploads themselves are verified by the
+    store, which checks each request body against its Content-MD5. This is
+    an extra check: the ETag of a single request upload is the MD5 of the
+    object, except with some server side encryptions (SSE-KMS, SSE-C), and
+    multipart ETags cannot be compared. Archives created before checksums
+    were saved cannot be compared either.
+    :param archive: Archive Object
+    :return: False if the ETag is known not to match, True otherwise
+    """
+    if not archive.md5 or not archive.etag:
+        return True
+    etag = archive.etag.strip('"')
+    return '-' in etag or etag == archive.md5
+
+
+class HashingWriter:
+    """
+    Non-seekable file object computing the SHA-256 and MD5 of what is
+    written through it. zipfile writes to it using data descriptors, as it
+    cannot seek back, so the digests are those of the final archive.
+    """
+
+    def __init__(self, file_obj):
+        self._file = file_obj
+        self.sha256 = hashlib.sha256()
+        self.md5 = hashlib.md5()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.md5.update(data)
+        return self._file.write(data)
+
+    def flush(self):
+        self._file.flush()
+
+
+def get_archive_compression(global_config):
+    """
+    Codec and level used to compress the records inside archives, from the
+    Global Configuration (archive_compression and archive_compression_level).
+    The 'auto' codec picks it by the record format, see
+    get_member_compression.
+    :param global_config: Global Configuration Dict
+    :return: Tuple with the zipfile compression constant (None for auto) and
+             the level (None for the codec default)
+    """
+    codec = global_config.get('archive_compression', 'auto') or 'auto'
+    if codec == 'auto':
+        compression = None
+    elif codec in COMPRESSION_CODECS:
+        compression = COMPRESSION_CODECS[codec]
+    else:
+        raise ValueError('Unknown or unavailable archive compression '
+                         '{}'.format(codec))
+
+    level = global_config.get('archive_compression_level', '')
+    if level is None or str(level).strip() == '':
+        return compression, None
+    return compression, int(level)
+
+
+def get_archive_workers(global_config):
+    """
+    Number of processes compressing the records of an archive in parallel,
+    from the Global Configuration (archive_workers).
+    :param global_config: Global Configuration Dict
+    :return: Number of processes, 1 to pack serially
+    """
+    return max(1, int(global_config.get('archive_workers', 1) or 1))
+
+
+def get_compress_pool(workers):
+    """
+    Process pool compressing records for pack_records, created once per
+    archive_records or stream_archive call and shared by its shards.
+    :param workers: Number of compressing processes
+    :return: ProcessPoolExecutor, or an empty context (None) to pack serially
+    """
+    if workers <= 1:
+        return nullcontext()
+    return ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context(POOL_START_METHOD))
+
+
+def get_member_compression(file_path, compression=None):
+    """
+    Compression used for a record inside an archive. Unless a codec is
+    configured, it depends on the file extension: raw PCM (WAV) is deflated,
+    compressed formats (FLAC) are only stored.
+    :param file_path: Path of the record
+    :param compression: Configured zipfile compression constant, None for
+                        auto
+    :return: zipfile compression constant
+    """
+    if compression is not None:
+        return compression
+    if path.splitext(file_path)[1].lower() in COMPRESSED_EXTENSIONS:
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+
+def get_archive_mode(global_config):
+    """
+    How archives are created, from the Global Configuration (archive_mode):
+    'local' writes the zip to archive_path and uploads it afterwards,
+    'stream' builds the zip while it is uploaded, without a local copy.
+    :param global_config: Global Configuration Dict
+    :return: 'local' or 'stream'
+    """
+    archive_mode = global_config.get('archive_mode', 'local') or 'local'
+    if archive_mode not in ('local', 'stream'):
+        raise ValueError('Unknown archive mode {}'.format(archive_mode))
+    return archive_mode
+
+
+def get_archive_filename(global_config):
+    """
+    Path for a new archive, inside archive_path.
+    :param global_config: Global Configuration Dict
+    :return: Archive path
+    """
+    return global_config['archive_path'] + \
+        str(uuid4()) + '_' + \
+        str(int(datetime.now().timestamp())) + '.zip'
+
+
+def write_member(zip_archive, file_path, compress_type, compress_level):
+    """
+    Writes a record into a zip archive, computing its SHA-256 from the same
+    reads used to compress it (the record is read again without the zipfile
+    internals, see ZIPINFO_LEVEL).
+    :param zip_archive: zipfile.ZipFile opened for writing
+    :param file_path: Path of the record
+    :param compress_type: zipfile compression constant
+    :param compress_level: Compression level, None for the codec default
+    :return: SHA-256 hex digest of the record
+    """
+    sha256 = hashlib.sha256()
+    if not ZIPINFO_LEVEL:
+        zip_archive.write(file_path, compress_type=compress_type,
+                          compresslevel=compress_level)
+        with open(file_path, 'rb') as record_file:
+            for block in iter(lambda: record_file.read(READ_BLOCK_SIZE),
+                              b''):
+                sha256.update(block)
+        return sha256.hexdigest()
+
+    zinfo = zipfile.ZipInfo.from_file(file_path)
+    zinfo.compress_type = compress_type
+    zinfo._compresslevel = compress_level
+
+    with open(file_path, 'rb') as record_file, \
+            zip_archive.open(zinfo, 'w') as member:
+        for block in iter(lambda: record_file.read(READ_BLOCK_SIZE), b''):
+            sha256.update(block)
+            member.write(block)
+    return sha256.hexdigest()
+
+
+def compress_member(file_path, compress_type, compress_level):
+    """
+    Compresses a record as the single member of an in memory zip. Runs in
+    the worker processes of pack_records.
+    :param file_path: Path of the record
+    :param compress_type: zipfile compression constant
+    :param compress_level: Compression level, None for the codec default
+    :return: Tuple with the bytes of the zip and the SHA-256 of the record
+    """
+    member_buffer = BytesIO()
+    with zipfile.ZipFile(member_buffer, 'w') as member_zip:
+        sha256 = write_member(member_zip, file_path, compress_type,
+                              compress_level)
+    return member_buffer.getvalue(), sha256
+
+
+def add_compressed_member(zip_archive, member):
+    """
+    Appends the member of a zip made by compress_member to an archive open
+    for writing, copying its local header and data as they are. zipfile has
+    no public API to add compressed data, so its internals are used the way
+    ZipFile.write does.
+    :param zip_archive: zipfile.ZipFile opened for writing
+    :param member: bytes of a single member zip
+    """
+    with zipfile.ZipFile(BytesIO(member)) as member_zip:
+        zinfo = member_zip.infolist()[0]
+        member_end = member_zip.start_dir
+
+    with zip_archive._lock:
+        zinfo.header_offset = zip_archive.fp.tell()
+        zip_archive.fp.write(member[:member_end])
+        zip_archive.start_dir = zip_archive.fp.tell()
+        zip_archive.filelist.append(zinfo)
+        zip_archive.NameToInfo[zinfo.filename] = zinfo
+        zip_archive._didModify = True
+
+
+def pack_records(zip_archive, records, compression=None, compress_level=None,
+                 workers=1, pool=None):
+    """
+    Writes the files of records into a zip archive. Records whose file is
+    gone are skipped. With several workers, records are compressed in
+    parallel by a process pool, and written to the archive in order as they
+    are ready; only a few of them are held in memory at once.
+    :param zip_archive: zipfile.ZipFile opened for writing
+    :param records: Record Objects to pack
+    :param compression: zipfile compression constant, None for auto
+    :param compress_level: Compression level, None for the codec default
+    :param workers: Number of compressing processes
+    :param pool: Pool of worker processes (see get_compress_pool), by
+                 default one for this call only
+    :return: List of tuples with the Records packed and their SHA-256
+    """
+    # Check the existence of file - Necessary check for Multithreading
+    records = [record for record in records if path.isfile(record.path)]
+
+    # Parallel packing appends members through zipfile internals
+    if workers <= 1 or not all(hasattr(zip_archive, name)
+                               for name in ZIPFILE_WRITE_STATE):
+        return [(record, write_member(
+            zip_archive, record.path,
+            get_member_compression(record.path, compression),
+            compress_level)) for record in records]
+
+    if pool is None:
+        with get_compress_pool(workers) as pool:
+            return pack_records(zip_archive, records, compression,
+                                compress_level, workers, pool)
+
+    records_packed = list()
+    members = deque()
+    for index, record in enumerate(records):
+        members.append((record, pool.submit(
+            compress_member, record.path,
+            get_member_compression(record.path, compression),
+            compress_level)))
+        last = index == len(records) - 1
+
+        # Keeps the pool busy, writing the oldest members meanwhile
+        while members and (len(members) >= 2 * workers or last):
+            record_next, member = members.popleft()
+            try:
+                member_zip, sha256 = member.result()
+            except OSError:
+                continue
+            add_compressed_member(zip_archive, member_zip)
+            records_packed.append((record_next, sha256))
+    return records_packed
+
+
+def get_record_size(record):
+    """
+    Size of a record file, from the catalog or else from the file system.
+    :param record: Record Object
+    :return: Size in MB
+    """
+    if record.size is not None:
+        return record.size
+    return stat(record.path).st_size / (1024 * 1024)
+
+
+def split_records(records, max_size=0, max_records=0):
+    """
+    Splits the records to archive into shards of at most max_size MB (of
+    record files) and max_records records, keeping their order. A record
+    bigger than max_size gets a shard of its own.
+    :param records: Record Objects to archive
+    :param max_size: Size limit of a shard in MB, 0 for unlimited
+    :param max_records: Records limit of a shard, 0 for unlimited
+    :return: List of lists of Record Objects
+    """
+    shards = list()
+    shard_size = 0
+    for record in records:
+        record_size = get_record_size(record)
+        if not shards or \
+                (max_records and len(shards[-1]) >= max_records) or \
+                (max_size and shard_size + record_size > max_size and
+                 shards[-1]):
+            shards.append(list())
+            shard_size = 0
+        shards[-1].append(record)
+        shard_size += record_size
+    return shards
+
+
+def get_archive_shards(global_config, records):
+    """
+    Splits the records to archive following the Global Configuration
+    (archive_max_size in MB and archive_max_records, 0 for unlimited).
+    Records whose file is gone are left out.
+    :param global_config: Global Configuration Dict
+    :param records: Record Objects to archive
+    :return: List of lists of Record Objects
+    """
+    return split_records(
+        [record for record in records if path.isfile(record.path)],
+        float(global_config.get('archive_max_size', 0) or 0),
+        int(global_config.get('archive_max_records', 0) or 0))
+
+
+def get_member_manifest(zip_archive):
+    """
+    Location of the members written so far to an archive. A member spans
+    from its local header to the next member (or the central directory), so
+    a single range request fetches it.
+    :param zip_archive: zipfile.ZipFile opened for writing
+    :return: List of dicts with the Record fields of each member, in the
+             order they were written
+    """
+    members = zip_archive.infolist()
+    ends = [member.header_offset for member in members[1:]] + \
+        [zip_archive.start_dir]
+    return [{
+        'member_offset': member.header_offset,
+        'member_length': end - member.header_offset,
+        'member_compress_size': member.compress_size,
+        'member_crc': member.CRC,
+        'member_compress_type': member.compress_type
+    } for member, end in zip(members, ends)]
+
+
+def claim_records(db, priority=False):
+    """
+    Selects the records to archive, skipping those the other lane is
+    archiving, and claims them. They must be released (see release_records)
+    once their archive is committed.
+    :param db: DB Connection to Pony
+    :param priority: Select the priority records only, instead of the
+                     recorded ones and the priority ones left
+    :return: List of Record Objects claimed
+    """
+    with archiving_lock:
+        if priority:
+            records = query.get_priority_entries(db)
+        else:
+            records = query.get_entries_to_archive(db)
+        records_claimed = [record for record in records
+                           if record.id not in records_archiving]
+        records_archiving.update(record.id for record in records_claimed)
+    return records_claimed
+
+
+def release_records(records):
+    """
+    Releases records claimed by claim_records.
+    :param records: Record Objects claimed
+    """
+    with archiving_lock:
+        records_archiving.difference_update(record.id for record in records)
+
+
 @db_session
-def archive_records(db, global_config):
+def archive_records(db, global_config, priority=False):
     """
-    Adds record(s) to a ZIP Archive to upload to Amazon S3.
+    Adds record(s) to ZIP Archive(s) to upload to Amazon S3. A backlog is
+    split into several archives (shards) bounded by archive_max_size and
+    archive_max_records, to be uploaded independently.
     :param db: DB Connection to Pony
     :param global_config: Global Configuration Dict
-    :return: Archive Object or False on Error
+    :param priority: Archive the priority records only, instead of the
+                     recorded ones and the priority ones left
+    :return: List of Archive Objects or False on Error
     """
 
-    list_records_to_archive = query.get_recorded_entries(db)
+    # Committed before the records are released, so the other lane sees
+    # them archived. The shards share a pool of compressing processes
+    list_records_to_archive = claim_records(db, priority)
+    try:
+        if len(list_records_to_archive) == 0 or \
+                not path.isdir(global_config['archive_path']):
+            return False
 
-    if len(list_records_to_archive) == 0 or \
-            not path.isdir(global_config['archive_path']):
-        return False
+        compression, compress_level = get_archive_compression(global_config)
+        workers = get_archive_workers(global_config)
+        archives_new = list()
+        shards = get_archive_shards(global_config, list_records_to_archive)
+        with get_compress_pool(workers) as pool:
+            for shard in shards:
+                archive_file = get_archive_filename(global_config)
+
+                archive_new = db.Archive(
+                    creation=datetime.now(),
+                    local_path=archive_file
+                )
+                # Checksums are computed as the archive is written
+                with open(archive_file, 'wb') as archive_fp:
+                    hashing_writer = HashingWriter(archive_fp)
+                    with zipfile.ZipFile(hashing_writer, 'w') as zip_archive:
+                        records_packed = pack_records(
+                            zip_archive, shard, compression, compress_level,
+                            workers, pool)
+                        manifest = get_member_manifest(zip_archive)
+                for (record, sha256), member in zip(records_packed,
+                                                    manifest):
+                    record.status = 'archived'
+                    record.archive = archive_new
+                    record.set(sha256=sha256, **member)
+                archive_new.size = stat(archive_file).st_size / (1024 * 1024)
+                archive_new.sha256 = hashing_writer.sha256.hexdigest()
+                archive_new.md5 = hashing_writer.md5.hexdigest()
+                archives_new.append(archive_new)
+        commit()
+    finally:
+        release_records(list_records_to_archive)
+
+    return archives_new or False
+
+
+class MultipartUploadWriter:
+    """
+    Non-seekable file object sending what is written to it as a multipart
+    upload, a part at a time, so only one part is held in memory. zipfile
+    writes to it using data descriptors, as it cannot seek back.
+    """
+
+    def __init__(self, store, key, part_size, limiter=None):
+        self.store = store
+        self.key = key
+        self.part_size = part_size
+        self.limiter = limiter
+        self.size = 0
+        self._buffer = bytearray()
+        self._parts = list()
+        self.upload_id = store.create_multipart_upload(key)
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._buffer += data
+        self.size += len(data)
+        while len(self._buffer) >= self.part_size:
+            self._send(bytes(self._buffer[:self.part_size]))
+            del self._buffer[:self.part_size]
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def _send(self, body):
+        content_md5 = get_content_md5(hashlib.md5(body).hexdigest())
+        body = BytesIO(body)
+        if self.limiter is not None:
+            body = throttle.ThrottledReader(body, self.limiter)
+        number = len(self._parts) + 1
+        etag = self.store.upload_part(self.key, self.upload_id, number, body,
+                                      content_md5)
+        self._parts.append((number, etag))
+
+    def complete(self):
+        """
+        Sends the last part and completes the upload.
+        :return: ETag of the object
+        """
+        if self._buffer or not self._parts:
+            self._send(bytes(self._buffer))
+            self._buffer.clear()
+        return self.store.complete_multipart_upload(self.key, self.upload_id,
+                                                    self._parts)
 
-    archive_file = global_config['archive_path'] + \
-                   str(uuid4()) + '_' + \
-                   str(int(datetime.now().timestamp())) + '.zip'
+    def abort(self):
+        """
+        Aborts the upload, so the store drops the parts already sent.
+        :return: True if the upload is gone from the store
+        """
+        try:
+            self.store.abort_multipart_upload(self.key, self.upload_id)
+        except UPLOAD_ERRORS as e:
+            return is_upload_lost(e)
+        return True
+
+
+def stream_shard(db, global_config, aws_config, records, store, pool=None):
+    """
+    Builds an archive with records while it is uploaded (see
+    stream_archive).
+    :param db: DB Connection to Pony
+    :param global_config: Global Configuration Dict
+    :param aws_config: AWS Config Dict
+    :param records: Record Objects to archive
+    :param store: Storage backend (see storage.get_storage)
+    :param pool: Pool of compressing processes (see get_compress_pool)
+    :return: Archive Object (uploaded) or False on Error
+    """
+    archive_id = uuid4()
+    part_size = get_part_size(aws_config)
+    try:
+        writer = MultipartUploadWriter(
+            store, str(archive_id), part_size,
+            get_upload_limiter(aws_config))
+    except UPLOAD_ERRORS:
+        return False
 
+    # The upload id is committed before any part is sent, so an upload left
+    # open by a crash is aborted on the next start (see
+    # abort_stream_uploads). No local file, local_path only keeps the name
+    # it would have had
     archive_new = db.Archive(
+        id=archive_id,
         creation=datetime.now(),
-        local_path=archive_file
+        local_path=get_archive_filename(global_config),
+        removed=True,
+        upload_id=writer.upload_id,
+        upload_part_size=part_size
+    )
+    commit()
+
+    compression, compress_level = get_archive_compression(global_config)
+    hashing_writer = HashingWriter(writer)
+    try:
+        with zipfile.ZipFile(hashing_writer, 'w') as zip_archive:
+            records_packed = pack_records(
+                zip_archive, records, compression, compress_level,
+                get_archive_workers(global_config), pool)
+            manifest = get_member_manifest(zip_archive)
+        etag = writer.complete()
+    except UPLOAD_ERRORS:
+        if writer.abort():
+            archive_new.delete()
+            commit()
+        return False
+
+    archive_new.set(
+        size=writer.size / (1024 * 1024),
+        remote_path=store.remote_path(str(archive_id)),
+        uploaded=True,
+        upload_id='',
+        upload_part_size=None,
+        sha256=hashing_writer.sha256.hexdigest(),
+        md5=hashing_writer.md5.hexdigest(),
+        etag=etag
     )
-    with zipfile.ZipFile(archive_file, 'w') as zip_archive:
-        for record in list_records_to_archive:
-            # Check the existence of file - Necessary check for Multithreading
-            if path.isfile(record.path):
-                zip_archive.write(record.path)
-                record.status = 'archived'
-                record.archive = archive_new
-        archive_new.size = stat(archive_file).st_size / (1024 * 1024)
+    for (record, sha256), member in zip(records_packed, manifest):
+        record.status = 'archived'
+        record.archive = archive_new
+        record.set(sha256=sha256, **member)
 
     return archive_new
 
 
 @db_session
-def upload_archive(db, aws_config):
+def stream_archive(db, global_config, aws_config, priority=False,
+                   store=None):
     """
-    Routine to Upload Archive(s) to AWS S3
-    :param aws_config: AWS Config Dict
+    Streaming version of archive_records and upload_archive: the zip is
+    built on the fly and sent as a multipart upload in upload_part_size
+    parts, so it is never written to the disk. The catalog is only updated
+    once the upload is complete; on error the upload is aborted and the
+    records are left to be archived again. A backlog is split in shards as
+    by archive_records, streamed one after the other.
     :param db: DB Connection to Pony
-    :return: List of Archives Uploaded
+    :param global_config: Global Configuration Dict
+    :param aws_config: AWS Config Dict
+    :param priority: Archive the priority records only, instead of the
+                     recorded ones and the priority ones left
+    :param store: Storage backend, by default the one configured (see
+                  storage.get_storage)
+    :return: List of Archive Objects (uploaded), None if there is nothing to
+             archive or uploads are paused by the circuit breaker, False on
+             Error (shards streamed before are kept)
     """
 
-    archives_to_upload = query.get_archives_not_uploaded(db)
+    # The records are claimed while streaming, so the other lane skips them
+    # without waiting. The shards share a pool of compressing processes
+    list_records_to_archive = claim_records(db, priority)
+    try:
+        shards = get_archive_shards(global_config, list_records_to_archive)
+        if len(shards) == 0:
+            return None
 
-    if len(archives_to_upload) == 0:
-        return True
+        # Records wait on the disk while the object store is unreachable
+        breaker = get_circuit_breaker(aws_config)
+        if not breaker.allow():
+            return None
+
+        store = store or storage.get_storage(aws_config)
+        workers = get_archive_workers(global_config)
+        archives_new = list()
+        with get_compress_pool(workers) as pool:
+            for shard in shards:
+                archive_new = stream_shard(db, global_config, aws_config,
+                                           shard, store, pool)
+                if archive_new is False:
+                    breaker.record_failure()
+                    return False
+                # Committed shard by shard, before the records are released
+                commit()
+                archives_new.append(archive_new)
+        breaker.record_success()
+        return archives_new
+    finally:
+        release_records(list_records_to_archive)
+
+
+@db_session
+def abort_stream_uploads(db, aws_config, store=None):
+    """
+    Aborts the streamed uploads left open by a crash (see stream_shard), so
+    the store drops their parts instead of keeping them. Their records were
+    not archived, they are streamed again. Must run before any stream is
+    started.
+    :param db: DB Connection to Pony
+    :param aws_config: AWS Config Dict
+    :param store: Storage backend, by default the one configured (see
+                  storage.get_storage)
+    :return: Number of uploads aborted
+    """
+    archives_open = list(query.get_stream_uploads_open(db))
+    if len(archives_open) == 0:
+        return 0
 
-    s3_resource = resource('s3')
-    for archive in archives_to_upload:
-        s3_obj = s3_resource.Object(
-            bucket_name=aws_config['s3_bucket_name'],
-            key=str(archive.id)
-        )
+    store = store or storage.get_storage(aws_config)
+    aborted = 0
+    for archive in archives_open:
         try:
-            s3_obj.upload_file(
-                Filename=archive.local_path
-            )
+            store.abort_multipart_upload(str(archive.id), archive.upload_id)
+        except UPLOAD_ERRORS as e:
+            if not is_upload_lost(e):
+                log.warning('Upload of archive %s left open: %s',
+                            archive.id, e)
+                continue
+        archive.delete()
+        aborted += 1
+    commit()
+    return aborted
+
+
+def get_upload_concurrency(aws_config):
+    """
+    Number of requests (archives or parts of them) uploaded at the same
+    time, from the AWS Configuration (upload_concurrency).
+    :param aws_config: AWS Config Dict
+    :return: Number of upload threads
+    """
+    return max(1, int(aws_config.get('upload_concurrency',
+                                     UPLOAD_CONCURRENCY)))
+
+
+def get_part_size(aws_config):
+    """
+    Size of the parts of multipart uploads, from the AWS Configuration
+    (upload_part_size, in MB). Archives up to this size are uploaded in a
+    single request.
+    :param aws_config: AWS Config Dict
+    :return: Part size in bytes (at least the 5MB required by S3)
+    """
+    part_size_mb = max(MIN_PART_SIZE_MB, int(aws_config.get(
+        'upload_part_size', PART_SIZE_MB)))
+    return part_size_mb * 1024 * 1024
+
+
+def get_upload_limiter(aws_config):
+    """
+    RateLimiter shared by all uploads (both lanes and all their threads),
+    created again only when its configuration changes.
+    :param aws_config: AWS Config Dict
+    :return: RateLimiter Object
+    """
+    global upload_limiter, upload_limiter_config
+
+    limiter_config = (aws_config.get('upload_rate', ''),
+                      aws_config.get('upload_rate_windows', ''))
+    with archives_uploading_lock:
+        if upload_limiter is None or upload_limiter_config != limiter_config:
+            upload_limiter = throttle.get_rate_limiter(aws_config)
+            upload_limiter_config = limiter_config
+        return upload_limiter
+
+
+def get_circuit_breaker(aws_config):
+    """
+    CircuitBreaker shared by all uploads (both lanes), created again only
+    when its configuration changes.
+    :param aws_config: AWS Config Dict
+    :return: CircuitBreaker Object
+    """
+    global circuit_breaker, circuit_breaker_config
+
+    breaker_config = (aws_config.get('breaker_threshold', ''),
+                      aws_config.get('breaker_timeout', ''))
+    with archives_uploading_lock:
+        if circuit_breaker is None or \
+                circuit_breaker_config != breaker_config:
+            circuit_breaker = retry.get_circuit_breaker(aws_config)
+            circuit_breaker_config = breaker_config
+        return circuit_breaker
+
+
+def upload_file(store, file_path, key, limiter=None, md5=None):
+    """
+    Uploads a single archive file in a single request. It does not touch
+    the DB, so it can run in any thread.
+    :param store: Storage backend (thread safe, shared by uploads)
+    :param file_path: Local path of the archive
+    :param key: Object key
+    :param limiter: RateLimiter throttling the upload, None for unlimited
+    :param md5: MD5 hex digest of the archive, sent for the store to check
+    :return: ETag of the object, or None on Error
+    """
+    try:
+        with open(file_path, 'rb') as archive_file:
+            body = archive_file
+            if limiter is not None:
+                body = throttle.ThrottledReader(archive_file, limiter)
+            return store.put_object(key, body,
+                                    get_content_md5(md5) if md5 else None)
+    except UPLOAD_ERRORS:
+        return None
+
+
+def upload_part(store, file_path, key, upload_id, number, part_size,
+                limiter=None):
+    """
+    Uploads a part of a multipart upload, read from the archive file. It
+    does not touch the DB, so it can run in any thread.
+    :param store: Storage backend (thread safe, shared by uploads)
+    :param file_path: Local path of the archive
+    :param key: Object key
+    :param upload_id: Multipart upload id
+    :param number: Part number, starting at 1
+    :param part_size: Size of the parts in bytes
+    :param limiter: RateLimiter throttling the upload, None for unlimited
+    :return: ETag of the part, or None on Error
+    """
+    try:
+        with open(file_path, 'rb') as archive_file:
+            archive_file.seek((number - 1) * part_size)
+            body = archive_file.read(part_size)
+
+        # The part is already in memory, hashing it costs no extra read
+        content_md5 = get_content_md5(hashlib.md5(body).hexdigest())
+        body = BytesIO(body)
+        if limiter is not None:
+            # Throttled as the store reads the body while sending it
+            body = throttle.ThrottledReader(body, limiter)
+        return store.upload_part(key, upload_id, number, body, content_md5)
+    except UPLOAD_ERRORS:
+        return None
+
+
+def is_upload_lost(error):
+    """
+    Checks if an error means the multipart upload no longer exists in the
+    store (aborted or expired), so it has to start over.
+    :param error: Exception raised by the storage backend
+    :return: True if the upload is gone
+    """
+    return isinstance(error, storage.UploadLostError)
+
+
+def reset_multipart_upload(archive):
+    """
+    Forgets the multipart upload of an archive saved in the catalog.
+    :param archive: Archive Object
+    """
+    archive.upload_id = ''
+    archive.upload_part_size = None
+    for part in list(archive.upload_parts):
+        part.delete()
+
+
+def start_multipart_upload(store, archive, part_size):
+    """
+    Starts the multipart upload of an archive, or resumes the one saved in
+    the catalog. The upload id is committed right away, so the parts sent
+    before a crash are not sent again by the next call.
+    :param store: Storage backend
+    :param archive: Archive Object
+    :param part_size: Size of the parts in bytes, for new uploads
+    :return: List of part numbers still to upload, or None on Error
+    """
+    try:
+        if archive.upload_id:
+            try:
+                store.check_multipart_upload(str(archive.id),
+                                             archive.upload_id)
+            except storage.UploadLostError:
+                reset_multipart_upload(archive)
+
+        if not archive.upload_id:
+            archive.upload_id = store.create_multipart_upload(
+                str(archive.id))
+            archive.upload_part_size = part_size
+            commit()
+    except UPLOAD_ERRORS:
+        return None
+
+    parts_count = -(-stat(archive.local_path).st_size //
+                    archive.upload_part_size)
+    parts_done = set(part.number for part in archive.upload_parts)
+    return [number for number in range(1, parts_count + 1)
+            if number not in parts_done]
+
+
+def complete_multipart_upload(store, archive):
+    """
+    Completes the multipart upload of an archive, once all its parts are
+    uploaded, and removes the parts from the catalog.
+    :param store: Storage backend
+    :param archive: Archive Object
+    :return: ETag of the object, or None on Error
+    """
+    parts = sorted(archive.upload_parts, key=lambda part: part.number)
+    try:
+        etag = store.complete_multipart_upload(
+            str(archive.id), archive.upload_id,
+            [(part.number, part.etag) for part in parts])
+    except UPLOAD_ERRORS as e:
+        if is_upload_lost(e):
+            reset_multipart_upload(archive)
+        return None
+    reset_multipart_upload(archive)
+    return etag
+
+
+@db_session
+def upload_archive(db, aws_config, archive_ids=None):
+    """
+    Routine to Upload Archive(s) to the object store (storage_backend, see
+    storage.get_storage). All pending archives are uploaded in a single
+    pass, upload_concurrency requests at a time, and a failed upload does
+    not stop the others. A failed archive is retried by a
+    later call, after an exponential backoff kept in the catalog
+    (upload_attempts and next_attempt). Whole passes failing open the
+    circuit breaker (see get_circuit_breaker), which pauses all uploads for
+    breaker_timeout seconds and then lets a single archive through as a
+    probe; once it is uploaded, the whole backlog is uploaded right away,
+    ignoring the backoff of each archive. The bandwidth of all uploads is
+    limited by upload_rate (and upload_rate_windows), see get_upload_limiter.
+    :param aws_config: AWS Config Dict
+    :param db: DB Connection to Pony
+    :param archive_ids: Upload only these archives (ids), even if not due.
+                        By default, all archives not uploaded yet and due
+    :return: Dict with the result of each upload (True if uploaded) by
+             archive id, empty when there is nothing to upload or uploads
+             are paused
+    """
+
+    breaker = get_circuit_breaker(aws_config)
+    if not breaker.allow():
+        return dict()
+    probing = breaker.state == retry.HALF_OPEN
+
+    if archive_ids is not None:
+        archives_to_upload = [db.Archive[archive_id]
+                              for archive_id in archive_ids]
+    elif probing:
+        archives_to_upload = list(query.get_archives_not_uploaded(db))
+    else:
+        archives_to_upload = list(query.get_archives_due(db, datetime.now()))
+
+    upload_results = upload_archives(
+        db, aws_config,
+        archives_to_upload[:1] if probing else archives_to_upload)
+    if len(upload_results) == 0:
+        breaker.release()
+        return upload_results
+    if not any(upload_results.values()):
+        breaker.record_failure()
+        return upload_results
+
+    if breaker.record_success():
+        # Back from an outage, the backlog is drained at full speed
+        if archive_ids is None:
+            archives_to_upload = query.get_archives_not_uploaded(db)
+        backlog = [archive for archive in archives_to_upload
+                   if archive.id not in upload_results]
+        for archive in backlog:
+            archive.next_attempt = None
+        upload_results.update(upload_archives(db, aws_config, backlog))
+    return upload_results
+
+
+def upload_archives(db, aws_config, archives_to_upload):
+    """
+    Uploads a list of archives, see upload_archive. Archives bigger than
+    upload_part_size are sent as multipart uploads, whose id and finished
+    parts are kept in the catalog: an interrupted upload resumes from the
+    parts missing. Archives already being uploaded by another thread are
+    skipped.
+    :param db: DB Connection to Pony
+    :param aws_config: AWS Config Dict
+    :param archives_to_upload: List of Archive Objects
+    :return: Dict with the result of each upload (True if uploaded) by
+             archive id
+    """
+
+    with archives_uploading_lock:
+        archives_claimed = [archive for archive in archives_to_upload
+                            if archive.id not in archives_uploading]
+        archives_uploading.update(archive.id for archive in archives_claimed)
+
+    if len(archives_claimed) == 0:
+        return dict()
+
+    store = storage.get_storage(aws_config)
+    part_size = get_part_size(aws_config)
+    limiter = get_upload_limiter(aws_config)
+    backoff = retry.get_backoff(aws_config)
+    upload_results = dict()
+
+    def finish(archive, etag):
+        if etag:
             archive.uploaded = True
-            archive.remote_path = "https://%s.s3-%s.amazonaws.com/%s" % \
-                                  (aws_config['s3_bucket_name'],
-                                   aws_config['s3_region'],
-                                   str(archive.id))
-        except (ConnectionError, EndpointConnectionError) as e:
+            archive.remote_path = store.remote_path(str(archive.id))
+            archive.etag = etag
+            archive.upload_attempts = 0
+            archive.next_attempt = None
+        else:
             archive.uploaded = False
             archive.remote_path = ''
+            archive.upload_attempts = (archive.upload_attempts or 0) + 1
+            archive.next_attempt = datetime.now() + timedelta(
+                seconds=backoff.delay(archive.upload_attempts))
+        upload_results[archive.id] = archive.uploaded
+
+    try:
+        with ThreadPoolExecutor(
+                max_workers=get_upload_concurrency(aws_config)) as executor:
+            # Whole archives and parts share the pool, the value tells the
+            # archive and the part number (None for a whole archive)
+            uploads = dict()
+            parts_left = dict()
+            for archive in archives_claimed:
+                if not path.isfile(archive.local_path) or \
+                        (not archive.upload_id and
+                         stat(archive.local_path).st_size <= part_size):
+                    uploads[executor.submit(
+                        upload_file, store, archive.local_path,
+                        str(archive.id), limiter, archive.md5)] = \
+                        (archive, None)
+                    continue
+
+                parts = start_multipart_upload(store, archive, part_size)
+                if parts is None:
+                    finish(archive, None)
+                    continue
+                parts_left[archive.id] = len(parts)
+                if len(parts) == 0:
+                    finish(archive,
+                           complete_multipart_upload(store, archive))
+                for number in parts:
+                    uploads[executor.submit(
+                        upload_part, store, archive.local_path,
+                        str(archive.id), archive.upload_id, number,
+                        archive.upload_part_size, limiter)] = (archive, number)
+
+            # Pony sessions belong to a thread, so the catalog is only
+            # updated here, as uploads finish
+            parts_failed = set()
+            for upload in as_completed(uploads):
+                archive, number = uploads[upload]
+                if number is None:
+                    finish(archive, upload.result())
+                    continue
+
+                etag = upload.result()
+                if etag is None:
+                    parts_failed.add(archive.id)
+                else:
+                    # Committed one by one, so they survive a crash
+                    db.UploadPart(archive=archive, number=number, etag=etag)
+                    commit()
+                parts_left[archive.id] -= 1
+                if parts_left[archive.id] == 0:
+                    finish(archive, archive.id not in parts_failed and
+                           complete_multipart_upload(store, archive))
+    finally:
+        with archives_uploading_lock:
+            archives_uploading.difference_update(
+                archive.id for archive in archives_claimed)
+
+    return upload_results
+
+
+def upload_priority_records(db, global_config, aws_config):
+    """
+    Priority lane: archives the priority records on their own and uploads
+    them right away, without waiting for the bulk batch.
+    :param db: DB Connection to Pony
+    :param global_config: Global Configuration Dict
+    :param aws_config: AWS Config Dict
+    :return: True if there was nothing to do or the archive was uploaded,
+             False on Error or while uploads are paused (the local archive
+             or the records to stream are then uploaded by the bulk lane)
+    """
+    if get_archive_mode(global_config) == 'stream':
+        if get_circuit_breaker(aws_config).state == retry.OPEN:
             return False
+        return stream_archive(db, global_config, aws_config,
+                              priority=True) is not False
 
+    # Archived even while uploads are paused, so the bulk lane uploads the
+    # archive once they resume
+    archives = archive_records(db, global_config, priority=True)
+    if archives is False:
         return True
+    if get_circuit_breaker(aws_config).state == retry.OPEN:
+        return False
+    upload_results = upload_archive(
+        db, aws_config, archive_ids=[archive.id for archive in archives])
+    return len(upload_results) > 0 and all(upload_results.values())
+
+
+def read_member(data, compress_size, compress_type, crc):
+    """
+    Extracts a member from the bytes of its local header and data, as
+    fetched from an archive.
+    :param data: bytes from the local header of the member on
+    :param compress_size: Size of the compressed data
+    :param compress_type: zipfile compression constant
+    :param crc: CRC-32 of the uncompressed member
+    :return: bytes of the member
+    """
+    if data[:4] != b'PK\x03\x04':
+        raise zipfile.BadZipFile('Bad local header of archive member')
+    name_length, extra_length = struct.unpack('<HH', data[26:30])
+    data_start = 30 + name_length + extra_length
+    compressed = data[data_start:data_start + compress_size]
+
+    decompressor = zipfile._get_decompressor(compress_type)
+    content = compressed if decompressor is None else \
+        decompressor.decompress(compressed)
+    if zlib.crc32(content) != crc:
+        raise zipfile.BadZipFile('Bad CRC-32 of archive member')
+    return content
+
+
+@db_session
+def fetch_record(db, aws_config, record_id, store=None):
+    """
+    Gets the file of a single record. Uploaded records are fetched with a
+    range GET of their member in the archive, using the manifest saved by
+    archive_records, instead of downloading the whole archive.
+    :param db: DB Connection to Pony
+    :param aws_config: AWS Config Dict
+    :param record_id: Record id
+    :param store: Storage backend, by default the one configured (see
+                  storage.get_storage)
+    :return: bytes of the record file, None if it is not available
+    """
+    record = db.Record.get(id=record_id)
+    if record is None:
+        return None
+
+    archive = record.archive
+    if archive is None or not archive.uploaded:
+        if not record.path or not path.isfile(record.path):
+            return None
+        with open(record.path, 'rb') as record_file:
+            return record_file.read()
+
+    store = store or storage.get_storage(aws_config)
+    if record.member_offset is None or not ZIP_DECOMPRESSOR:
+        # Archived before the manifest existed (or no zipfile decompressor
+        # to read a member alone), the whole archive is needed
+        body = store.get_object(str(archive.id))
+        with zipfile.ZipFile(BytesIO(body)) as zip_archive:
+            for name in zip_archive.namelist():
+                if path.basename(name) == path.basename(record.path):
+                    return zip_archive.read(name)
+        return None
+
+    member = store.get_object(
+        str(archive.id), record.member_offset,
+        record.member_offset + record.member_length - 1)
+    return read_member(member, record.member_compress_size,
+                       record.member_compress_type, record.member_crc)
@@ -1,7 +1,7 @@
 """ Routines check if conditions are satisfied before start recording
 """
 
-from pony.orm import db_session, sum
+from pony.orm import db_session
 
 from ImHearing.database import query
 
@@ -20,9 +20,8 @@ def check_aws_budget(db, aws_config):
     if budget_max == 0:
         return float('Inf')
 
-    # Get all Archives already uploaded to AWS
-    archives_uploaded = query.get_archives_uploaded(db)
-    uploaded_gb = (sum(o.size for o in archives_uploaded) / 1024)
+    # Size of all Archives already uploaded to AWS
+    uploaded_gb = query.get_counters(db)['uploaded_mb'] / 1024
 
     current_amount = float(aws_config['price_per_gb']) * uploaded_gb
     return budget_max - current_amount
@@ -43,9 +42,8 @@ def check_fs_usage(db, global_config):
     if max_fs_usage == 0:
         return float('Inf')
 
-    # List of records in local disk
-    local_records_list = query.get_local_record_files(db)
-    local_records_mb = sum(o.size for o in local_records_list)
+    # Size of records in local disk
+    local_records_mb = query.get_counters(db)['local_records_mb']
 
     return max_fs_usage - local_records_mb
 
@@ -65,6 +63,6 @@ def check_record_count(db, global_config):
     if max_count == 0:
         return float('Inf')
 
-    records_count = len(query.get_local_record_files(db))
+    records_count = query.get_counters(db)['local_records']
 
     return max_count - records_count
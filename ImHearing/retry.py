@@ -0,0 +1,166 @@
+""" Retry scheduling for uploads: backoff between attempts and a circuit
+breaker pausing all uploads while the object store is unreachable
+"""
+
+import random
+import threading
+import time
+
+# Circuit breaker states
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class Backoff:
+    """
+    Exponential backoff with full jitter: the delay before attempt n + 1 is
+    drawn uniformly between 0 and min(cap, base * factor ** (n - 1)), so
+    clients failing together do not retry together.
+    """
+
+    def __init__(self, base=10.0, cap=900.0, factor=2.0,
+                 uniform=random.uniform):
+        self.base = float(base)
+        self.cap = float(cap)
+        self.factor = float(factor)
+        self._uniform = uniform
+
+    def ceiling(self, attempts):
+        """
+        Longest delay after a number of failed attempts.
+        :param attempts: Failed attempts so far (at least 1)
+        :return: Seconds
+        """
+        # Bounded exponent, so a long outage does not overflow the float
+        exponent = min(max(0, attempts - 1), 64)
+        return min(self.cap, self.base * self.factor ** exponent)
+
+    def delay(self, attempts):
+        """
+        Delay before the next attempt.
+        :param attempts: Failed attempts so far (at least 1)
+        :return: Seconds
+        """
+        return self._uniform(0, self.ceiling(attempts))
+
+
+class CircuitBreaker:
+    """
+    Stops calls to a service failing again and again. After threshold
+    consecutive failures the breaker opens and allow() refuses calls for
+    reset_timeout seconds. Then it is half open: a single call (the probe)
+    is allowed, closing the breaker if it succeeds or opening it again if
+    it fails.
+    """
+
+    def __init__(self, threshold=5, reset_timeout=300.0,
+                 clock=time.monotonic):
+        self.threshold = max(1, int(threshold))
+        self.reset_timeout = float(reset_timeout)
+        self.failures = 0
+        self._clock = clock
+        self._state = CLOSED
+        self._opened = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._current_state()
+
+    def _current_state(self):
+        if self._state == OPEN and \
+                self._clock() - self._opened >= self.reset_timeout:
+            self._state = HALF_OPEN
+            self._probing = False
+        return self._state
+
+    def allow(self):
+        """
+        Checks if a call can be made now. In the half open state, only the
+        first caller is allowed, until its result is recorded.
+        :return: True if the call can be made
+        """
+        with self._lock:
+            state = self._current_state()
+            if state == CLOSED:
+                return True
+            if state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def release(self):
+        """
+        Gives back the probe allowed in the half open state without a
+        result (there was nothing to call), so the next caller probes.
+        """
+        with self._lock:
+            self._probing = False
+
+    def record_success(self):
+        """
+        Records a successful call, closing the breaker.
+        :return: True if the breaker was not closed before (recovery)
+        """
+        with self._lock:
+            recovered = self._current_state() != CLOSED
+            self._state = CLOSED
+            self._probing = False
+            self.failures = 0
+            return recovered
+
+    def record_failure(self):
+        """
+        Records a failed call, opening the breaker after threshold
+        consecutive failures or when the probe fails.
+        """
+        with self._lock:
+            state = self._current_state()
+            self.failures += 1
+            self._probing = False
+            if state == HALF_OPEN or self.failures >= self.threshold:
+                self._state = OPEN
+                self._opened = self._clock()
+
+    def retry_in(self):
+        """
+        Time left until a probe is allowed.
+        :return: Seconds, 0 if calls are allowed now
+        """
+        with self._lock:
+            if self._current_state() != OPEN:
+                return 0.0
+            return max(0.0, self._opened + self.reset_timeout - self._clock())
+
+    def as_dict(self):
+        return {
+            'state': self.state,
+            'failures': self.failures,
+            'retry_in': self.retry_in()
+        }
+
+
+def get_backoff(aws_config):
+    """
+    Creates the upload Backoff from the AWS Configuration: retry_base and
+    retry_max (seconds).
+    :param aws_config: AWS Config Dict
+    :return: Backoff Object
+    """
+    return Backoff(base=float(aws_config.get('retry_base', 10) or 10),
+                   cap=float(aws_config.get('retry_max', 900) or 900))
+
+
+def get_circuit_breaker(aws_config):
+    """
+    Creates the upload CircuitBreaker from the AWS Configuration:
+    breaker_threshold (failed upload passes) and breaker_timeout (seconds).
+    :param aws_config: AWS Config Dict
+    :return: CircuitBreaker Object
+    """
+    return CircuitBreaker(
+        threshold=int(aws_config.get('breaker_threshold', 5) or 5),
+        reset_timeout=float(aws_config.get('breaker_timeout', 300) or 300))
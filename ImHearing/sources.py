@@ -0,0 +1,190 @@
+""" Audio sources used by the capture engine. Besides the real device
+(PyAudio), there are sources replaying a WAV file and generating a signal,
+used to run and benchmark the capture path without a microphone.
+"""
+
+import threading
+import time
+import wave
+
+import numpy as np
+
+
+class AudioSource:
+    """
+    Base class for audio sources. Once started, a source delivers whole
+    frames of interleaved PCM to the sink callable, sink(data), from its own
+    thread until it is stopped. An empty chunk marks the end of the stream.
+    Sources able to detect overruns report them calling
+    sink(data, overflow=True).
+    """
+
+    # Real time sources cannot wait for the reader, so the engine drops old
+    # audio instead of blocking them
+    realtime = True
+
+    def __init__(self, rate, channels, sample_width, chunk):
+        self.rate = rate
+        self.channels = channels
+        self.sample_width = sample_width
+        self.chunk = chunk
+
+    @property
+    def frame_size(self):
+        return self.channels * self.sample_width
+
+    def start(self, sink):
+        """
+        Starts delivering audio to sink.
+        :param sink: Callable receiving each chunk of audio (bytes)
+        """
+        raise NotImplementedError
+
+    def stop(self):
+        """
+        Stops delivering audio and releases the source.
+        """
+        raise NotImplementedError
+
+
+class PyAudioSource(AudioSource):
+    """
+    Captures from an input device using PyAudio in callback mode.
+    """
+
+    def __init__(self, device_index, rate, channels, sample_width, chunk):
+        super().__init__(rate, channels, sample_width, chunk)
+        self.device_index = device_index
+        self._audio = None
+        self._stream = None
+
+    def start(self, sink):
+        from pyaudio import PyAudio, paContinue, paInputOverflow
+
+        def callback(in_data, frame_count, time_info, status):
+            sink(in_data, overflow=bool(status & paInputOverflow))
+            return None, paContinue
+
+        self._audio = PyAudio()
+        self._stream = self._audio.open(
+            format=self._audio.get_format_from_width(self.sample_width),
+            rate=self.rate,
+            channels=self.channels,
+            input_device_index=self.device_index,
+            input=True,
+            frames_per_buffer=self.chunk,
+            stream_callback=callback)
+        self._stream.start_stream()
+
+    def stop(self):
+        if self._stream is not None:
+            self._stream.stop_stream()
+            self._stream.close()
+            self._stream = None
+        if self._audio is not None:
+            self._audio.terminate()
+            self._audio = None
+
+
+class ThreadedSource(AudioSource):
+    """
+    Base class for sources producing audio in a worker thread. speed sets
+    how fast audio is produced compared to real time; 0 produces as fast as
+    the reader consumes it.
+    """
+
+    def __init__(self, rate, channels, sample_width, chunk, speed=1.0):
+        super().__init__(rate, channels, sample_width, chunk)
+        self.speed = float(speed)
+        self.realtime = self.speed > 0
+        self._thread = None
+        self._stop_event = threading.Event()
+
+    def start(self, sink):
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, args=(sink,),
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self, sink):
+        produced = 0
+        time_start = time.monotonic()
+        while not self._stop_event.is_set():
+            data = self.next_chunk()
+            sink(data)
+            if not data:
+                break
+            produced += len(data) // self.frame_size
+            if self.realtime:
+                ahead = produced / (self.rate * self.speed) - \
+                    (time.monotonic() - time_start)
+                if ahead > 0:
+                    self._stop_event.wait(ahead)
+
+    def next_chunk(self):
+        """
+        Produces the next chunk of audio.
+        :return: bytes with whole frames, empty when the source is exhausted
+        """
+        raise NotImplementedError
+
+
+class WaveFileSource(ThreadedSource):
+    """
+    Replays a WAV file, optionally in a loop.
+    """
+
+    def __init__(self, file_path, chunk, speed=1.0, loop=True):
+        with wave.open(file_path, 'rb') as wave_file:
+            rate = wave_file.getframerate()
+            channels = wave_file.getnchannels()
+            sample_width = wave_file.getsampwidth()
+        super().__init__(rate, channels, sample_width, chunk, speed)
+        self.file_path = file_path
+        self.loop = loop
+        self._wave_file = None
+
+    def next_chunk(self):
+        if self._wave_file is None:
+            self._wave_file = wave.open(self.file_path, 'rb')
+        data = self._wave_file.readframes(self.chunk)
+        if not data and self.loop:
+            self._wave_file.rewind()
+            data = self._wave_file.readframes(self.chunk)
+        return data
+
+    def stop(self):
+        super().stop()
+        if self._wave_file is not None:
+            self._wave_file.close()
+            self._wave_file = None
+
+
+class SignalSource(ThreadedSource):
+    """
+    Generates 16 bits PCM made of a sine tone plus white noise.
+    """
+
+    def __init__(self, rate, channels, chunk, speed=1.0, frequency=440.0,
+                 amplitude=0.1, noise=0.01):
+        super().__init__(rate, channels, 2, chunk, speed)
+        self.frequency = frequency
+        self.amplitude = amplitude
+        self.noise = noise
+        self._phase = 0
+        self._random = np.random.default_rng()
+
+    def next_chunk(self):
+        t = (self._phase + np.arange(self.chunk)) / self.rate
+        self._phase += self.chunk
+        signal = self.amplitude * np.sin(2 * np.pi * self.frequency * t)
+        if self.noise:
+            signal = signal + self._random.normal(0, self.noise, self.chunk)
+        samples = np.clip(signal * 32767, -32768, 32767).astype('<i2')
+        return np.repeat(samples, self.channels).tobytes()
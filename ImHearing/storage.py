@@ -0,0 +1,246 @@
+""" Object stores archives are uploaded to. Backends share the subset of the
+S3 API used by post_recording, so uploads (whole or multipart), range reads
+and remote paths do not depend on the store
+"""
+
+import hashlib
+import shutil
+from base64 import b64encode
+from os import makedirs, path, remove, replace, scandir
+from uuid import uuid4
+
+from boto3 import client
+from botocore.exceptions import ClientError
+
+# Object stores available for storage_backend
+STORAGE_BACKENDS = ('s3', 'local')
+
+# Bytes copied at once by the local backend
+COPY_BLOCK_SIZE = 1024 * 1024
+
+
+class StorageError(Exception):
+    """
+    Error of a storage backend not raised by the underlying client.
+    """
+
+
+class UploadLostError(StorageError):
+    """
+    The multipart upload no longer exists in the store (aborted or
+    expired), so it has to start over.
+    """
+
+
+def get_multipart_etag(part_etags):
+    """
+    ETag of an object uploaded in parts, as computed by S3: the MD5 of the
+    MD5s of the parts, followed by the number of parts.
+    :param part_etags: ETags of the parts, in order
+    :return: Quoted ETag
+    """
+    digests = b''.join(bytes.fromhex(etag.strip('"')) for etag in part_etags)
+    return '"{}-{}"'.format(hashlib.md5(digests).hexdigest(),
+                            len(part_etags))
+
+
+class S3Storage:
+    """
+    Archives stored in an S3 bucket. The boto3 client is thread safe, so a
+    single backend is shared by all upload threads.
+    """
+
+    def __init__(self, bucket_name, region='', s3_client=None):
+        self.bucket_name = bucket_name
+        self.region = region
+        self.s3_client = s3_client or client('s3')
+
+    def remote_path(self, key):
+        return "https://%s.s3-%s.amazonaws.com/%s" % \
+            (self.bucket_name, self.region, key)
+
+    def put_object(self, key, body, md5=None):
+        """
+        Uploads an object in a single request.
+        :param key: Object key
+        :param body: File-like object with the content
+        :param md5: Content-MD5 (base64) checked by the store, if given
+        :return: ETag of the object
+        """
+        extra_args = {'ContentMD5': md5} if md5 else {}
+        return self.s3_client.put_object(Bucket=self.bucket_name, Key=key,
+                                         Body=body, **extra_args)['ETag']
+
+    def create_multipart_upload(self, key):
+        return self.s3_client.create_multipart_upload(
+            Bucket=self.bucket_name, Key=key)['UploadId']
+
+    def check_multipart_upload(self, key, upload_id):
+        """
+        Checks that a multipart upload still exists.
+        :raises UploadLostError: if it does not
+        """
+        try:
+            self.s3_client.list_parts(Bucket=self.bucket_name, Key=key,
+                                      UploadId=upload_id, MaxParts=1)
+        except ClientError as e:
+            raise self._upload_error(e)
+
+    def upload_part(self, key, upload_id, number, body, md5=None):
+        extra_args = {'ContentMD5': md5} if md5 else {}
+        return self.s3_client.upload_part(
+            Bucket=self.bucket_name, Key=key, UploadId=upload_id,
+            PartNumber=number, Body=body, **extra_args)['ETag']
+
+    def complete_multipart_upload(self, key, upload_id, parts):
+        """
+        Completes a multipart upload.
+        :param key: Object key
+        :param upload_id: Multipart upload id
+        :param parts: List of (part number, ETag), in order
+        :return: ETag of the object
+        """
+        try:
+            return self.s3_client.complete_multipart_upload(
+                Bucket=self.bucket_name, Key=key, UploadId=upload_id,
+                MultipartUpload={'Parts': [
+                    {'ETag': etag, 'PartNumber': number}
+                    for number, etag in parts]})['ETag']
+        except ClientError as e:
+            raise self._upload_error(e)
+
+    def abort_multipart_upload(self, key, upload_id):
+        try:
+            self.s3_client.abort_multipart_upload(
+                Bucket=self.bucket_name, Key=key, UploadId=upload_id)
+        except ClientError as e:
+            raise self._upload_error(e)
+
+    def get_object(self, key, start=None, end=None):
+        """
+        Reads an object, or a range of it.
+        :param key: Object key
+        :param start: First byte, None to read the whole object
+        :param end: Last byte (included)
+        :return: bytes
+        """
+        extra_args = {}
+        if start is not None:
+            extra_args['Range'] = 'bytes={}-{}'.format(start, end)
+        return self.s3_client.get_object(Bucket=self.bucket_name, Key=key,
+                                         **extra_args)['Body'].read()
+
+    @staticmethod
+    def _upload_error(error):
+        if error.response.get('Error', {}).get('Code') == 'NoSuchUpload':
+            return UploadLostError(str(error))
+        return error
+
+
+class LocalStorage:
+    """
+    Archives stored in a local directory, e.g. another disk, a network mount
+    or a temporary directory to benchmark the upload pipeline offline.
+    Objects are written to a temporary file and renamed, so a partial object
+    is never visible. Parts of multipart uploads are kept under .uploads
+    until the upload is completed. ETags and Content-MD5 checks follow S3.
+    """
+
+    def __init__(self, root):
+        self.root = path.abspath(root)
+        self._uploads = path.join(self.root, '.uploads')
+        makedirs(self._uploads, exist_ok=True)
+
+    def remote_path(self, key):
+        return 'file://' + self._object_path(key)
+
+    def _object_path(self, key):
+        return path.join(self.root, key)
+
+    def _upload_path(self, upload_id):
+        return path.join(self._uploads, upload_id)
+
+    @staticmethod
+    def _write(file_path, body, md5=None):
+        temp_path = '{}.{}.tmp'.format(file_path, uuid4().hex)
+        digest = hashlib.md5()
+        try:
+            with open(temp_path, 'wb') as out_file:
+                while True:
+                    data = body.read(COPY_BLOCK_SIZE)
+                    if not data:
+                        break
+                    digest.update(data)
+                    out_file.write(data)
+            if md5 and b64encode(digest.digest()).decode() != md5:
+                raise StorageError('BadDigest: Content-MD5 does not match')
+            replace(temp_path, file_path)
+        finally:
+            if path.isfile(temp_path):
+                remove(temp_path)
+        return '"{}"'.format(digest.hexdigest())
+
+    def put_object(self, key, body, md5=None):
+        return self._write(self._object_path(key), body, md5)
+
+    def create_multipart_upload(self, key):
+        upload_id = uuid4().hex
+        makedirs(self._upload_path(upload_id))
+        return upload_id
+
+    def check_multipart_upload(self, key, upload_id):
+        if not path.isdir(self._upload_path(upload_id)):
+            raise UploadLostError('NoSuchUpload: {}'.format(upload_id))
+
+    def upload_part(self, key, upload_id, number, body, md5=None):
+        self.check_multipart_upload(key, upload_id)
+        return self._write(
+            path.join(self._upload_path(upload_id), str(number)), body, md5)
+
+    def complete_multipart_upload(self, key, upload_id, parts):
+        self.check_multipart_upload(key, upload_id)
+        upload_path = self._upload_path(upload_id)
+        parts_found = set(int(entry.name) for entry in scandir(upload_path)
+                          if entry.name.isdigit())
+        if set(number for number, _ in parts) - parts_found:
+            raise StorageError('InvalidPart: {}'.format(upload_id))
+
+        object_path = self._object_path(key)
+        temp_path = '{}.{}.tmp'.format(object_path, uuid4().hex)
+        with open(temp_path, 'wb') as out_file:
+            for number, _ in parts:
+                with open(path.join(upload_path, str(number)),
+                          'rb') as part_file:
+                    shutil.copyfileobj(part_file, out_file, COPY_BLOCK_SIZE)
+        replace(temp_path, object_path)
+        shutil.rmtree(upload_path, ignore_errors=True)
+        return get_multipart_etag([etag for _, etag in parts])
+
+    def abort_multipart_upload(self, key, upload_id):
+        shutil.rmtree(self._upload_path(upload_id), ignore_errors=True)
+
+    def get_object(self, key, start=None, end=None):
+        with open(self._object_path(key), 'rb') as object_file:
+            if start is None:
+                return object_file.read()
+            object_file.seek(start)
+            return object_file.read(end - start + 1)
+
+
+def get_storage(aws_config, s3_client=None):
+    """
+    Creates the storage backend from the AWS Configuration: storage_backend
+    (s3 or local), s3_bucket_name and s3_region for S3, storage_path for a
+    local directory.
+    :param aws_config: AWS Config Dict
+    :param s3_client: boto3 S3 client for the S3 backend, by default a new
+                      one
+    :return: S3Storage or LocalStorage Object
+    """
+    backend = aws_config.get('storage_backend', 's3') or 's3'
+    if backend not in STORAGE_BACKENDS:
+        raise ValueError('Unsupported storage backend {}'.format(backend))
+    if backend == 'local':
+        return LocalStorage(aws_config['storage_path'])
+    return S3Storage(aws_config['s3_bucket_name'],
+                     aws_config.get('s3_region', ''), s3_client)
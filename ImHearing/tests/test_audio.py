@@ -0,0 +1,404 @@
+""" Test recording routines in ImHearing/audio.py using synthetic sources
+"""
+
+import threading
+import time
+import unittest
+import wave
+from os import path, remove
+from unittest.mock import patch as mock_patch
+
+from pony.orm import db_session
+
+from ImHearing import audio, dsp, sources
+from ImHearing.database.models import define_db
+from ImHearing.database.query import get_recorded_entries
+
+try:
+    import soundfile
+except ImportError:
+    soundfile = None
+
+
+class StallingSource(sources.AudioSource):
+    """
+    Source delivering some audio at once, then nothing, as a stalled device
+    whose callback stopped without ending the stream.
+    """
+
+    def __init__(self, frames):
+        super().__init__(8000, 1, 2, 512)
+        self.frames = frames
+        self.starts = 0
+
+    def start(self, sink):
+        self.starts += 1
+        if self.frames:
+            sink(sources.SignalSource(8000, 1, self.frames).next_chunk())
+
+    def stop(self):
+        pass
+
+
+class TestAudio(unittest.TestCase):
+
+    def setUp(self):
+        self.db_test = define_db(
+            provider='sqlite',
+            filename='testdb.sql',
+            create_db=True
+        )
+        self.config = {
+            'record_path': './',
+            'archive_path': './',
+            'storage_usage': '0',
+            'records_count': '0',
+            'log_file': '/var/log/ImHearing.log',
+            'record_period': '2',
+            'audio_source': 'signal',
+            'source_speed': '0'
+        }
+        self.files_to_remove = []
+
+    def tearDown(self):
+        self.db_test.drop_all_tables(with_all_data=True)
+        for file in self.files_to_remove:
+            if path.isfile(file):
+                remove(file)
+
+    def test_ring_buffer(self):
+        ring = audio.RingBuffer(10)
+        ring.write(b'abcdef')
+        self.assertEqual((b'abcd', 0), ring.read(4))
+
+        # Overflow drops the oldest bytes, but keeps the stream offsets
+        self.assertEqual(2, ring.write(b'ghijklmnop'))
+        self.assertEqual((b'ghijkl', 6), ring.read(6))
+
+        ring.close()
+        self.assertEqual((b'mnop', 12), ring.read(10))
+        self.assertEqual(b'', ring.read(10)[0])
+
+    def test_ring_buffer_wraparound(self):
+        ring = audio.RingBuffer(7)
+        stream = bytes(range(100))
+
+        # Writes and reads cross the end of the buffer at every position
+        for start in range(0, 100, 5):
+            self.assertEqual(0, ring.write(stream[start:start + 5]))
+            self.assertEqual((stream[start:start + 5], start), ring.read(5))
+        self.assertEqual(0, ring.available)
+
+        # Overflows while wrapped keep the newest bytes and their offsets
+        ring.write(stream[:5])
+        self.assertEqual(4, ring.write(stream[5:11]))
+        self.assertEqual(4, ring.dropped)
+        self.assertEqual((stream[4:11], 104), ring.read(7))
+
+    def test_ring_buffer_blocking(self):
+        ring = audio.RingBuffer(4)
+
+        # A read waits for the writer, or gives up after its timeout
+        with self.assertRaises(TimeoutError):
+            ring.read(2, timeout=0.05)
+        writer = threading.Timer(0.05, ring.write, [b'ab'])
+        writer.start()
+        self.assertEqual((b'ab', 0), ring.read(2, timeout=5))
+        writer.join()
+
+        # A blocking write waits for the reader instead of dropping bytes
+        ring.write(b'cdef')
+        writer = threading.Thread(target=ring.write, args=(b'gh', True))
+        writer.start()
+        time.sleep(0.05)
+        self.assertTrue(writer.is_alive())
+        self.assertEqual((b'cd', 2), ring.read(2))
+        writer.join(5)
+        self.assertEqual((b'efgh', 4), ring.read(4))
+        self.assertEqual(0, ring.dropped)
+
+        # Closing wakes up a blocked reader with what is left
+        ring.write(b'i')
+        threading.Timer(0.05, ring.close).start()
+        self.assertEqual((b'i', 8), ring.read(4, timeout=5))
+
+    @db_session
+    def test_start_recording_gapless(self):
+        engine = audio.get_capture_engine(self.config)
+        engine.start()
+        record_01 = audio.start_recording(self.db_test, self.config, engine)
+        record_02 = audio.start_recording(self.db_test, self.config, engine)
+        engine.stop()
+        self.files_to_remove += [record_01.path, record_02.path]
+
+        with wave.open(record_01.path, 'rb') as wave_file:
+            self.assertEqual(2 * audio.SAMPLE_RATE, wave_file.getnframes())
+            self.assertEqual(audio.SAMPLE_RATE, wave_file.getframerate())
+
+        # Records are cut from the same stream, so one ends where the next
+        # starts and the period is computed from the frame count
+        self.assertEqual(record_01.end, record_02.start)
+        self.assertEqual(2, (record_01.end - record_01.start).total_seconds())
+        self.assertEqual('recorded', record_02.status)
+
+        # The loudness envelope has a level pair per second
+        self.assertEqual(2, len(dsp.unpack_envelope(record_01.loudness)))
+
+        # A source running as fast as possible never overflows
+        self.assertEqual(0, record_02.overflows)
+        self.assertGreaterEqual(record_02.read_latency_max,
+                                record_02.read_latency_avg)
+        self.assertEqual(-(-4 * audio.SAMPLE_RATE // audio.CHUNK),
+                         engine.stats.reads)
+
+    @db_session
+    def test_start_recording_all(self):
+        self.config['device_index'] = '2, 3'
+        engines = audio.get_capture_engines(self.config)
+        self.assertEqual(['2', '3'], [engine.device for engine in engines])
+
+        for engine in engines:
+            engine.start()
+        records_01 = audio.start_recording_all(self.db_test, self.config,
+                                               engines)
+        records_02 = audio.start_recording_all(self.db_test, self.config,
+                                               engines)
+        for engine in engines:
+            engine.stop()
+        self.files_to_remove += [record.path
+                                 for record in records_01 + records_02]
+
+        # Each device has its own gapless sequence of tagged records
+        self.assertEqual(['2', '3'], [record.device for record in records_01])
+        for record_01, record_02 in zip(records_01, records_02):
+            self.assertEqual(record_01.device, record_02.device)
+            self.assertEqual(record_01.end, record_02.start)
+        self.assertEqual(4, len(get_recorded_entries(self.db_test)))
+
+    def test_capture_stats(self):
+        engine = audio.CaptureEngine(
+            sources.SignalSource(8000, 1, 8000), buffer_seconds=2)
+
+        # Device overruns and ring buffer overflows are both counted
+        engine._sink(b'\x00\x00' * 8000, overflow=True)
+        engine._sink(b'\x00\x00' * 8000)
+        engine._sink(b'\x00\x00' * 8000)
+        self.assertEqual(2, engine.stats.overflows)
+        self.assertEqual(8000, engine.stats.dropped_frames)
+
+        # The first read returns audio waiting for two seconds. Overflows
+        # before the record count in it
+        engine.read(8000)
+        record_stats = engine.roll_record_stats()
+        self.assertEqual(1, record_stats.late_reads)
+        self.assertEqual(2000.0, record_stats.as_dict()['read_latency_max'])
+        self.assertEqual(2, record_stats.overflows)
+        self.assertEqual(8000, record_stats.dropped_frames)
+
+        # Overflows between records count in the next one
+        engine._sink(b'\x00\x00' * 24000)
+        self.assertEqual(1, engine.roll_record_stats().overflows)
+        self.assertEqual(0, engine.record_stats.overflows)
+
+    @db_session
+    def test_start_recording_resampled(self):
+        self.config['sample_rate'] = '16000'
+        engine = audio.get_capture_engine(self.config)
+        engine.start()
+        record_01 = audio.start_recording(self.db_test, self.config, engine)
+        record_02 = audio.start_recording(self.db_test, self.config, engine)
+        engine.stop()
+        self.files_to_remove += [record_01.path, record_02.path]
+
+        with wave.open(record_01.path, 'rb') as wave_file:
+            self.assertEqual(2 * 16000, wave_file.getnframes())
+            self.assertEqual(16000, wave_file.getframerate())
+            self.assertEqual(2, wave_file.getsampwidth())
+
+        self.assertEqual(record_01.end, record_02.start)
+        self.assertEqual(2, (record_01.end - record_01.start).total_seconds())
+
+    @db_session
+    def test_start_recording_from_file(self):
+        source_file = './source_signal.wav'
+        self.files_to_remove.append(source_file)
+        signal = sources.SignalSource(8000, 1, 8000)
+        with wave.open(source_file, 'wb') as wave_file:
+            wave_file.setnchannels(1)
+            wave_file.setsampwidth(2)
+            wave_file.setframerate(8000)
+            wave_file.writeframes(signal.next_chunk())
+
+        self.config['audio_source'] = 'file'
+        self.config['source_file'] = source_file
+
+        # Without an engine, a temporary one is used for a single record
+        record = audio.start_recording(self.db_test, self.config)
+        self.files_to_remove.append(record.path)
+
+        # The one second file is replayed in a loop to fill the period
+        with wave.open(record.path, 'rb') as wave_file:
+            self.assertEqual(2 * 8000, wave_file.getnframes())
+
+    @unittest.skipUnless(soundfile, 'soundfile is not installed')
+    @db_session
+    def test_start_recording_flac(self):
+        self.config['record_format'] = 'flac'
+        record = audio.start_recording(self.db_test, self.config)
+        self.files_to_remove.append(record.path)
+
+        self.assertTrue(record.path.endswith('.flac'))
+        info = soundfile.info(record.path)
+        self.assertEqual('FLAC', info.format)
+        self.assertEqual(2 * audio.SAMPLE_RATE, info.frames)
+
+        self.config['record_format'] = 'mp3'
+        with self.assertRaises(ValueError):
+            audio.start_recording(self.db_test, self.config)
+
+    @db_session
+    def test_start_recording_silence(self):
+        self.config['silence_threshold'] = '-50'
+        quiet_source = sources.SignalSource(8000, 1, 512, speed=0,
+                                            amplitude=0, noise=0.0001)
+        engine = audio.CaptureEngine(quiet_source)
+        engine.start()
+
+        # A silent record has no file, only a marker
+        record = audio.start_recording(self.db_test, self.config, engine)
+        self.assertEqual('silent', record.status)
+        self.assertEqual('', record.path)
+        self.assertTrue(record.removed)
+        self.assertEqual(2, (record.end - record.start).total_seconds())
+
+        self.config['silence_mode'] = 'drop'
+        self.assertIsNone(
+            audio.start_recording(self.db_test, self.config, engine)
+        )
+        engine.stop()
+
+    @db_session
+    def test_start_recording_leading_silence(self):
+        source_file = './source_signal.wav'
+        self.files_to_remove.append(source_file)
+        silence = sources.SignalSource(8000, 1, 8000, amplitude=0, noise=0)
+        tone = sources.SignalSource(8000, 1, 8000, noise=0)
+        with wave.open(source_file, 'wb') as wave_file:
+            wave_file.setnchannels(1)
+            wave_file.setsampwidth(2)
+            wave_file.setframerate(8000)
+            wave_file.writeframes(silence.next_chunk())
+            wave_file.writeframes(tone.next_chunk())
+
+        self.config['silence_threshold'] = '-50'
+        engine = audio.CaptureEngine(
+            sources.WaveFileSource(source_file, 400, speed=0, loop=False))
+        engine.start()
+        record = audio.start_recording(self.db_test, self.config, engine)
+        engine.stop()
+        self.files_to_remove.append(record.path)
+
+        # Only the tone and half a second of pre-roll are stored
+        self.assertEqual('recorded', record.status)
+        self.assertEqual(1.5, (record.end - record.start).total_seconds())
+        with wave.open(record.path, 'rb') as wave_file:
+            self.assertEqual(12000, wave_file.getnframes())
+
+    @db_session
+    def test_start_recording_priority(self):
+        # The signal source peaks around -20dBFS
+        self.config['priority_threshold'] = '-30'
+        record = audio.start_recording(self.db_test, self.config)
+        self.files_to_remove.append(record.path)
+        self.assertEqual('priority', record.status)
+
+        self.config['priority_threshold'] = '-3'
+        record = audio.start_recording(self.db_test, self.config)
+        self.files_to_remove.append(record.path)
+        self.assertEqual('recorded', record.status)
+
+    @mock_patch.object(audio, 'READ_TIMEOUT_MIN_SECONDS', 0.1)
+    def test_frame_time_after_gap(self):
+        engine = audio.CaptureEngine(StallingSource(0))
+        chunk = sources.SignalSource(8000, 1, 512).next_chunk()
+        engine._sink(chunk)
+        time.sleep(0.3)
+        engine._sink(chunk)
+
+        # Frames of a span are timed by their count, the audio resumed
+        # after the gap is timed from the wall clock again
+        self.assertGreaterEqual(
+            (engine.frame_time(512) - engine.frame_time(0)).total_seconds(),
+            0.3)
+        self.assertEqual(
+            0.032, (engine.frame_time(768) - engine.frame_time(512))
+            .total_seconds())
+        self.assertEqual(
+            0.032, (engine.frame_time(256) - engine.frame_time(0))
+            .total_seconds())
+
+    @mock_patch.object(audio, 'READ_TIMEOUT_MIN_SECONDS', 0.1)
+    @db_session
+    def test_start_recording_stalled(self):
+        # The device stops after 16 chunks of a two seconds record
+        engine = audio.CaptureEngine(StallingSource(16 * 512))
+        engine.start()
+        started = time.monotonic()
+        record = audio.start_recording(self.db_test, self.config, engine)
+        self.files_to_remove.append(record.path)
+
+        # The record ends after the timeout, with the audio captured
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertEqual('error', record.status)
+        self.assertEqual(1.024,
+                         (record.end - record.start).total_seconds())
+        with wave.open(record.path, 'rb') as wave_file:
+            self.assertEqual(16 * 512, wave_file.getnframes())
+
+        # Without any audio, only a marker of the stall is stored
+        engine = audio.CaptureEngine(StallingSource(0))
+        engine.start()
+        record = audio.start_recording(self.db_test, self.config, engine)
+        self.assertEqual('error', record.status)
+        self.assertEqual('', record.path)
+        self.assertTrue(record.removed)
+
+    @mock_patch.object(audio, 'READ_TIMEOUT_MIN_SECONDS', 0.1)
+    @mock_patch.object(audio, 'STALL_BACKOFF_MAX_SECONDS', 0.2)
+    @db_session
+    def test_start_recording_stalled_again(self):
+        source = StallingSource(0)
+        engine = audio.CaptureEngine(source)
+        engine.start()
+        marker = audio.start_recording(self.db_test, self.config, engine)
+        marker_end = marker.end
+
+        # While the device stays silent, it is reopened, waited for longer
+        # each time, and the same marker is extended
+        started = time.monotonic()
+        for _ in range(2):
+            self.assertEqual(marker, audio.start_recording(
+                self.db_test, self.config, engine))
+        self.assertGreaterEqual(time.monotonic() - started, 0.4)
+        self.assertEqual(3, source.starts)
+        self.assertEqual(3, engine.stalls)
+        self.assertGreater(marker.end, marker_end)
+        self.assertEqual(1, self.db_test.Record.select().count())
+
+        # Once it delivers audio again, the record is timed from then
+        source.frames = 512
+        record = audio.start_recording(self.db_test, self.config, engine)
+        self.files_to_remove.append(record.path)
+        self.assertNotEqual(marker, record)
+        self.assertGreater(record.start, marker.start)
+        self.assertGreater(record.end, marker.end)
+        self.assertEqual(0.064, (record.end - record.start).total_seconds())
+        self.assertIsNone(engine.stall_marker)
+
+    @db_session
+    def test_start_recording_errors(self):
+        self.config['record_path'] = './not_a_dir/'
+        self.assertEqual(
+            -1,
+            audio.start_recording(self.db_test, self.config)
+        )
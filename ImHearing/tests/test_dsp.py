@@ -0,0 +1,93 @@
+""" Test signal processing routines in ImHearing/dsp.py
+"""
+
+import unittest
+
+import numpy as np
+
+from ImHearing import dsp
+
+
+class TestDsp(unittest.TestCase):
+
+    def setUp(self):
+        self.rate_in = 44100
+        self.rate_out = 16000
+        self.time_in = np.arange(2 * self.rate_in) / self.rate_in
+        self.time_out = np.arange(2 * self.rate_out) / self.rate_out
+
+    def __resample_in_chunks(self, signal, chunk=512):
+        resampler = dsp.Resampler(self.rate_in, self.rate_out, 1)
+        blocks = [resampler.process(signal[i:i + chunk, None])
+                  for i in range(0, len(signal), chunk)]
+        blocks.append(resampler.flush())
+        return np.concatenate(blocks)[:, 0]
+
+    def test_pcm_conversion(self):
+        samples = np.array([-1, -0.5, 0, 0.5])
+        for width in [1, 2, 4]:
+            data = dsp.from_float(samples, width)
+            self.assertEqual(len(samples) * width, len(data))
+            np.testing.assert_allclose(dsp.to_float(data, width), samples,
+                                       atol=1 / 128)
+
+        # Values out of range are clipped
+        self.assertEqual(b'\xff\x7f', dsp.from_float([2.0], 2))
+        with self.assertRaises(ValueError):
+            dsp.to_float(b'\x00\x00\x00', 3)
+
+    def test_rms_dbfs(self):
+        full_scale_sine = np.sin(2 * np.pi * 440 * self.time_in)
+        self.assertAlmostEqual(-3.01, dsp.rms_dbfs(full_scale_sine), 2)
+        self.assertEqual(dsp.MIN_DBFS, dsp.rms_dbfs(np.zeros(512)))
+        self.assertEqual(dsp.MIN_DBFS, dsp.rms_dbfs(np.zeros(0)))
+
+    def test_resampler_keeps_speech_band(self):
+        tone = np.sin(2 * np.pi * 1000 * self.time_in)
+        output = self.__resample_in_chunks(tone)
+
+        # Same duration, aligned to the same time origin
+        self.assertEqual(len(self.time_out), len(output))
+        expected = np.sin(2 * np.pi * 1000 * self.time_out)
+        np.testing.assert_allclose(output[500:-500], expected[500:-500],
+                                   atol=1e-3)
+
+    def test_resampler_rejects_aliases(self):
+        # 10kHz is above the output Nyquist frequency, it must be filtered
+        # out instead of folding back to 6kHz
+        tone = np.sin(2 * np.pi * 10000 * self.time_in)
+        output = self.__resample_in_chunks(tone)
+        self.assertLess(dsp.rms_dbfs(output[500:-500]), -80)
+
+    def test_format_converter(self):
+        # Stereo 44.1kHz with the tone in a single channel
+        tone = 0.5 * np.sin(2 * np.pi * 440 * self.time_in)
+        stereo = np.stack([tone, np.zeros(len(tone))], axis=1)
+        converter = dsp.FormatConverter(self.rate_in, 2, 2,
+                                        self.rate_out, 1, 2)
+        data = converter.process(dsp.from_float(stereo.ravel(), 2))
+        data += converter.flush()
+
+        self.assertEqual(2 * self.rate_out * 2, len(data))
+        self.assertEqual(2 * self.rate_out, converter.next_output)
+        output = dsp.to_float(data, 2)
+        self.assertAlmostEqual(20 * np.log10(0.25 / np.sqrt(2)),
+                               dsp.rms_dbfs(output[500:-500]), 1)
+
+    def test_loudness_envelope(self):
+        # A second of a -6dBFS peak tone, a second of silence and a half
+        tone = 0.5 * np.sin(2 * np.pi * 441 * self.time_in[:self.rate_in])
+        signal = np.concatenate([tone, np.zeros(self.rate_in + 22050)])
+        data = dsp.from_float(signal, 2)
+
+        # Blocks not aligned to the windows give the same envelope
+        envelope = dsp.LoudnessEnvelope(self.rate_in, 1, 2)
+        for i in range(0, len(data), 3000):
+            envelope.add(data[i:i + 3000])
+        levels = dsp.unpack_envelope(envelope.pack())
+
+        self.assertEqual((3, 2), levels.shape)
+        self.assertEqual([-9, -6], list(levels[0]))
+        self.assertEqual([-120, -120], list(levels[2]))
+        self.assertTrue(np.allclose(envelope.levels()[:, 1],
+                                    [-6.02, -120, -120], atol=0.01))
@@ -2,18 +2,25 @@
 """
 
 import datetime
+import hashlib
+import tempfile
 import unittest
+import zipfile
 from enum import Enum
-from os import path, remove
+from io import BytesIO
+from os import path, remove, urandom
+from unittest.mock import patch as mock_patch
 
 from moto import mock_s3
 import boto3
+from botocore.config import Config
 from pony.orm import db_session
 
-from ImHearing import post_recording
+from ImHearing import post_recording, retry, storage
 from ImHearing.database.models import define_db
-from ImHearing.database.query import (get_recorded_entries,
-                                      get_archives_uploaded)
+from ImHearing.database.query import (get_archives_not_uploaded,
+                                      get_archives_uploaded,
+                                      get_recorded_entries)
 
 
 class RecordStatus(Enum):
@@ -40,6 +47,9 @@ class TestQueries(unittest.TestCase):
         self.time_to_add = datetime.timedelta(minutes=15)
         self.record_size_mb = 25.19535
 
+        # Uploads of each test start with a closed circuit breaker
+        post_recording.circuit_breaker = None
+
     def tearDown(self):
         self.db_test.drop_all_tables(with_all_data=True)
 
@@ -179,14 +189,15 @@ class TestQueries(unittest.TestCase):
         )
 
         # Now we add the records to an Archive - No records can be shown
-        archive = post_recording.archive_records(self.db_test,
-                                                 config_01['GLOBAL'])
+        archives = post_recording.archive_records(self.db_test,
+                                                  config_01['GLOBAL'])
         local_records = get_recorded_entries(self.db_test)
         self.assertEqual(
             len(local_records),
             0
         )
-        remove(archive.local_path)
+        self.assertEqual(1, len(archives))
+        remove(archives[0].local_path)
 
         # Removes all .wav
         for file in ['./record_without_arch_01.wav',
@@ -194,6 +205,212 @@ class TestQueries(unittest.TestCase):
                      './record_without_arch_03.wav']:
             remove(file)
 
+    @db_session
+    def test_archive_records_shards(self):
+        config_01 = {
+            'GLOBAL': {
+                'archive_path': './',
+                'archive_max_records': '2'
+            }
+        }
+        self.__creates_records_without_archives()
+
+        # Three records, at most two by archive
+        archives = post_recording.archive_records(self.db_test,
+                                                  config_01['GLOBAL'])
+        self.assertEqual([2, 1], [len(archive.records)
+                                  for archive in archives])
+        for archive in archives:
+            for record in archive.records:
+                self.assertEqual(archive, record.archive)
+            remove(archive.local_path)
+        for file in ['./record_without_arch_01.wav',
+                     './record_without_arch_02.wav',
+                     './record_without_arch_03.wav']:
+            remove(file)
+
+    @db_session
+    def test_archive_records_claimed(self):
+        config_01 = {
+            'GLOBAL': {
+                'archive_path': './'
+            }
+        }
+        self.__creates_records_without_archives()
+        records = list(get_recorded_entries(self.db_test))
+        claimed = records[0]
+
+        # Records are packed without holding the lock, so the other lane
+        # can claim its own records meanwhile
+        pack_records = post_recording.pack_records
+
+        def unlocked_pack_records(*args, **kwargs):
+            self.assertFalse(post_recording.archiving_lock.locked())
+            return pack_records(*args, **kwargs)
+
+        # A record claimed by the other lane is left to it
+        post_recording.records_archiving.add(claimed.id)
+        try:
+            with mock_patch.object(post_recording, 'pack_records',
+                                   unlocked_pack_records):
+                archives = post_recording.archive_records(
+                    self.db_test, config_01['GLOBAL'])
+        finally:
+            post_recording.release_records([claimed])
+        self.assertEqual(1, len(archives))
+        self.assertEqual(2, len(archives[0].records))
+        self.assertNotIn(claimed, archives[0].records)
+        self.assertEqual('recorded', claimed.status)
+        self.assertEqual(set(), post_recording.records_archiving)
+
+        remove(archives[0].local_path)
+        for record in records:
+            remove(record.path)
+
+    @db_session
+    def test_archive_checksums(self):
+        config_01 = {
+            'GLOBAL': {
+                'archive_path': './',
+                'archive_workers': '2'
+            }
+        }
+        self.__creates_records_without_archives()
+        for record in get_recorded_entries(self.db_test):
+            with open(record.path, 'wb') as record_file:
+                record_file.write(urandom(4096))
+
+        archive = post_recording.archive_records(self.db_test,
+                                                 config_01['GLOBAL'])[0]
+
+        # Digests computed while archiving match the files
+        for record in archive.records:
+            with open(record.path, 'rb') as record_file:
+                self.assertEqual(
+                    hashlib.sha256(record_file.read()).hexdigest(),
+                    record.sha256)
+            remove(record.path)
+        with open(archive.local_path, 'rb') as archive_file:
+            content = archive_file.read()
+        remove(archive.local_path)
+        self.assertEqual(hashlib.sha256(content).hexdigest(), archive.sha256)
+        self.assertEqual(hashlib.md5(content).hexdigest(), archive.md5)
+
+        # The ETag is compared with the MD5 saved, without reading files
+        archive.etag = '"{}"'.format(archive.md5)
+        self.assertTrue(post_recording.is_etag_matching(archive))
+        archive.etag = '"{}-3"'.format(archive.md5)
+        self.assertTrue(post_recording.is_etag_matching(archive))
+        archive.etag = '"0123"'
+        self.assertFalse(post_recording.is_etag_matching(archive))
+
+    def test_split_records(self):
+        class FakeRecord:
+            def __init__(self, size):
+                self.size = size
+
+        records = [FakeRecord(size) for size in [10, 20, 50, 5, 5, 5]]
+
+        self.assertEqual([6], [len(shard) for shard in
+                               post_recording.split_records(records)])
+        # A record bigger than the limit gets its own shard
+        self.assertEqual(
+            [[10, 20], [50], [5, 5, 5]],
+            [[record.size for record in shard] for shard in
+             post_recording.split_records(records, max_size=40)])
+        self.assertEqual(
+            [[10, 20], [50], [5, 5], [5]],
+            [[record.size for record in shard] for shard in
+             post_recording.split_records(records, max_size=40,
+                                          max_records=2)])
+
+    def test_get_member_compression(self):
+        self.assertEqual(
+            zipfile.ZIP_DEFLATED,
+            post_recording.get_member_compression('./record_01.wav')
+        )
+        self.assertEqual(
+            zipfile.ZIP_STORED,
+            post_recording.get_member_compression('./record_01.FLAC')
+        )
+
+    def test_get_archive_compression(self):
+        self.assertEqual(
+            (None, None),
+            post_recording.get_archive_compression({})
+        )
+        self.assertEqual(
+            (zipfile.ZIP_BZIP2, 9),
+            post_recording.get_archive_compression({
+                'archive_compression': 'bzip2',
+                'archive_compression_level': '9'})
+        )
+        with self.assertRaises(ValueError):
+            post_recording.get_archive_compression(
+                {'archive_compression': 'rar'})
+
+    @db_session
+    def test_pack_records(self):
+        self.__creates_records_without_archives()
+        records = list(get_recorded_entries(self.db_test))
+        for record in records:
+            with open(record.path, 'wb') as record_file:
+                record_file.write(urandom(1024) * 64)
+        remove('./record_without_arch_03.wav')
+
+        # Serial into a file, parallel into a non-seekable stream
+        serial_zip = BytesIO()
+        with zipfile.ZipFile(serial_zip, 'w') as zip_archive:
+            serial = post_recording.pack_records(
+                zip_archive, records, zipfile.ZIP_LZMA)
+
+        class NonSeekable:
+            def __init__(self):
+                self.buffer = BytesIO()
+
+            def write(self, data):
+                return self.buffer.write(data)
+
+            def flush(self):
+                pass
+
+        # Workers are never forked from the (multithreaded) recorder
+        self.assertNotEqual('fork', post_recording.POOL_START_METHOD)
+        parallel_zip = NonSeekable()
+        with zipfile.ZipFile(parallel_zip, 'w') as zip_archive, \
+                post_recording.get_compress_pool(2) as pool:
+            parallel = post_recording.pack_records(
+                zip_archive, records, zipfile.ZIP_LZMA, workers=2, pool=pool)
+
+        # Without the zipfile internals, the public API packs serially
+        fallback_zip = BytesIO()
+        with zipfile.ZipFile(fallback_zip, 'w') as zip_archive, \
+                mock_patch.object(post_recording, 'ZIPINFO_LEVEL', False), \
+                mock_patch.object(post_recording, 'ZIPFILE_WRITE_STATE',
+                                  ('_missing',)):
+            fallback = post_recording.pack_records(
+                zip_archive, records, zipfile.ZIP_LZMA, workers=2)
+        for file in ['./record_without_arch_01.wav',
+                     './record_without_arch_02.wav']:
+            remove(file)
+
+        # The record without file is skipped by all
+        self.assertEqual(2, len(serial))
+        self.assertEqual(serial, parallel)
+        self.assertEqual(serial, fallback)
+        with zipfile.ZipFile(fallback_zip) as fallback_file:
+            self.assertIsNone(fallback_file.testzip())
+            self.assertEqual(zipfile.ZIP_LZMA,
+                             fallback_file.infolist()[0].compress_type)
+        with zipfile.ZipFile(serial_zip) as serial_file, \
+                zipfile.ZipFile(parallel_zip.buffer) as parallel_file:
+            self.assertIsNone(parallel_file.testzip())
+            self.assertEqual(serial_file.namelist(),
+                             parallel_file.namelist())
+            for info in parallel_file.infolist():
+                self.assertEqual(zipfile.ZIP_LZMA, info.compress_type)
+                self.assertLess(info.compress_size, info.file_size)
+
     @db_session
     def test_remove_uploaded_archives(self):
 
@@ -212,7 +429,10 @@ class TestQueries(unittest.TestCase):
             size=self.record_size_mb * 3,
             remote_path='http://somes3path/',
             uploaded=True,
-            removed=False
+            removed=False,
+            # ETag of a bucket encrypted with SSE-KMS, not the MD5
+            md5='d41d8cd98f00b204e9800998ecf8427e',
+            etag='"9b2cf535f27731c974343645a3985328"'
         )
         f = open('archive_03.zip', 'w+')
         f.close()
@@ -221,7 +441,11 @@ class TestQueries(unittest.TestCase):
             path.isfile(archive_03.local_path)
         )
 
-        archive_list = post_recording.remove_uploaded_archives(self.db_test)
+        # Uploads are checked by Content-MD5, a different ETag is reported
+        with self.assertLogs('ImHearing.post_recording', 'WARNING'):
+            archive_list = post_recording.remove_uploaded_archives(
+                self.db_test)
+        self.assertTrue(archive_03.uploaded)
 
         self.assertIn(
             archive_03,
@@ -272,23 +496,545 @@ class TestQueries(unittest.TestCase):
                 's3_region': 'eu-west-1',
                 'price_per_gb': '0.0023',
                 'budget_cost': '30',
+                'upload_concurrency': '2'
             }
         }
 
-        self.assertTrue(
+        # Nothing to upload
+        self.assertEqual(
+            {},
             post_recording.upload_archive(self.db_test, config_01['AWS'])
         )
 
         self.__creates_archives()
+        archive_03 = self.db_test.Archive(
+            creation=self.initial_date + (180 * self.time_to_add),
+            local_path='./archive_03.zip',
+            uploaded=False
+        )
+        archive_04 = self.db_test.Archive(
+            creation=self.initial_date + (240 * self.time_to_add),
+            local_path='./archive_04.zip',
+            uploaded=False
+        )
+        open(archive_04.local_path, 'w+').close()
+
         s3 = boto3.resource('s3')
         s3.create_bucket(Bucket=config_01['AWS']['s3_bucket_name'])
-        self.assertTrue(
+
+        # All pending archives are uploaded in one call, and the missing
+        # archive_03 file does not stop the others
+        self.assertEqual(
+            {self.archive_02.id: True, archive_03.id: False,
+             archive_04.id: True},
             post_recording.upload_archive(self.db_test, config_01['AWS']))
         mock.stop()
         remove('./archive_02.zip')
+        remove('./archive_04.zip')
 
         # Check if the Archive entry changed correctly
         self.assertEqual(
-            2,
+            3,
+            len(get_archives_uploaded(self.db_test))
+        )
+        self.assertEqual('', archive_03.remote_path)
+
+    @db_session
+    def test_upload_archive_retry(self):
+        mock = mock_s3()
+        mock.start()
+
+        config_01 = {
+            'AWS': {
+                's3_bucket_name': 'my_bucket',
+                's3_region': 'eu-west-1',
+                'price_per_gb': '0.0023',
+                'budget_cost': '30',
+                'breaker_threshold': '2',
+                'breaker_timeout': '60'
+            }
+        }
+        s3 = boto3.resource('s3')
+        s3.create_bucket(Bucket=config_01['AWS']['s3_bucket_name'])
+        clock = [0.0]
+        post_recording.circuit_breaker = retry.CircuitBreaker(
+            threshold=2, reset_timeout=60, clock=lambda: clock[0])
+        post_recording.circuit_breaker_config = ('2', '60')
+
+        # The archive file is missing, so its upload fails
+        archive_01 = self.db_test.Archive(
+            creation=self.initial_date,
+            local_path='./archive_01.zip',
+            uploaded=False
+        )
+        self.assertEqual(
+            {archive_01.id: False},
+            post_recording.upload_archive(self.db_test, config_01['AWS']))
+        self.assertEqual(1, archive_01.upload_attempts)
+        self.assertGreater(archive_01.next_attempt, datetime.datetime.now())
+
+        # Not retried before its backoff
+        self.assertEqual(
+            {}, post_recording.upload_archive(self.db_test, config_01['AWS']))
+
+        # A second failed pass opens the breaker, pausing all uploads
+        archive_01.next_attempt = None
+        post_recording.upload_archive(self.db_test, config_01['AWS'])
+        self.assertEqual(2, archive_01.upload_attempts)
+        self.assertEqual(
+            {}, post_recording.upload_archive(
+                self.db_test, config_01['AWS'], archive_ids=[archive_01.id]))
+
+        # After the timeout, a probe is let through and, once it is
+        # uploaded, the backlog is uploaded regardless of its backoff
+        open(archive_01.local_path, 'w+').close()
+        archive_02 = self.db_test.Archive(
+            creation=self.initial_date,
+            local_path='./archive_02.zip',
+            uploaded=False,
+            upload_attempts=5,
+            next_attempt=datetime.datetime.now() + self.time_to_add
+        )
+        open(archive_02.local_path, 'w+').close()
+        clock[0] = 60.0
+        self.assertEqual(
+            {archive_01.id: True, archive_02.id: True},
+            post_recording.upload_archive(self.db_test, config_01['AWS']))
+        self.assertEqual(retry.CLOSED, post_recording.circuit_breaker.state)
+        self.assertEqual(0, archive_02.upload_attempts)
+        self.assertIsNone(archive_02.next_attempt)
+        mock.stop()
+        remove('./archive_01.zip')
+        remove('./archive_02.zip')
+
+    @db_session
+    def test_upload_archive_local_storage(self):
+        work_dir = tempfile.TemporaryDirectory()
+        config_01 = {
+            'GLOBAL': {
+                'archive_path': './'
+            },
+            'AWS': {
+                'storage_backend': 'local',
+                'storage_path': work_dir.name,
+                'upload_part_size': '5'
+            }
+        }
+
+        # The whole archive -> upload -> cleanup cycle, without S3
+        self.__creates_records_without_archives()
+        with open('./record_without_arch_01.wav', 'wb') as record_file:
+            record_file.write(urandom(6 * 1024 * 1024))
+        archive = post_recording.archive_records(self.db_test,
+                                                 config_01['GLOBAL'])[0]
+        self.assertEqual(
+            {archive.id: True},
+            post_recording.upload_archive(self.db_test, config_01['AWS']))
+        remote_file = path.join(work_dir.name, str(archive.id))
+        self.assertEqual('file://' + remote_file, archive.remote_path)
+        with open(remote_file, 'rb') as archive_file:
+            self.assertEqual(
+                archive.sha256,
+                hashlib.sha256(archive_file.read()).hexdigest())
+
+        self.assertIn(archive,
+                      post_recording.remove_uploaded_archives(self.db_test))
+        self.assertEqual(
+            3, len(post_recording.remove_uploaded_records(self.db_test)))
+        self.assertFalse(path.isfile('./record_without_arch_01.wav'))
+        work_dir.cleanup()
+
+    @db_session
+    def test_upload_archive_multipart(self):
+        mock = mock_s3()
+        mock.start()
+
+        config_01 = {
+            'AWS': {
+                's3_bucket_name': 'my_bucket',
+                's3_region': 'eu-west-1',
+                'upload_part_size': '5'
+            }
+        }
+        s3 = boto3.resource('s3')
+        s3.create_bucket(Bucket=config_01['AWS']['s3_bucket_name'])
+
+        # 11MB archive, sent in three parts
+        archive = self.db_test.Archive(
+            creation=self.initial_date,
+            local_path='./archive_multipart.zip',
+            uploaded=False
+        )
+        with open(archive.local_path, 'wb') as archive_file:
+            archive_file.write(urandom(11 * 1024 * 1024))
+
+        # The upload of part 2 fails, as if the uplink dropped
+        upload_part = post_recording.upload_part
+        parts_sent = []
+
+        def failing_part(*args):
+            parts_sent.append(args[4])
+            return None if args[4] == 2 else upload_part(*args)
+
+        with mock_patch.object(post_recording, 'upload_part', failing_part):
+            self.assertEqual(
+                {archive.id: False},
+                post_recording.upload_archive(self.db_test, config_01['AWS'])
+            )
+        self.assertEqual([1, 2, 3], sorted(parts_sent))
+        self.assertNotEqual('', archive.upload_id)
+        self.assertEqual([1, 3], sorted(
+            part.number for part in archive.upload_parts))
+
+        # The next call (forced, ignoring the backoff) resumes the upload,
+        # sending only the missing part
+        parts_sent.clear()
+        with mock_patch.object(
+                post_recording, 'upload_part',
+                lambda *args: parts_sent.append(args[4]) or
+                upload_part(*args)):
+            self.assertEqual(
+                {archive.id: True},
+                post_recording.upload_archive(self.db_test, config_01['AWS'],
+                                              archive_ids=[archive.id])
+            )
+        self.assertEqual([2], parts_sent)
+        self.assertEqual('', archive.upload_id)
+        self.assertEqual(0, len(archive.upload_parts))
+
+        bucket = s3.Bucket(config_01['AWS']['s3_bucket_name'])
+        self.assertEqual([str(archive.id)],
+                         [s3_object.key for s3_object in bucket.objects.all()])
+        mock.stop()
+        remove(archive.local_path)
+
+    @db_session
+    def test_stream_archive(self):
+        mock = mock_s3()
+        mock.start()
+
+        config_01 = {
+            'GLOBAL': {
+                'archive_path': './',
+                'archive_mode': 'stream'
+            },
+            'AWS': {
+                's3_bucket_name': 'my_bucket',
+                's3_region': 'eu-west-1',
+                'upload_part_size': '5'
+            }
+        }
+        # Checksums off, so moto keeps the parts as they were sent
+        s3_client = boto3.client('s3', config=Config(
+            request_checksum_calculation='when_required'))
+        store = storage.S3Storage(config_01['AWS']['s3_bucket_name'],
+                                  config_01['AWS']['s3_region'], s3_client)
+
+        # Nothing to stream
+        self.assertIsNone(post_recording.stream_archive(
+            self.db_test, config_01['GLOBAL'], config_01['AWS'],
+            store=store))
+
+        self.__creates_records_without_archives()
+        with open('./record_without_arch_01.wav', 'wb') as record_file:
+            record_file.write(urandom(6 * 1024 * 1024))
+
+        # Without the bucket, the upload fails and the records are kept
+        self.assertFalse(post_recording.stream_archive(
+            self.db_test, config_01['GLOBAL'], config_01['AWS'],
+            store=store))
+        self.assertEqual(3, len(get_recorded_entries(self.db_test)))
+
+        # A failed priority stream leaves its record to the bulk lane
+        priority_record = self.db_test.Record(
+            start=self.initial_date,
+            end=self.initial_date + self.time_to_add,
+            path='./priority_record.wav',
+            status='priority'
+        )
+        open(priority_record.path, 'w+').close()
+        self.assertFalse(post_recording.stream_archive(
+            self.db_test, config_01['GLOBAL'], config_01['AWS'],
+            priority=True, store=store))
+        self.assertEqual('priority', priority_record.status)
+
+        # Shards are streamed without holding the lock, and the records
+        # claimed are released once committed
+        stream_shard = post_recording.stream_shard
+
+        def unlocked_stream_shard(*args, **kwargs):
+            self.assertFalse(post_recording.archiving_lock.locked())
+            self.assertEqual(4, len(post_recording.records_archiving))
+            return stream_shard(*args, **kwargs)
+
+        s3_client.create_bucket(Bucket=config_01['AWS']['s3_bucket_name'])
+        with mock_patch.object(post_recording, 'stream_shard',
+                               unlocked_stream_shard):
+            archives = post_recording.stream_archive(
+                self.db_test, config_01['GLOBAL'], config_01['AWS'],
+                store=store)
+        self.assertEqual(1, len(archives))
+        self.assertEqual(set(), post_recording.records_archiving)
+        archive = archives[0]
+        s3_object = s3_client.get_object(
+            Bucket=config_01['AWS']['s3_bucket_name'], Key=str(archive.id))
+        mock.stop()
+        for file in ['./record_without_arch_01.wav',
+                     './record_without_arch_02.wav',
+                     './record_without_arch_03.wav',
+                     priority_record.path]:
+            remove(file)
+
+        # The archive only exists in the bucket, split in two parts
+        self.assertTrue(archive.uploaded)
+        self.assertTrue(archive.removed)
+        self.assertFalse(path.isfile(archive.local_path))
+        self.assertEqual(4, len(archive.records))
+        self.assertEqual(archive, priority_record.archive)
+        self.assertEqual(0, len(get_recorded_entries(self.db_test)))
+        self.assertEqual('2', s3_object['ETag'].strip('"').split('-')[1])
+
+        with zipfile.ZipFile(BytesIO(s3_object['Body'].read())) as zip_file:
+            self.assertIsNone(zip_file.testzip())
+            self.assertEqual(4, len(zip_file.namelist()))
+            self.assertAlmostEqual(
+                archive.size * 1024 * 1024,
+                sum(info.compress_size for info in zip_file.infolist()),
+                delta=1024)
+
+    @db_session
+    def test_abort_stream_uploads(self):
+        mock = mock_s3()
+        mock.start()
+
+        config_01 = {
+            'GLOBAL': {
+                'archive_path': './',
+                'archive_mode': 'stream'
+            },
+            'AWS': {
+                's3_bucket_name': 'my_bucket',
+                's3_region': 'eu-west-1'
+            }
+        }
+        s3_client = boto3.client('s3')
+        s3_client.create_bucket(Bucket=config_01['AWS']['s3_bucket_name'])
+        store = storage.S3Storage(config_01['AWS']['s3_bucket_name'],
+                                  config_01['AWS']['s3_region'], s3_client)
+        self.__creates_records_without_archives()
+
+        # A crash while streaming leaves the upload open, its id in the
+        # catalog and the records to archive
+        def crashing_pack_records(*args, **kwargs):
+            raise RuntimeError('crash')
+
+        with mock_patch.object(post_recording, 'pack_records',
+                               crashing_pack_records):
+            with self.assertRaises(RuntimeError):
+                post_recording.stream_archive(
+                    self.db_test, config_01['GLOBAL'], config_01['AWS'],
+                    store=store)
+        archive = self.db_test.Archive.select().first()
+        uploads = s3_client.list_multipart_uploads(
+            Bucket=config_01['AWS']['s3_bucket_name'])['Uploads']
+        self.assertEqual([archive.upload_id],
+                         [upload['UploadId'] for upload in uploads])
+        self.assertEqual(0, len(get_archives_not_uploaded(self.db_test)))
+        self.assertEqual(3, len(get_recorded_entries(self.db_test)))
+
+        # An upload the store no longer has is dropped from the catalog too
+        self.db_test.Archive(local_path='./archive_lost.zip', removed=True,
+                             upload_id='lost')
+
+        self.assertEqual(2, post_recording.abort_stream_uploads(
+            self.db_test, config_01['AWS'], store=store))
+        self.assertNotIn('Uploads', s3_client.list_multipart_uploads(
+            Bucket=config_01['AWS']['s3_bucket_name']))
+        self.assertEqual(0, self.db_test.Archive.select().count())
+        self.assertEqual(0, post_recording.abort_stream_uploads(
+            self.db_test, config_01['AWS'], store=store))
+        mock.stop()
+
+        for file in ['./record_without_arch_01.wav',
+                     './record_without_arch_02.wav',
+                     './record_without_arch_03.wav']:
+            remove(file)
+
+    @db_session
+    def test_fetch_record(self):
+        mock = mock_s3()
+        mock.start()
+
+        config_01 = {
+            'GLOBAL': {
+                'archive_path': './',
+                'archive_compression': 'bzip2'
+            },
+            'AWS': {
+                's3_bucket_name': 'my_bucket',
+                's3_region': 'eu-west-1'
+            }
+        }
+        s3_client = boto3.client('s3', config=Config(
+            request_checksum_calculation='when_required'))
+        s3_client.create_bucket(Bucket=config_01['AWS']['s3_bucket_name'])
+        store = storage.S3Storage(config_01['AWS']['s3_bucket_name'],
+                                  config_01['AWS']['s3_region'], s3_client)
+
+        self.__creates_records_without_archives()
+        contents = dict()
+        for record in get_recorded_entries(self.db_test):
+            contents[record.id] = urandom(512) * 32
+            with open(record.path, 'wb') as record_file:
+                record_file.write(contents[record.id])
+
+        # Records not uploaded yet are read from the local file
+        record = self.record_without_arch_02
+        self.assertEqual(contents[record.id], post_recording.fetch_record(
+            self.db_test, config_01['AWS'], record.id, store))
+
+        archive = post_recording.archive_records(self.db_test,
+                                                 config_01['GLOBAL'])[0]
+        with open(archive.local_path, 'rb') as archive_file:
+            s3_client.put_object(Bucket=config_01['AWS']['s3_bucket_name'],
+                                 Key=str(archive.id),
+                                 Body=archive_file.read())
+        archive.uploaded = True
+        remove(archive.local_path)
+        for record_path in ['./record_without_arch_01.wav',
+                            './record_without_arch_02.wav',
+                            './record_without_arch_03.wav']:
+            remove(record_path)
+
+        # Only the member of the record is requested
+        with mock_patch.object(s3_client, 'get_object',
+                               wraps=s3_client.get_object) as get_object:
+            self.assertEqual(contents[record.id], post_recording.fetch_record(
+                self.db_test, config_01['AWS'], record.id, store))
+        self.assertEqual(
+            'bytes={}-{}'.format(
+                record.member_offset,
+                record.member_offset + record.member_length - 1),
+            get_object.call_args[1]['Range'])
+        self.assertLess(record.member_length, archive.size * 1024 * 1024)
+
+        # Without the zipfile decompressor, the whole archive is fetched
+        with mock_patch.object(post_recording, 'ZIP_DECOMPRESSOR', False):
+            self.assertEqual(contents[record.id], post_recording.fetch_record(
+                self.db_test, config_01['AWS'], record.id, store))
+
+        # Records archived without a manifest need the whole archive
+        record.member_offset = None
+        self.assertEqual(contents[record.id], post_recording.fetch_record(
+            self.db_test, config_01['AWS'], record.id, store))
+        mock.stop()
+
+    @db_session
+    def test_upload_priority_records_paused(self):
+        work_dir = tempfile.TemporaryDirectory()
+        config_01 = {
+            'GLOBAL': {
+                'archive_path': './'
+            },
+            'AWS': {
+                'storage_backend': 'local',
+                'storage_path': work_dir.name,
+                'breaker_threshold': '1',
+                'breaker_timeout': '60'
+            }
+        }
+        clock = [0.0]
+        post_recording.circuit_breaker = retry.CircuitBreaker(
+            threshold=1, reset_timeout=60, clock=lambda: clock[0])
+        post_recording.circuit_breaker_config = ('1', '60')
+        post_recording.circuit_breaker.record_failure()
+
+        priority_record = self.db_test.Record(
+            start=self.initial_date,
+            end=self.initial_date + self.time_to_add,
+            path='./priority_record.wav',
+            status='priority'
+        )
+        open(priority_record.path, 'w+').close()
+
+        # While uploads are paused, the record is archived all the same
+        self.assertFalse(post_recording.upload_priority_records(
+            self.db_test, config_01['GLOBAL'], config_01['AWS']))
+        archive = priority_record.archive
+        self.assertEqual('archived', priority_record.status)
+        self.assertFalse(archive.uploaded)
+
+        # and its archive is uploaded by the bulk lane once they resume
+        clock[0] = 60.0
+        self.assertEqual(
+            {archive.id: True},
+            post_recording.upload_archive(self.db_test, config_01['AWS']))
+
+        # Priority records left behind are archived by the bulk lane
+        left_record = self.db_test.Record(
+            start=self.initial_date + self.time_to_add,
+            end=self.initial_date + 2 * self.time_to_add,
+            path='./priority_record.wav',
+            status='priority'
+        )
+        self.__creates_records_without_archives()
+        archives = post_recording.archive_records(self.db_test,
+                                                  config_01['GLOBAL'])
+        self.assertEqual(archives[0], left_record.archive)
+        self.assertEqual(4, len(archives[0].records))
+
+        for file in [priority_record.path, archive.local_path,
+                     archives[0].local_path,
+                     './record_without_arch_01.wav',
+                     './record_without_arch_02.wav',
+                     './record_without_arch_03.wav']:
+            remove(file)
+        work_dir.cleanup()
+
+    @db_session
+    def test_upload_priority_records(self):
+        mock = mock_s3()
+        mock.start()
+
+        config_01 = {
+            'GLOBAL': {
+                'record_path': '.',
+                'archive_path': './'
+            },
+            'AWS': {
+                's3_bucket_name': 'my_bucket',
+                's3_region': 'eu-west-1'
+            }
+        }
+        s3 = boto3.resource('s3')
+        s3.create_bucket(Bucket=config_01['AWS']['s3_bucket_name'])
+
+        # Nothing to do without priority records
+        self.assertTrue(post_recording.upload_priority_records(
+            self.db_test, config_01['GLOBAL'], config_01['AWS']))
+
+        self.__creates_records_without_archives(create_files=False)
+        priority_record = self.db_test.Record(
+            start=self.initial_date,
+            end=self.initial_date + self.time_to_add,
+            path='./priority_record.wav',
+            status='priority'
+        )
+        open(priority_record.path, 'w+').close()
+
+        self.assertTrue(post_recording.upload_priority_records(
+            self.db_test, config_01['GLOBAL'], config_01['AWS']))
+        mock.stop()
+        remove(priority_record.path)
+
+        # Only the priority record is archived and uploaded
+        self.assertTrue(priority_record.archive.uploaded)
+        remove(priority_record.archive.local_path)
+        self.assertEqual(
+            1,
             len(get_archives_uploaded(self.db_test))
         )
+        self.assertEqual(
+            3,
+            len(get_recorded_entries(self.db_test))
+        )
@@ -2,16 +2,26 @@
 """
 
 import datetime
+import sqlite3
+import tempfile
+import threading
 import unittest
+from os import path
 from enum import Enum
 
-from pony.orm import db_session
+from pony.orm import db_session, flush
 
-from ImHearing.database.models import define_db
+from ImHearing.database.models import (INDEXES, MIGRATIONS, PAGE_INDEXES,
+                                       define_db, get_schema_version,
+                                       get_sqlite_profile, migrate,
+                                       repair_counters)
 from ImHearing.database.query import (
-    get_archives_not_uploaded, get_archives_uploaded, get_local_archive_files,
-    get_local_record_files, get_record_by_date, get_recorded_entries,
-    get_records_from_archive, get_records_uploaded)
+    decode_cursor, get_all_archives, get_all_records,
+    get_archives_not_uploaded, get_archives_uploaded, get_capture_health,
+    get_counters, get_page_limit,
+    get_local_archive_files, get_local_record_files, get_loud_spans,
+    get_record_by_date, get_recorded_entries, get_records_from_archive,
+    get_records_uploaded, parse_query_date)
 
 
 class RecordStatus(Enum):
@@ -248,6 +258,16 @@ class TestQueries(unittest.TestCase):
                                   timez='America/Santiago')
         self.assertTrue(q_01.get(str(self.record_01.id)))
         self.assertTrue(q_01.get(str(self.record_02.id)))
+        self.assertEqual(
+            {'Archive': 'https://amazon.s3/archive_01',
+             'Start': '2020-01-01 10:00:00', 'End': '2020-01-01 10:15:00'},
+            q_01[str(self.record_01.id)])
+
+        # Dates are parsed once per timezone
+        hits = parse_query_date.cache_info().hits
+        get_record_by_date(self.db_test, start_date_01, end_date_01,
+                           timez='America/Santiago')
+        self.assertEqual(hits + 2, parse_query_date.cache_info().hits)
 
         # Should return Record 01 to Record 04
         q_02 = get_record_by_date(self.db_test, start_date_02, end_date_02,
@@ -320,3 +340,211 @@ class TestQueries(unittest.TestCase):
             len(q_08),
             0
         )
+
+    @db_session
+    def test_get_capture_health(self):
+        self.__populate_test_db()
+
+        # Records without health counters (older records) are ignored
+        self.assertEqual(
+            0,
+            get_capture_health(self.db_test)['records']
+        )
+
+        self.record_07.overflows = 2
+        self.record_07.late_reads = 4
+        self.record_07.read_latency_avg = 10.0
+        self.record_07.read_latency_max = 300.0
+        self.record_08.overflows = 0
+        self.record_08.late_reads = 0
+        self.record_08.read_latency_avg = 20.0
+        self.record_08.read_latency_max = 40.0
+        flush()
+
+        health = get_capture_health(self.db_test)
+        self.assertEqual(2, health['records'])
+        self.assertEqual(2, health['overflows'])
+        self.assertEqual(1, health['records_with_overflows'])
+        self.assertEqual(4, health['late_reads'])
+        self.assertEqual(15.0, health['read_latency_avg'])
+        self.assertEqual(300.0, health['read_latency_max'])
+
+        health = get_capture_health(
+            self.db_test, start=self.record_08.start)
+        self.assertEqual(1, health['records'])
+        self.assertEqual(0, health['overflows'])
+
+    @db_session
+    def test_get_loud_spans(self):
+        self.__populate_test_db()
+
+        # (RMS, peak) per second: loud on seconds 2-3 and on the last one
+        self.record_07.loudness = bytes(bytearray(
+            level & 0xff for level in
+            [-60, -50, -60, -50, -20, -6, -25, -10, -60, -50, -30, -12]))
+        flush()
+
+        spans = get_loud_spans(self.db_test, -15)
+        self.assertEqual(2, len(spans))
+        self.assertEqual(str(self.record_07.id), spans[0]['Record'])
+        self.assertEqual(
+            self.record_07.start + datetime.timedelta(seconds=2),
+            spans[0]['Start'])
+        self.assertEqual(
+            self.record_07.start + datetime.timedelta(seconds=4),
+            spans[0]['End'])
+        self.assertEqual(-6.0, spans[0]['Level'])
+
+        self.assertEqual(1, len(get_loud_spans(self.db_test, -22,
+                                               level='rms')))
+        self.assertEqual([], get_loud_spans(
+            self.db_test, -15,
+            start=self.record_07.start + datetime.timedelta(seconds=7)))
+        self.assertEqual([], get_loud_spans(self.db_test, -5))
+
+    @db_session
+    def __scan_counters(self):
+        local_records = get_local_record_files(self.db_test)
+        return {
+            'local_records': len(local_records),
+            'local_records_mb': sum(o.size or 0 for o in local_records),
+            'uploaded_mb': sum(
+                o.size or 0 for o in get_archives_uploaded(self.db_test))
+        }
+
+    def __assert_counters(self):
+        counters = get_counters(self.db_test)
+        for name, value in self.__scan_counters().items():
+            self.assertAlmostEqual(value, counters[name], places=6)
+
+    @db_session
+    def test_get_counters(self):
+        self.assertEqual(
+            {'local_records': 0, 'local_records_mb': 0, 'uploaded_mb': 0},
+            get_counters(self.db_test))
+
+        # Kept up to date as entities are created, changed and deleted
+        self.__populate_test_db()
+        self.__assert_counters()
+        self.record_04.removed = True
+        self.archive_02.uploaded = True
+        self.archive_02.size = 1.5
+        self.__assert_counters()
+        self.record_05.size = None
+        self.record_06.delete()
+        self.archive_01.delete()
+        self.__assert_counters()
+
+        # Changes made without the triggers are fixed by a repair
+        flush()
+        self.db_test.execute('DROP TRIGGER "counters_record_update"')
+        self.record_07.removed = True
+        flush()
+        self.assertNotEqual(self.__scan_counters()['local_records'],
+                            get_counters(self.db_test)['local_records'])
+        repair_counters(self.db_test)
+        self.__assert_counters()
+
+    def test_get_all_records(self):
+        with db_session:
+            self.__populate_test_db()
+            # Same start as record_01, ordered by id
+            self.db_test.Record(start=self.initial_date, status='recorded')
+
+        pages = list()
+        cursor = None
+        while True:
+            records, cursor = get_all_records(self.db_test, cursor, 4)
+            pages.append(records)
+            if cursor is None:
+                break
+
+        # Each record once, in (start, id) order
+        self.assertEqual([4, 4, 2], [len(page) for page in pages])
+        records = [record for page in pages for record in page]
+        self.assertEqual(10, len(set(record['ID'] for record in records)))
+        self.assertEqual(
+            sorted((record['Start'], record['ID']) for record in records),
+            [(record['Start'], record['ID']) for record in records])
+        self.assertEqual(str(self.initial_date + 7 * self.time_to_add),
+                         records[-2]['Start'])
+        self.assertEqual(str(self.archive_02.id), records[5]['Archive'])
+        self.assertIsNone(records[-1]['Archive'])
+
+        # Archives without a creation date come first
+        with db_session:
+            self.db_test.Archive(local_path='/data/archive_03.zip')
+        archives, cursor = get_all_archives(self.db_test, limit=1)
+        self.assertIsNone(archives[0]['Created'])
+        archives, cursor = get_all_archives(self.db_test, cursor, 5)
+        self.assertEqual(['/data/archive_01.zip', '/data/archive_02.zip'],
+                         [archive['LocalPath'] for archive in archives])
+        self.assertIsNone(cursor)
+
+        self.assertEqual(1000, get_page_limit('100000'))
+        self.assertEqual(100, get_page_limit(None))
+        with self.assertRaises(ValueError):
+            decode_cursor('not-a-cursor')
+        with self.assertRaises(ValueError):
+            get_page_limit('ten')
+
+    def test_sqlite_profile(self):
+        profile = get_sqlite_profile({
+            'db_path': 'testdb.sql', 'journal_mode': 'WAL',
+            'synchronous': 'Normal', 'busy_timeout': '2000',
+            'cache_size': '-4000', 'mmap_size': ''})
+        self.assertEqual([('busy_timeout', 2000), ('journal_mode', 'wal'),
+                          ('synchronous', 'normal'), ('cache_size', -4000)],
+                         profile)
+        with self.assertRaises(ValueError):
+            get_sqlite_profile({'synchronous': 'fast'})
+
+        with tempfile.TemporaryDirectory() as db_dir:
+            profile_db = define_db(profile=profile, provider='sqlite',
+                                   filename=path.join(db_dir, 'wal.sql'),
+                                   create_db=True)
+
+            # Applied to the connection of each thread
+            settings = list()
+
+            def read_settings():
+                with db_session:
+                    settings.append([
+                        profile_db.execute('PRAGMA {}'.format(name))
+                        .fetchone()[0] for name, _ in profile])
+            read_settings()
+            thread = threading.Thread(target=read_settings)
+            thread.start()
+            thread.join()
+            self.assertEqual([[2000, 'wal', 1, -4000]] * 2, settings)
+            profile_db.disconnect()
+
+    def test_add_missing_columns(self):
+        with tempfile.TemporaryDirectory() as db_dir:
+            db_file = path.join(db_dir, 'old.sql')
+
+            # Record table as created by the first release
+            connection = sqlite3.connect(db_file)
+            connection.execute(
+                'CREATE TABLE "Record" ("id" UUID NOT NULL PRIMARY KEY, '
+                '"start" DATETIME NOT NULL, "end" DATETIME, "size" REAL, '
+                '"path" TEXT, "status" TEXT, "removed" BOOLEAN NOT NULL, '
+                '"archive" UUID)')
+            connection.commit()
+            connection.close()
+
+            old_db = define_db(provider='sqlite', filename=db_file)
+            with db_session:
+                record = old_db.Record(start=self.initial_date, overflows=1)
+            with db_session:
+                self.assertEqual(1, old_db.Record[record.id].overflows)
+
+            # Migrated to the last version, indexes included, only once
+            self.assertEqual(MIGRATIONS[-1][0], get_schema_version(old_db))
+            with db_session:
+                indexes = old_db.select(
+                    "name FROM sqlite_master WHERE type = 'index'")
+            for name, _, _ in INDEXES + PAGE_INDEXES:
+                self.assertIn(name, indexes)
+            self.assertEqual([], migrate(old_db))
+            old_db.disconnect()
@@ -0,0 +1,61 @@
+""" Test the upload retry scheduling in ImHearing/retry.py
+"""
+
+import unittest
+
+from ImHearing import retry
+
+
+class TestRetry(unittest.TestCase):
+
+    def setUp(self):
+        self.time = 0.0
+
+    def __clock(self):
+        return self.time
+
+    def test_backoff(self):
+        backoff = retry.Backoff(base=10, cap=100,
+                                uniform=lambda low, high: high)
+        self.assertEqual([10, 20, 40, 80, 100],
+                         [backoff.delay(attempts) for attempts in range(1, 6)])
+
+        # A long outage stays at the cap
+        self.assertEqual(100, backoff.delay(10000))
+
+        # Delays are drawn between 0 and the ceiling
+        backoff = retry.Backoff(base=10, cap=100)
+        for _ in range(100):
+            self.assertTrue(0 <= backoff.delay(3) <= 40)
+
+    def test_circuit_breaker(self):
+        breaker = retry.CircuitBreaker(threshold=2, reset_timeout=60,
+                                       clock=self.__clock)
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+
+        # Opens after consecutive failures, until the timeout
+        breaker.record_failure()
+        self.assertEqual(retry.OPEN, breaker.state)
+        self.assertFalse(breaker.allow())
+        self.time = 45.0
+        self.assertEqual(15.0, breaker.retry_in())
+
+        # Half open, a single probe is allowed, failing it opens again
+        self.time = 60.0
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(retry.OPEN, breaker.state)
+
+        # A probe given back lets the next caller probe
+        self.time = 120.0
+        self.assertTrue(breaker.allow())
+        breaker.release()
+        self.assertTrue(breaker.allow())
+
+        # A successful probe closes it
+        self.assertTrue(breaker.record_success())
+        self.assertEqual(retry.CLOSED, breaker.state)
+        self.assertFalse(breaker.record_success())
+        self.assertEqual(0, breaker.failures)
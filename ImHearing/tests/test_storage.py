@@ -0,0 +1,64 @@
+""" Test the storage backends in ImHearing/storage.py
+"""
+
+import hashlib
+import tempfile
+import unittest
+from io import BytesIO
+from os import listdir, path
+
+from ImHearing import post_recording, storage
+
+
+class TestStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.TemporaryDirectory()
+        self.store = storage.get_storage({'storage_backend': 'local',
+                                          'storage_path': self.work_dir.name})
+
+    def tearDown(self):
+        self.work_dir.cleanup()
+
+    def test_get_storage(self):
+        self.assertIsInstance(self.store, storage.LocalStorage)
+        self.assertEqual('file://' + path.join(self.work_dir.name, 'key'),
+                         self.store.remote_path('key'))
+        with self.assertRaises(ValueError):
+            storage.get_storage({'storage_backend': 'ftp'})
+
+    def test_local_put_object(self):
+        content = b'0123456789' * 100
+        md5 = hashlib.md5(content).hexdigest()
+
+        # Same ETag as S3, the MD5 of the object
+        self.assertEqual('"{}"'.format(md5), self.store.put_object(
+            'key', BytesIO(content), post_recording.get_content_md5(md5)))
+        self.assertEqual(content, self.store.get_object('key'))
+        self.assertEqual(b'2345', self.store.get_object('key', 2, 5))
+
+        # A body not matching its Content-MD5 is refused and not stored
+        with self.assertRaises(storage.StorageError):
+            self.store.put_object('bad_key', BytesIO(content[1:]),
+                                  post_recording.get_content_md5(md5))
+        self.assertEqual(['.uploads', 'key'],
+                         sorted(listdir(self.work_dir.name)))
+
+    def test_local_multipart_upload(self):
+        upload_id = self.store.create_multipart_upload('key')
+        parts = [(number, self.store.upload_part(
+            'key', upload_id, number, BytesIO(data)))
+            for number, data in [(1, b'first '), (2, b'second')]]
+
+        self.assertEqual(
+            storage.get_multipart_etag([etag for _, etag in parts]),
+            self.store.complete_multipart_upload('key', upload_id, parts))
+        self.assertEqual(b'first second', self.store.get_object('key'))
+
+        # Completed (or aborted) uploads are gone
+        with self.assertRaises(storage.UploadLostError):
+            self.store.check_multipart_upload('key', upload_id)
+        upload_id = self.store.create_multipart_upload('key')
+        self.store.abort_multipart_upload('key', upload_id)
+        with self.assertRaises(storage.UploadLostError):
+            self.store.upload_part('key', upload_id, 1, BytesIO(b'data'))
@@ -0,0 +1,84 @@
+""" Test the upload bandwidth limit in ImHearing/throttle.py
+"""
+
+import datetime
+import unittest
+from io import BytesIO
+
+from ImHearing import throttle
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.time = 0.0
+
+    def __call__(self):
+        return self.time
+
+    def sleep(self, seconds):
+        self.time += seconds
+
+
+class TestThrottle(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.now = datetime.datetime(2020, 1, 1, 12, 0)
+
+    def __limiter(self, rate=0, windows=''):
+        return throttle.RateLimiter(
+            rate=rate, windows=throttle.parse_windows(windows),
+            clock=self.clock, sleep=self.clock.sleep, now=lambda: self.now)
+
+    def test_parse_windows(self):
+        self.assertEqual(
+            [(datetime.time(8, 0), datetime.time(20, 0), 1000.0),
+             (datetime.time(22, 0), datetime.time(6, 0), 0.0)],
+            throttle.parse_windows('08:00-20:00=1000, 22:00-06:00=0')
+        )
+        self.assertEqual([], throttle.parse_windows(''))
+        with self.assertRaises(ValueError):
+            throttle.parse_windows('08:00=1000')
+
+    def test_rate_limiter(self):
+        limiter = self.__limiter(rate=1000)
+
+        # A full bucket (one second) is sent at once, then the rate applies
+        limiter.consume(1000)
+        self.assertEqual(0.0, self.clock.time)
+        for _ in range(10):
+            limiter.consume(500)
+        self.assertAlmostEqual(5.0, self.clock.time)
+        self.assertAlmostEqual(5.0, limiter.throttled)
+        self.assertEqual(6000, limiter.bytes_sent)
+        self.assertAlmostEqual(1200.0, limiter.throughput())
+
+        # Rewinds reported by boto3 callbacks are ignored
+        limiter.consume(-500)
+        self.assertEqual(6000, limiter.as_dict()['bytes_sent'])
+
+    def test_rate_limiter_windows(self):
+        limiter = self.__limiter(rate=1000,
+                                 windows='22:00-06:00=0, 08:00-20:00=100')
+        self.assertEqual(100, limiter.current_rate())
+
+        # Unlimited at night, the window crosses midnight
+        self.now = datetime.datetime(2020, 1, 1, 23, 30)
+        self.assertEqual(0, limiter.current_rate())
+        limiter.consume(10 ** 9)
+        self.assertEqual(0.0, self.clock.time)
+
+        self.now = datetime.datetime(2020, 1, 1, 7, 0)
+        self.assertEqual(1000, limiter.current_rate())
+
+    def test_throttled_reader(self):
+        limiter = self.__limiter()
+        reader = throttle.ThrottledReader(BytesIO(b'x' * 100), limiter)
+        self.assertEqual(60, len(reader.read(60)))
+        reader.seek(0)
+        reader.read()
+
+        # Bytes read again after a rewind are only accounted once
+        self.assertEqual(100, limiter.bytes_sent)
+        self.assertEqual(100, reader.tell())
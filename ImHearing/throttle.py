@@ -0,0 +1,171 @@
+""" Bandwidth limit applied to uploads, so they do not starve the capture
+"""
+
+import threading
+import time
+from datetime import datetime
+
+# Seconds without sending after which an upload is considered finished, so
+# idle time does not count in the throughput
+IDLE_SECONDS = 5.0
+
+
+def parse_windows(windows):
+    """
+    Parses time-of-day windows with their own rate, like
+    '08:00-20:00=131072, 22:00-06:00=0'. A window may cross midnight.
+    :param windows: String with comma separated windows (rates in bytes/s)
+    :return: List of (start time, end time, rate) tuples
+    """
+    parsed = list()
+    for window in (windows or '').split(','):
+        if not window.strip():
+            continue
+        try:
+            span, rate = window.split('=')
+            start, end = span.split('-')
+            parsed.append((
+                datetime.strptime(start.strip(), '%H:%M').time(),
+                datetime.strptime(end.strip(), '%H:%M').time(),
+                float(rate)))
+        except ValueError:
+            raise ValueError('Invalid upload window {}'.format(window))
+    return parsed
+
+
+class RateLimiter:
+    """
+    Token bucket shared by all upload threads. Tokens are bytes, refilled at
+    the rate of the current time-of-day window, or the default rate outside
+    them. A rate of 0 means unlimited. consume() blocks the caller until the
+    bytes can be sent, and also accounts the bytes sent and the time spent
+    throttled.
+    """
+
+    def __init__(self, rate=0, windows=None, burst_seconds=1.0,
+                 clock=time.monotonic, sleep=time.sleep, now=datetime.now):
+        self.rate = float(rate)
+        self.windows = windows or []
+        self.burst_seconds = burst_seconds
+        self.bytes_sent = 0
+        self.throttled = 0.0
+        self._clock = clock
+        self._sleep = sleep
+        self._now = now
+        self._tokens = None
+        self._updated = None
+        self._active = 0.0
+        self._last_send = None
+        self._lock = threading.Lock()
+
+    def current_rate(self):
+        """
+        Rate in force now.
+        :return: Rate in bytes/s, 0 if unlimited
+        """
+        now = self._now().time()
+        for start, end, rate in self.windows:
+            if start <= end:
+                inside = start <= now < end
+            else:
+                inside = now >= start or now < end
+            if inside:
+                return rate
+        return self.rate
+
+    def consume(self, nbytes):
+        """
+        Takes nbytes tokens from the bucket, waiting for them if needed. The
+        bucket may go into debt, so concurrent callers queue up behind each
+        other. Can be used as a boto3 transfer Callback, negative amounts
+        (rewinds on retries) are ignored.
+        :param nbytes: Bytes about to be sent
+        """
+        if nbytes <= 0:
+            return
+
+        with self._lock:
+            now = self._clock()
+            rate = self.current_rate()
+            wait = 0.0
+            if rate > 0:
+                capacity = rate * self.burst_seconds
+                if self._tokens is None:
+                    self._tokens = capacity
+                else:
+                    self._tokens = min(capacity, self._tokens +
+                                       (now - self._updated) * rate)
+                self._tokens -= nbytes
+                if self._tokens < 0:
+                    wait = -self._tokens / rate
+            else:
+                self._tokens = None
+            self._updated = now
+
+            # Sending time, from the previous send to the end of this one
+            if self._last_send is not None and \
+                    now - self._last_send < IDLE_SECONDS:
+                self._active += now - self._last_send
+            self._active += wait
+            self._last_send = now + wait
+            self.bytes_sent += nbytes
+            self.throttled += wait
+
+        if wait > 0:
+            self._sleep(wait)
+
+    def throughput(self):
+        """
+        Throughput achieved while uploading, idle time excluded.
+        :return: Bytes/s, 0 if nothing was sent yet
+        """
+        with self._lock:
+            if self._active <= 0:
+                return 0.0
+            return self.bytes_sent / self._active
+
+    def as_dict(self):
+        return {
+            'bytes_sent': self.bytes_sent,
+            'throughput': self.throughput(),
+            'throttled': self.throttled
+        }
+
+
+class ThrottledReader:
+    """
+    File-like wrapper taking tokens from a RateLimiter as data is read. A
+    byte is only accounted once, so rewinds (retries, checksums) are not
+    throttled again.
+    """
+
+    def __init__(self, file_obj, limiter):
+        self._file = file_obj
+        self._limiter = limiter
+        self._read_up_to = file_obj.tell()
+
+    def read(self, size=-1):
+        data = self._file.read(size)
+        position = self._file.tell()
+        if position > self._read_up_to:
+            self._limiter.consume(position - self._read_up_to)
+            self._read_up_to = position
+        return data
+
+    def seek(self, offset, whence=0):
+        return self._file.seek(offset, whence)
+
+    def tell(self):
+        return self._file.tell()
+
+
+def get_rate_limiter(aws_config):
+    """
+    Creates the upload RateLimiter from the AWS Configuration: upload_rate
+    (bytes/s, 0 for unlimited) and upload_rate_windows.
+    :param aws_config: AWS Config Dict
+    :return: RateLimiter Object
+    """
+    return RateLimiter(
+        rate=float(aws_config.get('upload_rate', 0) or 0),
+        windows=parse_windows(aws_config.get('upload_rate_windows', '')))
@@ -1,23 +1,32 @@
 """ This file contains routines to display and get data from DB
 """
 
+import json
+from datetime import datetime
+from mimetypes import guess_type
 from uuid import UUID
 
 import validators
-from flask import Blueprint, Flask, render_template
+from flask import (Blueprint, Flask, Response, abort, jsonify,
+                   render_template, request)
 from pony.orm import db_session
 
-from ImHearing import reader
+from ImHearing import post_recording, reader
 from ImHearing.database import models, query
 
 DB_CONFIG, db_ret = reader.db_config()
+AWS_CONFIG, aws_ret = reader.aws_config()
 
 db = models.define_db(
+    profile=models.get_sqlite_profile(DB_CONFIG),
     provider='sqlite',
     filename=DB_CONFIG['db_path'],
     create_db=True
 )
 
+# Timezone of the dates given to the queries
+QUERY_TIMEZONE = 'America/Sao_Paulo'
+
 app = Flask(__name__)
 v1 = Blueprint("version1", "version1")
 
@@ -48,27 +57,77 @@ def get_record_id(record_id):
     return render_template('singlerecord.html', record=out)
 
 
-@v1.route('/records/')
+@v1.route('/records/<record_id>/audio')
 @db_session
-def get_all_records():
-    list_of_records = query.get_all_records(db)
-    records_dict = dict()
+def get_record_audio(record_id):
+
+    if not validators.uuid(record_id):
+        abort(404)
+    record_uuid = UUID(record_id)
+    rec = query.get_single_record(db, record_uuid.bytes)
+    if not rec:
+        abort(404)
+
+    # Only the record is fetched from S3, not its whole archive
+    content = post_recording.fetch_record(db, AWS_CONFIG, rec.id)
+    if content is None:
+        abort(404)
+    return Response(content,
+                    mimetype=guess_type(rec.path)[0] or 'audio/wav')
+
+
+def stream_json(list_function, after, limit):
+    """
+    Streams all rows of a listing, from a cursor on, as a JSON array. Rows
+    are read page by page, each page in its own DB session, so neither the
+    table nor the response is held in memory.
+    :param list_function: query.get_all_records or query.get_all_archives
+    :param after: Cursor to start after, None to start at the first row
+    :param limit: Rows read per page
+    :return: Generator of JSON text chunks
+    """
+    yield '['
+    first = True
+    while True:
+        rows, after = list_function(db, after, limit)
+        for row in rows:
+            yield ('' if first else ',') + json.dumps(row)
+            first = False
+        if after is None:
+            break
+    yield ']'
+
+
+def list_page(list_function, template, name):
+    """
+    Renders a page of a listing, with the cursor and page size given in the
+    query string (after, limit). With format=json, all rows from the cursor
+    on are streamed as JSON instead.
+    :param list_function: query.get_all_records or query.get_all_archives
+    :param template: Template of the HTML page
+    :param name: Name of the rows in the template
+    :return: Response
+    """
+    after = request.args.get('after') or None
+    try:
+        limit = query.get_page_limit(request.args.get('limit'))
+        if after is not None:
+            query.decode_cursor(after)
+    except ValueError:
+        abort(400)
+
+    if request.args.get('format') == 'json':
+        return Response(stream_json(list_function, after, limit),
+                        mimetype='application/json')
+
+    rows, next_cursor = list_function(db, after, limit)
+    return render_template(template, next_cursor=next_cursor, limit=limit,
+                           **{name: rows})
 
-    for record in list_of_records:
-        records_dict[str(record.id)] = {
-            'ID': str(record.id),
-            'Status': record.status,
-            'Start': record.start,
-            'End': record.end,
-            'Size': record.size
-        }
-        if record.archive is not None:
-            records_dict[str(record.id)]['Archive'] = str(record.archive.id)
 
-        else:
-            records_dict[str(record.id)]['Archive'] = None
-
-    return render_template('recordslist.html', records=records_dict)
+@v1.route('/records/')
+def get_all_records():
+    return list_page(query.get_all_records, 'recordslist.html', 'records')
 
 
 @v1.route('/archives/<archive_id>')
@@ -98,20 +157,8 @@ def get_archive_id(archive_id):
 
 
 @v1.route('/archives/')
-@db_session
 def get_all_archives():
-    list_of_archives = query.get_all_archives(db)
-    archives_dict = dict()
-
-    for archive in list_of_archives:
-        archives_dict[str(archive.id)] = {
-            'ID': str(archive.id),
-            'Created': archive.creation,
-            'LocalPath': archive.local_path,
-            'RemotePath': archive.remote_path
-        }
-
-    return render_template('archiveslist.html', archives=archives_dict)
+    return list_page(query.get_all_archives, 'archiveslist.html', 'archives')
 
 
 @v1.route('/query/<datetime>')
@@ -131,6 +178,47 @@ def get_query_by_date(datetime):
     return render_template('querylist.html', records=records)
 
 
+def query_range():
+    """
+    Reads the time range given in the query string (start, end), in the
+    format of the date queries: YYYY-MM-DD HH:MM, where HH:MM is optional.
+    :return: Tuple (start, end) of datetimes, None where not given
+    """
+    return tuple(
+        datetime.strptime(query.parse_query_date(request.args[key],
+                                                 QUERY_TIMEZONE),
+                          query.DATETIME_FORMAT)
+        if request.args.get(key) else None
+        for key in ('start', 'end'))
+
+
+@v1.route('/health')
+def get_capture_health():
+    try:
+        start, end = query_range()
+    except ValueError:
+        abort(400)
+    return jsonify(query.get_capture_health(db, start, end))
+
+
+@v1.route('/loud/')
+def get_loud_spans():
+    level = request.args.get('level', 'peak')
+    try:
+        threshold = float(request.args['threshold'])
+        start, end = query_range()
+    except (KeyError, ValueError):
+        abort(400)
+    if level not in ('peak', 'rms'):
+        abort(400)
+
+    spans = query.get_loud_spans(db, threshold, start, end, level)
+    for span in spans:
+        span['Start'] = str(span['Start'])
+        span['End'] = str(span['End'])
+    return jsonify(spans)
+
+
 app.register_blueprint(v1, url_prefix="/v1")
 
 
@@ -4,12 +4,13 @@
 import random
 import threading
 import time
-from queue import Queue
+from queue import Empty, Queue
 from signal import SIGINT, signal
 
 from pony.orm.dbapiprovider import DatabaseError
 
-from ImHearing import audio, logger, post_recording, pre_recording, reader
+from ImHearing import (audio, logger, post_recording, pre_recording, reader,
+                       retry)
 from ImHearing.database import models
 
 # Configurations Sections
@@ -20,6 +21,9 @@ DB_CONFIG, db_ret = reader.db_config()
 # Queue for Threads
 task_queue = Queue(maxsize=1)
 
+# Queue for the priority lane, fed with loud records as soon as they finish
+priority_queue = Queue()
+
 # Semaphore to indicate that Thread is uploading a file and cannot be killed
 thread_uploading_archive = False
 
@@ -42,6 +46,7 @@ if global_ret < 0 or aws_ret < 0 or db_ret < 0:
 # Defines the DB Connection to Pony
 try:
     db = models.define_db(
+        profile=models.get_sqlite_profile(DB_CONFIG),
         provider='sqlite',
         filename=DB_CONFIG['db_path'],
         create_db=True
@@ -51,6 +56,9 @@ except DatabaseError as e:
     print("-- Recreate the DB or Try some DB Recovery Utility --")
     exit(-1)
 
+# Capture engines (one per device) kept open for the whole execution
+capture_engines = audio.get_capture_engines(GLOBAL_CONFIG)
+
 
 def exit_handler(signal_received, frame):
     """
@@ -74,8 +82,14 @@ def exit_handler(signal_received, frame):
                 "Terminating Thread".format(signal_received))
             thread_run = False
 
-    # Archive
-    post_recording.archive_records(db, GLOBAL_CONFIG)
+    # Release the audio devices
+    for engine in capture_engines:
+        engine.stop()
+
+    # Archive (priority records not uploaded yet go with the bulk ones). In
+    # stream mode, records are left to be streamed by the next execution
+    if post_recording.get_archive_mode(GLOBAL_CONFIG) == 'local':
+        post_recording.archive_records(db, GLOBAL_CONFIG)
 
     # --> Clean Up Routine Here
     post_recording.remove_uploaded_records(db)
@@ -88,38 +102,85 @@ def processing():
     This routine is the main consumer to the Queue. Every time an item is added
     to the Queue, this routine consumes it.
     """
+    global thread_uploading_archive
+    processing_logger = logger.get_logger("processing",
+                                          GLOBAL_CONFIG['log_file'])
 
     while True and thread_run:
         if not task_queue.empty():
             # Set the semaphore
             thread_uploading_archive = True
 
-            # Archive, Upload & Remove Records & Archives
-            post_recording.archive_records(db, GLOBAL_CONFIG)
+            # Archive, Upload & Remove Records & Archives. Streamed archives
+            # are uploaded while they are built
+            if post_recording.get_archive_mode(GLOBAL_CONFIG) == 'stream':
+                post_recording.stream_archive(db, GLOBAL_CONFIG, AWS_CONFIG)
+            else:
+                post_recording.archive_records(db, GLOBAL_CONFIG)
 
-            # Uploading check
+            # Uploading check. Failed archives are retried by the next
+            # tasks, after their backoff, while the recording goes on
             up_arch = post_recording.upload_archive(db, AWS_CONFIG)
-            up_count = 0
-            while up_arch is False and up_count <= 10:
-                wait_time = random.randint(10, 90)
-                time.sleep(wait_time)
-                up_arch = post_recording.upload_archive(db, AWS_CONFIG)
-                up_count += 1
-            if up_count > 10:
-                exit(-1)
+            if not all(up_arch.values()):
+                processing_logger.warning(
+                    " -- {} Archive(s) Failed, Retried Later --".format(
+                        list(up_arch.values()).count(False)))
+            breaker = post_recording.get_circuit_breaker(AWS_CONFIG)
+            if breaker.state == retry.OPEN:
+                processing_logger.warning(
+                    " -- Object Store Unreachable, Uploads Paused for "
+                    "{:.0f} sec --".format(breaker.retry_in()))
 
             post_recording.remove_uploaded_archives(db)
             post_recording.remove_uploaded_records(db)
 
+            # Throughput achieved under the bandwidth limit
+            upload_stats = post_recording.get_upload_limiter(
+                AWS_CONFIG).as_dict()
+            processing_logger.info(
+                " -- Upload Throughput: {:.1f} KB/s, Throttled: {:.1f} sec "
+                "--".format(upload_stats['throughput'] / 1024,
+                            upload_stats['throttled']))
+
             # Removes task from queue after finishing all tasks and Release Sem
             thread_uploading_archive = False
             task_queue.get()
     return
 
 
+def priority_processing():
+    """
+    Consumer of the priority lane. Loud records are archived and uploaded
+    on their own as soon as they are queued, regardless of the bulk batch
+    handled by processing(). If the upload fails, the archive is uploaded
+    later by the bulk lane.
+    """
+    priority_logger = logger.get_logger("priority",
+                                        GLOBAL_CONFIG['log_file'])
+
+    while thread_run:
+        try:
+            record_id = priority_queue.get(timeout=1)
+        except Empty:
+            continue
+
+        if post_recording.upload_priority_records(db, GLOBAL_CONFIG,
+                                                  AWS_CONFIG):
+            priority_logger.info(
+                " -- Priority Record {} Uploaded -- ".format(record_id))
+        else:
+            priority_logger.warning(
+                " -- Priority Upload of {} Failed, Left to the Bulk "
+                "Upload -- ".format(record_id))
+        priority_queue.task_done()
+    return
+
+
 def main():
 
     main_logger = logger.get_logger("runner", GLOBAL_CONFIG['log_file'])
+    # Warnings of the ImHearing modules (e.g. uploads) go to the same file
+    logger.get_logger("ImHearing", GLOBAL_CONFIG['log_file'])
 
     while True:
         if pre_recording.check_aws_budget(db, AWS_CONFIG) < 0:
@@ -152,17 +213,46 @@ def main():
                 " -- Queueing Task {} -- ".format(task_id)
             )
 
-        record_obj = audio.start_recording(db, GLOBAL_CONFIG)
-        main_logger.info(
-            " -- Record {} Finished -- ".format(record_obj.path)
-        )
+        records = audio.start_recording_all(db, GLOBAL_CONFIG,
+                                            capture_engines)
+        for record_obj in records:
+            if record_obj is None or record_obj.status == 'silent':
+                main_logger.info(" -- Silent Record Skipped -- ")
+            elif record_obj.status == 'error':
+                main_logger.error(
+                    " -- Capture Stalled, Record Ended Early (Device {}) "
+                    "--".format(record_obj.device))
+            else:
+                main_logger.info(
+                    " -- Record {} Finished -- ".format(record_obj.path)
+                )
+            if record_obj is not None and record_obj.status == 'priority':
+                main_logger.info(
+                    " -- Queueing Priority Record {} -- ".format(
+                        record_obj.path))
+                priority_queue.put(str(record_obj.id))
+            # Capture health, to correlate dropped audio with uploads
+            if record_obj is not None and record_obj.overflows:
+                main_logger.warning(
+                    " -- Capture Overflows: {}, Late Reads: {}, Uploading: {} "
+                    "(Device {}) --".format(record_obj.overflows,
+                                            record_obj.late_reads,
+                                            thread_uploading_archive,
+                                            record_obj.device))
 
 
 if __name__ == '__main__':
     signal(SIGINT, exit_handler)
+    # Before any stream starts, drop the ones a crash left open
+    post_recording.abort_stream_uploads(db, AWS_CONFIG)
+    for engine in capture_engines:
+        engine.start()
     consumer_thread = threading.Thread(target=processing)
     thread_list.append(consumer_thread)
+    priority_thread = threading.Thread(target=priority_processing,
+                                       daemon=True)
 
     # Start Threads
     consumer_thread.start()
+    priority_thread.start()
     main()
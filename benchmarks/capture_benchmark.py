@@ -0,0 +1,64 @@
+""" Measures the overhead of the capture path without a microphone. A signal
+source runs as fast as the recorder consumes it, so the result is how many
+seconds of audio are recorded per second of wall clock (and of CPU).
+
+Run from the repository root:
+    python -m benchmarks.capture_benchmark --records 20 --period 30
+    python -m benchmarks.capture_benchmark --sample-rate 16000
+"""
+
+import argparse
+import tempfile
+import time
+from os import path
+
+from ImHearing import audio
+from ImHearing.database import models
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--records', type=int, default=10)
+    parser.add_argument('--period', type=int, default=30)
+    parser.add_argument('--source', default='signal',
+                        choices=['signal', 'file'])
+    parser.add_argument('--source-file', default='')
+    parser.add_argument('--sample-rate', type=int, default=0,
+                        help='resample records to this rate')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        global_config = {
+            'record_path': work_dir + '/',
+            'archive_path': work_dir + '/',
+            'record_period': str(args.period),
+            'audio_source': args.source,
+            'source_file': args.source_file,
+            'source_speed': '0'
+        }
+        if args.sample_rate:
+            global_config['sample_rate'] = str(args.sample_rate)
+        db = models.define_db(provider='sqlite',
+                              filename=path.join(work_dir, 'bench.db'),
+                              create_db=True)
+
+        engine = audio.get_capture_engine(global_config)
+        engine.start()
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        for _ in range(args.records):
+            audio.start_recording(db, global_config, engine)
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+        engine.stop()
+
+    audio_seconds = args.records * args.period
+    chunks = audio_seconds * engine.source.rate / engine.chunk
+    print('Recorded {}s of audio in {:.2f}s ({:.1f}x real time)'.format(
+        audio_seconds, wall, audio_seconds / wall))
+    print('CPU time: {:.2f}s, {:.1f} us per chunk of {} frames'.format(
+        cpu, cpu / chunks * 1e6, engine.chunk))
+
+
+if __name__ == '__main__':
+    main()
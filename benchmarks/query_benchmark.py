@@ -0,0 +1,161 @@
+""" Measures the latency of the catalog queries on a large database, with
+and without the indexes created by the schema migrations. The catalog is
+filled as after a long run: most records archived, uploaded and removed,
+and a small backlog of records and archives still local.
+
+Run from the repository root:
+    python -m benchmarks.query_benchmark --records 100000
+    python -m benchmarks.query_benchmark --records 1000000 --repeat 3
+"""
+
+import argparse
+import sqlite3
+import tempfile
+import time
+from datetime import datetime, timedelta
+from os import path
+from uuid import uuid4
+
+from pony.orm import db_session
+
+from ImHearing.database import models, query
+
+# Pony stores datetimes as text with microseconds
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+
+def fill_catalog(db_file, records, records_per_archive, backlog):
+    """
+    Inserts the rows straight with sqlite3, much faster than through Pony.
+    The last backlog records are recorded and not archived yet, the
+    archives of the last 10 * backlog archived records are not uploaded.
+    Optional strings are NOT NULL for Pony, so they are set to ''.
+    """
+    first = datetime(2020, 1, 1)
+    archived = records - backlog
+    connection = sqlite3.connect(db_file)
+    archive_ids = list()
+    archive_rows = list()
+    for number in range(-(-archived // records_per_archive)):
+        archive_ids.append(uuid4().bytes)
+        uploaded = (number + 1) * records_per_archive < archived - \
+            10 * backlog
+        archive_rows.append((
+            archive_ids[-1], (first + timedelta(
+                seconds=30 * number * records_per_archive)).strftime(
+                DATETIME_FORMAT),
+            '/data/archive_{}.zip'.format(number), 1.0,
+            'https://bucket/{}'.format(number) if uploaded else '',
+            int(uploaded), int(uploaded)))
+    connection.executemany(
+        'INSERT INTO "Archive" (id, creation, local_path, size, remote_path, '
+        'uploaded, removed, upload_id, sha256, md5, etag) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?, \'\', \'\', \'\', \'\')',
+        archive_rows)
+
+    def record_rows():
+        for number in range(records):
+            start = first + timedelta(seconds=30 * number)
+            is_archived = number < archived
+            yield (uuid4().bytes, start.strftime(DATETIME_FORMAT),
+                   (start + timedelta(seconds=30)).strftime(DATETIME_FORMAT),
+                   2.5, '/data/record_{}.wav'.format(number),
+                   'archived' if is_archived else 'recorded',
+                   int(is_archived and
+                       archive_rows[number // records_per_archive][5]),
+                   archive_ids[number // records_per_archive]
+                   if is_archived else None)
+    connection.executemany(
+        'INSERT INTO "Record" (id, start, "end", size, path, status, removed, '
+        'archive, device, sha256) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?, ?, \'\', \'\')', record_rows())
+    connection.commit()
+    connection.close()
+    return first + timedelta(seconds=30 * records)
+
+
+def get_queries(db, last):
+    """
+    Queries timed. Those returning a Pony query are counted, so the time is
+    spent filtering in SQLite rather than building objects; the others are
+    timed end to end.
+    """
+    window_start = last - timedelta(days=2)
+    window_end = last - timedelta(days=1)
+    date_format = '%Y-%m-%d %H:%M'
+    return [
+        ('get_recorded_entries',
+         lambda: query.get_recorded_entries(db).count()),
+        ('get_archives_not_uploaded',
+         lambda: query.get_archives_not_uploaded(db).count()),
+        ('get_archives_due',
+         lambda: query.get_archives_due(db, datetime.now()).count()),
+        ('get_local_archive_files',
+         lambda: query.get_local_archive_files(db).count()),
+        ('get_local_record_files',
+         lambda: query.get_local_record_files(db).count()),
+        ('get_records_uploaded',
+         lambda: query.get_records_uploaded(db).count()),
+        ('get_record_by_date (1 day)',
+         lambda: query.get_record_by_date(
+             db, window_start.strftime(date_format),
+             window_end.strftime(date_format), 'UTC')),
+        ('get_record_by_date (1 week)',
+         lambda: query.get_record_by_date(
+             db, (window_end - timedelta(days=7)).strftime(date_format),
+             window_end.strftime(date_format), 'UTC')),
+        ('get_counters', lambda: query.get_counters(db))
+    ]
+
+
+def time_queries(queries, repeat):
+    timings = dict()
+    for name, function in queries:
+        best = None
+        for _ in range(repeat):
+            with db_session:
+                start = time.perf_counter()
+                function()
+                elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        timings[name] = best
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--records', type=int, default=100000)
+    parser.add_argument('--records-per-archive', type=int, default=100)
+    parser.add_argument('--backlog', type=int, default=200,
+                        help='records not archived yet')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        db_file = path.join(work_dir, 'bench.db')
+        db = models.define_db(provider='sqlite', filename=db_file,
+                              create_db=True)
+        fill_start = time.perf_counter()
+        last = fill_catalog(db_file, args.records, args.records_per_archive,
+                            args.backlog)
+        print('Filled {} records in {:.1f}s'.format(
+            args.records, time.perf_counter() - fill_start))
+        with db_session:
+            db.execute('ANALYZE')
+
+        queries = get_queries(db, last)
+        indexed = time_queries(queries, args.repeat)
+        with db_session:
+            for name, _, _ in models.INDEXES + models.PAGE_INDEXES:
+                db.execute('DROP INDEX "{}"'.format(name))
+        scanned = time_queries(queries, args.repeat)
+
+    print('{:30} {:>12} {:>12}'.format('Query (best of {})'.format(
+        args.repeat), 'Indexed ms', 'Scan ms'))
+    for name, _ in queries:
+        print('{:30} {:12.2f} {:12.2f}'.format(
+            name, indexed[name] * 1000, scanned[name] * 1000))
+
+
+if __name__ == '__main__':
+    main()
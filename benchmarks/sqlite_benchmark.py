@@ -0,0 +1,133 @@
+""" Measures the throughput of concurrent writers and readers on the same
+database, with the SQLite defaults and with the profile of the DB
+Configuration (WAL, synchronous, cache and mmap sizes, busy timeout). Each
+worker is a process with its own connection, as the recorder, the upload
+thread and the web app are: writers add records one transaction at a time,
+readers list pages of records and read the counters.
+
+Run from the repository root:
+    python -m benchmarks.sqlite_benchmark
+    python -m benchmarks.sqlite_benchmark --writers 2 --readers 4 --seconds 10
+"""
+
+import argparse
+import multiprocessing
+import tempfile
+import time
+from datetime import datetime, timedelta
+from os import path
+
+from pony.orm import db_session
+from pony.orm.dbapiprovider import OperationalError
+
+from ImHearing.database import models, query
+
+# Profile of config_example.ini
+PROFILE_CONFIG = {
+    'busy_timeout': '5000',
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'cache_size': '-16000',
+    'mmap_size': '268435456'
+}
+
+
+def open_db(db_file, profile):
+    return models.define_db(profile=profile, provider='sqlite',
+                            filename=db_file, create_db=True)
+
+
+def write_records(db, start, number):
+    """
+    Adds a record and archives the previous one, in one transaction.
+    """
+    with db_session:
+        record = db.Record(start=start + timedelta(seconds=30 * number),
+                           end=start + timedelta(seconds=30 * (number + 1)),
+                           size=2.5, path='/data/record_{}.wav'.format(number),
+                           status='recorded', removed=False)
+        previous = db.Record.select(
+            lambda rec: rec.status == 'recorded' and rec.id != record.id
+        ).first()
+        if previous is not None:
+            previous.status = 'archived'
+
+
+def read_records(db, start, number):
+    query.get_all_records(db, limit=query.PAGE_SIZE)
+    query.get_counters(db)
+
+
+def worker(role, db_file, profile, seconds, first, results):
+    """
+    Runs a role (write or read) until the deadline.
+    :return: Through results: (role, operations, lock errors, worst ms)
+    """
+    db = open_db(db_file, profile)
+    operation = write_records if role == 'write' else read_records
+    operations = errors = 0
+    worst = 0.0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        started = time.perf_counter()
+        try:
+            operation(db, first, operations + errors)
+            operations += 1
+        except OperationalError:
+            # database is locked: the busy timeout expired
+            errors += 1
+        worst = max(worst, time.perf_counter() - started)
+    db.disconnect()
+    results.put((role, operations, errors, worst * 1000))
+
+
+def run(profile, args):
+    with tempfile.TemporaryDirectory() as work_dir:
+        db_file = path.join(work_dir, 'bench.db')
+        open_db(db_file, profile).disconnect()
+
+        results = multiprocessing.Queue()
+        roles = ['write'] * args.writers + ['read'] * args.readers
+        workers = [multiprocessing.Process(
+            target=worker, args=(role, db_file, profile, args.seconds,
+                                 datetime(2020, 1, 1) +
+                                 timedelta(days=number), results))
+            for number, role in enumerate(roles)]
+        for process in workers:
+            process.start()
+        finished = [results.get() for _ in workers]
+        for process in workers:
+            process.join()
+
+    totals = dict()
+    for role, operations, errors, worst in finished:
+        total = totals.setdefault(role, [0, 0, 0.0])
+        total[0] += operations
+        total[1] += errors
+        total[2] = max(total[2], worst)
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--writers', type=int, default=1)
+    parser.add_argument('--readers', type=int, default=2)
+    parser.add_argument('--seconds', type=float, default=5)
+    args = parser.parse_args()
+
+    profiles = [('SQLite defaults', []),
+                ('Profile', models.get_sqlite_profile(PROFILE_CONFIG))]
+    print('{:16} {:6} {:>10} {:>8} {:>13}'.format(
+        'Settings', 'Role', 'Ops/s', 'Locked', 'Worst ms'))
+    for name, profile in profiles:
+        totals = run(profile, args)
+        for role in ('write', 'read'):
+            if role not in totals:
+                continue
+            operations, errors, worst = totals[role]
+            print('{:16} {:6} {:10.1f} {:8} {:13.1f}'.format(
+                name, role, operations / args.seconds, errors, worst))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+""" Measures the archive -> upload -> cleanup cycle offline, uploading to the
+local storage backend. Records are random bytes (the worst case for
+compression), so the result is the throughput of each stage on this box.
+
+Run from the repository root:
+    python -m benchmarks.upload_benchmark --records 20 --record-size 5
+    python -m benchmarks.upload_benchmark --concurrency 8 --part-size 5
+    python -m benchmarks.upload_benchmark --storage-path /mnt/other_disk
+"""
+
+import argparse
+import tempfile
+import time
+from datetime import datetime, timedelta
+from os import path, urandom
+
+from pony.orm import db_session
+
+from ImHearing import post_recording
+from ImHearing.database import models
+
+
+@db_session
+def create_records(db, work_dir, records, record_size):
+    start = datetime.now()
+    for number in range(records):
+        record_path = path.join(work_dir, 'record_{}.wav'.format(number))
+        with open(record_path, 'wb') as record_file:
+            record_file.write(urandom(record_size))
+        db.Record(start=start + timedelta(seconds=30 * number),
+                  end=start + timedelta(seconds=30 * (number + 1)),
+                  size=record_size / (1024 * 1024), path=record_path,
+                  status='recorded')
+
+
+def timed(function, *args):
+    wall_start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - wall_start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--records', type=int, default=10)
+    parser.add_argument('--record-size', type=float, default=5,
+                        help='size of each record in MB')
+    parser.add_argument('--archive-max-size', type=int, default=100,
+                        help='MB of records per archive (shard)')
+    parser.add_argument('--compression', default='stored')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--concurrency', type=int,
+                        default=post_recording.UPLOAD_CONCURRENCY)
+    parser.add_argument('--part-size', type=int,
+                        default=post_recording.PART_SIZE_MB)
+    parser.add_argument('--rate', type=int, default=0,
+                        help='upload limit in bytes/s, 0 for unlimited')
+    parser.add_argument('--storage-path', default='',
+                        help='destination directory, a temporary one by '
+                             'default')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        global_config = {
+            'archive_path': work_dir + '/',
+            'archive_max_size': str(args.archive_max_size),
+            'archive_compression': args.compression,
+            'archive_workers': str(args.workers)
+        }
+        aws_config = {
+            'storage_backend': 'local',
+            'storage_path': args.storage_path or path.join(work_dir,
+                                                           'store'),
+            'upload_concurrency': str(args.concurrency),
+            'upload_part_size': str(args.part_size),
+            'upload_rate': str(args.rate)
+        }
+        db = models.define_db(provider='sqlite',
+                              filename=path.join(work_dir, 'bench.db'),
+                              create_db=True)
+        record_size = int(args.record_size * 1024 * 1024)
+        create_records(db, work_dir, args.records, record_size)
+        total_mb = args.records * record_size / (1024 * 1024)
+
+        archives, archive_time = timed(post_recording.archive_records, db,
+                                       global_config)
+        results, upload_time = timed(post_recording.upload_archive, db,
+                                     aws_config)
+        _, cleanup_time = timed(
+            lambda: (post_recording.remove_uploaded_archives(db),
+                     post_recording.remove_uploaded_records(db)))
+
+    print('{} records, {:.1f}MB in {} archive(s), {} uploaded'.format(
+        args.records, total_mb, len(archives or []),
+        list(results.values()).count(True)))
+    for stage, seconds in [('Archive', archive_time),
+                           ('Upload', upload_time),
+                           ('Cleanup', cleanup_time)]:
+        print('{:8} {:.2f}s ({:.1f} MB/s)'.format(
+            stage, seconds, total_mb / seconds if seconds else 0))
+    upload_stats = post_recording.get_upload_limiter(aws_config).as_dict()
+    print('Throttled: {:.2f}s'.format(upload_stats['throttled']))
+
+
+if __name__ == '__main__':
+    main()
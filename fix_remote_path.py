@@ -15,6 +15,7 @@ AWS_CONFIG, aws_ret = reader.aws_config()
 # Defines the DB Connection to Pony
 try:
     db = models.define_db(
+        profile=models.get_sqlite_profile(DB_CONFIG),
         provider='sqlite',
         filename=DB_CONFIG['db_path'],
         create_db=True
@@ -0,0 +1,37 @@
+""" Recomputes the storage and budget counters from the records and archives
+"""
+
+from pony.orm.dbapiprovider import DatabaseError
+
+from ImHearing import reader
+from ImHearing.database import models, query
+
+# Get DB Configuration
+DB_CONFIG, db_ret = reader.db_config()
+
+
+# Defines the DB Connection to Pony
+try:
+    db = models.define_db(
+        profile=models.get_sqlite_profile(DB_CONFIG),
+        provider='sqlite',
+        filename=DB_CONFIG['db_path'],
+        create_db=True
+    )
+except DatabaseError as e:
+    print("ERROR: {}".format(e))
+    print("-- Recreate the DB or Try some DB Recovery Utility --")
+    exit(-1)
+
+
+def main():
+
+    counters_before = query.get_counters(db)
+    models.repair_counters(db)
+    counters_after = query.get_counters(db)
+    for name, value in counters_after.items():
+        print("{}: {} -> {}".format(name, counters_before[name], value))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,12 @@
 """ Main file with routines to run Listener
 """
 
-import random
-import time
 from signal import SIGINT, signal
 
 from pony.orm.dbapiprovider import DatabaseError
 
-from ImHearing import audio, logger, post_recording, pre_recording, reader
+from ImHearing import (audio, logger, post_recording, pre_recording, reader,
+                       retry)
 from ImHearing.database import models
 
 # Configurations Sections
@@ -28,6 +27,7 @@ if global_ret < 0 or aws_ret < 0 or db_ret < 0:
 # Defines the DB Connection to Pony
 try:
     db = models.define_db(
+        profile=models.get_sqlite_profile(DB_CONFIG),
         provider='sqlite',
         filename=DB_CONFIG['db_path'],
         create_db=True
@@ -37,6 +37,9 @@ except DatabaseError as e:
     print("-- Recreate the DB or Try some DB Recovery Utility --")
     exit(-1)
 
+# Capture engines (one per device) kept open for the whole execution
+capture_engines = audio.get_capture_engines(GLOBAL_CONFIG)
+
 
 def exit_handler(signal_received, frame):
     """
@@ -46,8 +49,14 @@ def exit_handler(signal_received, frame):
     my_logger = logger.get_logger("exit_handler", GLOBAL_CONFIG['log_file'])
     my_logger.info("Terminating - Reveived Signal {}".format(signal_received))
 
-    # Archive
-    post_recording.archive_records(db, GLOBAL_CONFIG)
+    # Release the audio devices
+    for engine in capture_engines:
+        engine.stop()
+
+    # Archive (priority records not uploaded yet go with the bulk ones). In
+    # stream mode, records are left to be streamed by the next execution
+    if post_recording.get_archive_mode(GLOBAL_CONFIG) == 'local':
+        post_recording.archive_records(db, GLOBAL_CONFIG)
 
     # --> Clean Up Routine Here
     post_recording.remove_uploaded_records(db)
@@ -58,6 +67,8 @@ def exit_handler(signal_received, frame):
 def main():
 
     main_logger = logger.get_logger("runner", GLOBAL_CONFIG['log_file'])
+    # Warnings of the ImHearing modules (e.g. uploads) go to the same file
+    logger.get_logger("ImHearing", GLOBAL_CONFIG['log_file'])
 
     while True:
         if pre_recording.check_aws_budget(db, AWS_CONFIG) < 0:
@@ -80,36 +91,73 @@ def main():
             perform_cleanup_routines = True
 
         if perform_cleanup_routines:
-            # Archive, Upload & Remove Records & Archives
-            post_recording.archive_records(db, GLOBAL_CONFIG)
-
-            # Uploading check
+            # Archive, Upload & Remove Records & Archives. Streamed archives
+            # are uploaded while they are built
+            if post_recording.get_archive_mode(GLOBAL_CONFIG) == 'stream':
+                post_recording.stream_archive(db, GLOBAL_CONFIG, AWS_CONFIG)
+            else:
+                post_recording.archive_records(db, GLOBAL_CONFIG)
+
+            # Uploading check. Failed archives are retried by the next
+            # passes, after their backoff, while the recording goes on
             up_arch = post_recording.upload_archive(db, AWS_CONFIG)
-            up_count = 0
-            while up_arch is False and up_count <= 10:
-                wait_time = random.randint(10, 90)
-                main_logger.info(
-                    " -- Retrying Upload in {} sec due to Error --".format(
-                        wait_time))
-                time.sleep(wait_time)
-                up_arch = post_recording.upload_archive(db, AWS_CONFIG)
-                up_count += 1
-            if up_count > 10:
-                main_logger.info(
-                    " -- Terminating due to exceeded timeouts --"
-                )
-                exit(-1)
+            if not all(up_arch.values()):
+                main_logger.warning(
+                    " -- {} Archive(s) Failed, Retried Later --".format(
+                        list(up_arch.values()).count(False)))
+            breaker = post_recording.get_circuit_breaker(AWS_CONFIG)
+            if breaker.state == retry.OPEN:
+                main_logger.warning(
+                    " -- Object Store Unreachable, Uploads Paused for "
+                    "{:.0f} sec --".format(breaker.retry_in()))
 
             post_recording.remove_uploaded_archives(db)
             post_recording.remove_uploaded_records(db)
             main_logger.info(" -- Archive and Upload routines Finished -- ")
-        else:
-            record_obj = audio.start_recording(db, GLOBAL_CONFIG)
+            upload_stats = post_recording.get_upload_limiter(
+                AWS_CONFIG).as_dict()
             main_logger.info(
-                " -- Record {} Finished -- ".format(record_obj.path)
-            )
+                " -- Upload Throughput: {:.1f} KB/s, Throttled: {:.1f} sec "
+                "--".format(upload_stats['throughput'] / 1024,
+                            upload_stats['throttled']))
+
+        # Recording goes on even when uploads are failing
+        records = audio.start_recording_all(db, GLOBAL_CONFIG,
+                                            capture_engines)
+        for record_obj in records:
+            if record_obj is None or record_obj.status == 'silent':
+                main_logger.info(" -- Silent Record Skipped -- ")
+            elif record_obj.status == 'error':
+                main_logger.error(
+                    " -- Capture Stalled, Record Ended Early (Device {}) "
+                    "--".format(record_obj.device))
+            else:
+                main_logger.info(
+                    " -- Record {} Finished -- ".format(record_obj.path)
+                )
+            if record_obj is not None and record_obj.overflows:
+                main_logger.warning(
+                    " -- Capture Overflows: {}, Late Reads: {} "
+                    "(Device {}) --".format(record_obj.overflows,
+                                            record_obj.late_reads,
+                                            record_obj.device))
+
+        # Loud records are uploaded right away, not with the next batch
+        if any(record_obj is not None and record_obj.status == 'priority'
+               for record_obj in records):
+            if post_recording.upload_priority_records(db, GLOBAL_CONFIG,
+                                                      AWS_CONFIG):
+                main_logger.info(" -- Priority Records Uploaded -- ")
+            else:
+                main_logger.warning(
+                    " -- Priority Upload Failed, Left to the Next "
+                    "Upload -- ")
 
 
 if __name__ == '__main__':
     signal(SIGINT, exit_handler)
+    # Before any stream starts, drop the ones a crash left open
+    post_recording.abort_stream_uploads(db, AWS_CONFIG)
+    for engine in capture_engines:
+        engine.start()
     main()